@@ -1,6 +1,14 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.http import QueryDict
 
-from .models import Item, OrderItem, Order, Payment, Coupon, Refund, Address, UserProfile
+from routers import shards
+from routers.context import routing
+
+from . import services
+from .forms import AddressAdminForm
+from .pagination import EstimatedCountPaginator
+from .models import Item, OrderItem, Order, Payment, Coupon, Refund, Address, UserProfile, Job
 
 
 def make_refund_accepted(modeladmin, request, queryset):
@@ -10,8 +18,110 @@ def make_refund_accepted(modeladmin, request, queryset):
 make_refund_accepted.short_description = 'Update orders to refund granted'
 
 
-class OrderAdmin(admin.ModelAdmin):
+def recompute_order_totals(modeladmin, request, queryset):
+    changed = services.recompute_totals(queryset)
+    modeladmin.message_user(request, f'Recomputed totals, {changed} orders had drifted')
+
+
+recompute_order_totals.short_description = 'Recompute totals from the order lines'
+
+
+class OrderTotalFilter(admin.SimpleListFilter):
+    title = 'total'
+    parameter_name = 'total'
+    ranges = {
+        'under-50': (None, 50),
+        '50-200': (50, 200),
+        'over-200': (200, None),
+    }
+
+    def lookups(self, request, model_admin):
+        return [
+            ('under-50', 'Under $50'),
+            ('50-200', '$50 to $200'),
+            ('over-200', '$200 and over'),
+        ]
+
+    def queryset(self, request, queryset):
+        if self.value() not in self.ranges:
+            return queryset
+        low, high = self.ranges[self.value()]
+        if low is not None:
+            queryset = queryset.filter(total__gte=low)
+        if high is not None:
+            queryset = queryset.filter(total__lt=high)
+        return queryset
+
+
+def admin_shard(request):
+    # ?shard= on the changelist, carried to the change, delete and history
+    # views in _changelist_filters by the admin's preserve_filters
+    shard = request.GET.get('shard')
+    if shard is None:
+        shard = QueryDict(request.GET.get('_changelist_filters', '')).get('shard')
+    return shard if shard in shards.order_shards() else shards.home_shard()
+
+
+class ShardFilter(admin.SimpleListFilter):
+    # the order shard the changelist shows, the first one by default
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in shards.order_shards()]
+
+    def queryset(self, request, queryset):
+        # ShardedAdmin.get_queryset() already reads from the shard
+        return queryset
+
+    def choices(self, changelist):
+        current = self.value() or shards.home_shard()
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': alias == current,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': title,
+            }
+
+
+class ShardedAdmin(admin.ModelAdmin):
+    # Order data is shown one shard at a time, picked with the shard filter,
+    # rather than from the shard of the staff user that the routing context
+    # would pick; saves and deletes stay on the shard the row came from
+    list_filter = [ShardFilter]
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).using(admin_shard(request))
+
+    def changelist_view(self, request, extra_context=None):
+        with routing(shard=admin_shard(request)):
+            return super().changelist_view(request, extra_context)
+
+    def changeform_view(self, request, *args, **kwargs):
+        # the transaction the admin opens follows the routing context
+        with routing(shard=admin_shard(request)):
+            return super().changeform_view(request, *args, **kwargs)
+
+    def delete_view(self, request, *args, **kwargs):
+        with routing(shard=admin_shard(request)):
+            return super().delete_view(request, *args, **kwargs)
+
+    def history_view(self, request, *args, **kwargs):
+        with routing(shard=admin_shard(request)):
+            return super().history_view(request, *args, **kwargs)
+
+
+class OrderChangeList(ChangeList):
+    # The shipping and billing addresses in list_display are loaded for the
+    # whole page with one query, like the users, payments and coupons
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = self.result_list.with_addresses()
+
+
+class OrderAdmin(ShardedAdmin):
     list_display = ['user',
+                    'total',
                     'ordered',
                     'being_delivered',
                     'received',
@@ -33,15 +143,38 @@ class OrderAdmin(admin.ModelAdmin):
                 'being_delivered',
                 'received',
                 'refund_requested',
-                'refund_granted']
+                'refund_granted',
+                OrderTotalFilter,
+                ShardFilter]
     search_fields = [
         'user__username',
         'ref_code'
     ]
-    actions = [make_refund_accepted]
+    actions = [make_refund_accepted, recompute_order_totals]
+    # users, payments and coupons can sit on other databases than the
+    # orders, so they are batch-loaded instead of joined
+    list_select_related = ()
+    # CORE_ORDER is large: no COUNT(*) of the unfiltered table next to a
+    # filtered one, and an estimated count for the unfiltered list
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_across('user', 'payment', 'coupon')
+
+    def get_changelist(self, request, **kwargs):
+        return OrderChangeList
+
+
+class OrderItemAdmin(ShardedAdmin):
+    list_select_related = ()
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_across('user', 'item')
 
 
 class AddressAdmin(admin.ModelAdmin):
+    form = AddressAdminForm
     list_display = [
         'user',
         'street_address',
@@ -55,14 +188,27 @@ class AddressAdmin(admin.ModelAdmin):
     search_fields = ['user', 'street_address', 'apartment_address', 'zip']
 
 
+class JobAdmin(admin.ModelAdmin):
+    list_display = [
+        'name',
+        'status',
+        'attempts',
+        'run_after',
+        'locked_by',
+        'created'
+    ]
+    list_filter = ['status', 'name']
+
+
 admin.site.register(Item)
-admin.site.register(OrderItem)
+admin.site.register(OrderItem, OrderItemAdmin)
 admin.site.register(Order, OrderAdmin)
-admin.site.register(Payment)
+admin.site.register(Payment, ShardedAdmin)
 admin.site.register(Coupon)
-admin.site.register(Refund)
+admin.site.register(Refund, ShardedAdmin)
 admin.site.register(Address, AddressAdmin)
 admin.site.register(UserProfile)
+admin.site.register(Job, JobAdmin)
 
 
 
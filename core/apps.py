@@ -4,3 +4,34 @@ from django.apps import AppConfig
 class CoreConfig(AppConfig):
     name = 'core'
 
+    def ready(self):
+        from django.contrib.auth.signals import user_logged_in
+        from django.core.signals import request_started
+        from django.db.backends.signals import connection_created
+        from django.db.models.signals import post_delete, post_save
+
+        from routers.replicas import watch_writes
+        from routers.shards import forget_moved_user
+
+        from . import querysets
+        from . import tasks  # noqa: F401 registers the background jobs
+        from .catalogue import record_item_change, refresh_catalogue, snapshot
+        from .models import Item, UserShard
+        from .page_cache import invalidate_deleted_item, invalidate_saved_item
+        from .pooling import record_connection_created
+        from .search import index_item, remove_item
+        from .services import merge_session_cart
+
+        connection_created.connect(record_connection_created, dispatch_uid='core.record_connection_created')
+        connection_created.connect(watch_writes, dispatch_uid='core.watch_writes')
+        user_logged_in.connect(merge_session_cart, dispatch_uid='core.merge_session_cart')
+        post_save.connect(index_item, sender=Item, dispatch_uid='core.index_item')
+        post_delete.connect(remove_item, sender=Item, dispatch_uid='core.remove_item')
+        post_save.connect(invalidate_saved_item, sender=Item, dispatch_uid='core.invalidate_saved_item')
+        post_delete.connect(invalidate_deleted_item, sender=Item, dispatch_uid='core.invalidate_deleted_item')
+        post_save.connect(record_item_change, sender=Item, dispatch_uid='core.record_saved_item_change')
+        post_delete.connect(record_item_change, sender=Item, dispatch_uid='core.record_deleted_item_change')
+        post_save.connect(forget_moved_user, sender=UserShard, dispatch_uid='core.forget_saved_user_shard')
+        post_delete.connect(forget_moved_user, sender=UserShard, dispatch_uid='core.forget_deleted_user_shard')
+        request_started.connect(refresh_catalogue, dispatch_uid='core.refresh_catalogue')
+        querysets.snapshots[Item] = snapshot.in_bulk
@@ -0,0 +1,36 @@
+import time
+
+from django.db.backends.oracle import base as oracle
+
+from core.pooling import get_session_pool, pool_metrics
+
+
+class DatabaseWrapper(oracle.DatabaseWrapper):
+    # Oracle backend whose connections are sessions checked out of a
+    # process-wide SessionPool, see core.pooling.configure_pools()
+
+    def create_session_pool(self):
+        return oracle.Database.SessionPool(
+            user=self.settings_dict['USER'],
+            password=self.settings_dict['PASSWORD'],
+            dsn=oracle.dsn(self.settings_dict),
+            threaded=True,
+            getmode=oracle.Database.SPOOL_ATTRVAL_TIMEDWAIT,
+            **self.settings_dict['POOL']
+        )
+
+    def get_new_connection(self, conn_params):
+        pool = get_session_pool(self.alias, self.create_session_pool)
+        if pool.busy >= pool.max:
+            pool_metrics.record(self.alias, 'waits')
+        started = time.monotonic()
+        connection = pool.acquire()
+        pool_metrics.record(self.alias, 'wait_time', time.monotonic() - started)
+        pool_metrics.record(self.alias, 'checkouts')
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                get_session_pool(self.alias, self.create_session_pool).release(self.connection)
+            pool_metrics.record(self.alias, 'releases')
@@ -0,0 +1,219 @@
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import Client
+from django.urls import resolve
+from django.utils import timezone
+
+from routers.shards import order_db
+
+from .models import CATEGORY_CHOICES, Item, Order, OrderItem, OrderItems, UserProfile
+from .money import money, price_snapshot
+from .search import get_backend
+from .testing import FakeStripe
+
+WORDS = ['cotton', 'linen', 'slim', 'classic', 'summer', 'winter', 'striped', 'denim', 'wool', 'light']
+PASSWORD = 'benchmark'
+
+
+def seed(items=200, users=20, orders=100, rng=None):
+    """
+    Fill the catalogue, users and paid order history. Everything goes
+    through bulk_create, so the search index is rebuilt at the end.
+    """
+    rng = rng or random.Random(0)
+    categories = [code for code, name in CATEGORY_CHOICES]
+    Item.objects.bulk_create([
+        Item(
+            title=f'{rng.choice(WORDS).title()} {rng.choice(WORDS)} {n}',
+            price=money(rng.uniform(5, 200)),
+            discount_price=money(rng.uniform(1, 5)) if n % 3 == 0 else None,
+            category=categories[n % len(categories)],
+            label='P',
+            slug=f'item-{n}',
+            description=' '.join(rng.choice(WORDS) for _ in range(12)),
+            image='item.jpg'
+        )
+        for n in range(items)
+    ])
+    get_backend().rebuild()
+
+    password = make_password(PASSWORD)
+    User.objects.bulk_create([
+        User(username=f'bench{n}', email=f'bench{n}@example.com', password=password)
+        for n in range(users)
+    ])
+    shoppers = list(User.objects.filter(username__startswith='bench'))
+    UserProfile.objects.bulk_create([UserProfile(user=user) for user in shoppers])
+
+    catalogue = Item.objects.in_bulk()
+    item_ids = list(catalogue)
+    for n in range(orders):
+        user = shoppers[n % len(shoppers)]
+        db = order_db(user, write=True)
+        lines = []
+        for item_id in rng.sample(item_ids, min(3, len(item_ids))):
+            unit_price, list_price = price_snapshot(catalogue[item_id])
+            lines.append(OrderItem(
+                user=user, item_id=item_id, ordered=True, quantity=rng.randint(1, 3),
+                unit_price=unit_price, list_price=list_price
+            ))
+        subtotal = sum(line.quantity * line.unit_price for line in lines)
+        order = Order.objects.using(db).create(
+            user=user, ordered=True, ordered_date=timezone.now(),
+            subtotal=subtotal, total=subtotal,
+            discount=sum(line.quantity * (line.list_price - line.unit_price) for line in lines)
+        )
+        if connections[db].features.can_return_rows_from_bulk_insert:
+            lines = OrderItem.objects.using(db).bulk_create(lines)
+        else:
+            for line in lines:
+                line.save(using=db)
+        OrderItems.objects.using(db).bulk_create([
+            OrderItems(order=order, orderitem=line) for line in lines
+        ])
+    return shoppers
+
+
+class Step:
+    def __init__(self, method, path, data=None, location=None):
+        self.method = method
+        self.path = path
+        self.data = data
+        # a redirect elsewhere means the view reported an error as a message
+        self.location = location
+
+    @property
+    def endpoint(self):
+        path, _, query = self.path.partition('?')
+        name = resolve(path).url_name
+        return f'{self.method} {name} (search)' if query else f'{self.method} {name}'
+
+
+def journey(rng, slugs):
+    # one shopper visit: browse, search, fill the cart, check out and pay
+    first, second = rng.sample(slugs, 2)
+    category = rng.choice(CATEGORY_CHOICES)[0]
+    return [
+        Step('GET', '/'),
+        Step('GET', f'/category/{category}/'),
+        Step('GET', f'/product/{first}/'),
+        Step('GET', f'/?q={rng.choice(WORDS)}'),
+        Step('GET', f'/add-to-cart/{first}/', location='/order-summary/'),
+        Step('GET', f'/add-to-cart/{second}/', location='/order-summary/'),
+        Step('GET', f'/add-to-cart/{second}/', location='/order-summary/'),
+        Step('GET', f'/remove-item-from-cart/{second}/', location='/order-summary/'),
+        Step('GET', '/order-summary/'),
+        Step('GET', '/checkout/'),
+        Step('POST', '/checkout/', {
+            'shipping_address': '1 Bench Street',
+            'shipping_country': 'US',
+            'shipping_zip': '10001',
+            'same_billing_address': 'on',
+            'payment_option': 'S',
+        }, location='/payment/stripe/'),
+        Step('GET', '/payment/stripe/'),
+        Step('POST', '/payment/stripe/', {'stripeToken': 'tok_visa'}, location='/'),
+    ]
+
+
+class Results:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def add(self, endpoint, elapsed, queries, ok):
+        with self.lock:
+            self.samples[endpoint].append((elapsed, queries, ok))
+
+
+def count_queries(response):
+    header = response.get('X-DB-Queries', '')
+    return sum(int(pair.split('=')[1]) for pair in header.split(', ') if pair)
+
+
+def run_shopper(user, iterations, slugs, results, seed_value):
+    rng = random.Random(seed_value)
+    client = Client(raise_request_exception=False)
+    client.force_login(user)
+    try:
+        for _ in range(iterations):
+            for step in journey(rng, slugs):
+                started = time.perf_counter()
+                if step.method == 'POST':
+                    response = client.post(step.path, step.data)
+                else:
+                    response = client.get(step.path)
+                elapsed = time.perf_counter() - started
+                ok = response.status_code < 400 and (
+                    step.location is None or response.get('Location') == step.location)
+                results.add(step.endpoint, elapsed, count_queries(response), ok)
+    finally:
+        connections.close_all()
+
+
+def run(users, iterations=5, concurrency=4, rng_seed=0):
+    """
+    Drive every shopper's journeys from a thread pool and return
+    (results, wall time in seconds).
+    """
+    slugs = list(Item.objects.values_list('slug', flat=True))
+    results = Results()
+    started = time.perf_counter()
+    with FakeStripe(), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(run_shopper, user, iterations, slugs, results, rng_seed + n)
+            for n, user in enumerate(users)
+        ]
+        for future in futures:
+            future.result()
+    return results, time.perf_counter() - started
+
+
+def percentile(values, pct):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)]
+
+
+def summarise(results, wall):
+    report = {}
+    for endpoint, samples in sorted(results.samples.items()):
+        timings = [elapsed * 1000 for elapsed, queries, ok in samples]
+        report[endpoint] = {
+            'requests': len(samples),
+            'errors': sum(1 for elapsed, queries, ok in samples if not ok),
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p95_ms': round(percentile(timings, 95), 2),
+            'p99_ms': round(percentile(timings, 99), 2),
+            'throughput': round(len(samples) / wall, 2),
+            'queries': round(sum(queries for elapsed, queries, ok in samples) / len(samples), 2),
+        }
+    return report
+
+
+def compare(report, baseline, tolerance=0.2):
+    # Latency may drift by ``tolerance``; any extra query per request or a
+    # new error is a regression
+    regressions = []
+    for endpoint, current in report.items():
+        previous = baseline.get(endpoint)
+        if previous is None:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f"{endpoint}: p95 {current['p95_ms']}ms > {previous['p95_ms']}ms")
+        if current['queries'] > previous['queries']:
+            regressions.append(
+                f"{endpoint}: {current['queries']} queries > {previous['queries']}")
+        if current['errors'] > previous['errors']:
+            regressions.append(
+                f"{endpoint}: {current['errors']} errors > {previous['errors']}")
+    return regressions
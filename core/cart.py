@@ -0,0 +1,172 @@
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Count
+
+from .catalogue import snapshot
+from .money import ZERO, money
+from .querysets import prefetch_across
+
+CART_CACHE_TIMEOUT = getattr(settings, 'CART_CACHE_TIMEOUT', 60 * 15)
+CART_SESSION_KEY = getattr(settings, 'CART_SESSION_KEY', 'cart')
+
+
+def has_item(order_item):
+    # False for a line whose item has been deleted from the catalogue;
+    # prefetch_across() caches None for it, which the descriptor of a
+    # non-null foreign key raises on
+    try:
+        return order_item.item is not None
+    except ObjectDoesNotExist:
+        return False
+
+
+class CartSummary:
+    def __init__(self, order_items, coupon=None):
+        # lines whose item has been deleted from the catalogue are skipped
+        self.items = [oi for oi in order_items if has_item(oi)]
+        self.coupon = coupon
+
+        subtotal = savings = ZERO
+        quantity = 0
+        for order_item in self.items:
+            subtotal += order_item.get_final_price()
+            if order_item.has_discount():
+                savings += order_item.get_amount_saved()
+            quantity += order_item.quantity
+
+        self.count = len(self.items)
+        self.quantity = quantity
+        self.subtotal = subtotal
+        self.savings = savings
+        self.coupon_amount = money(coupon.amount) if coupon else ZERO
+        self.total = subtotal - self.coupon_amount
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'quantity': self.quantity,
+            'subtotal': self.subtotal,
+            'savings': self.savings,
+            'coupon': self.coupon_amount,
+            'total': self.total,
+            'items': [
+                {
+                    'slug': order_item.item.slug,
+                    'quantity': order_item.quantity,
+                    'price': order_item.get_final_price(),
+                }
+                for order_item in self.items
+            ],
+        }
+
+    @classmethod
+    def for_order(cls, order):
+        # a no-op when the order came from prefetch_across('items__item')
+        prefetch_across([order], 'items__item')
+        return cls(order.items.all(), coupon=order.coupon)
+
+
+def cart_version_key(user_id):
+    return f'cart-version:{user_id}'
+
+
+def cart_version(user_id):
+    # Bumped by every cart write, and part of the cached summary's key, so
+    # a write never has to reach the entries other workers filled. A lost
+    # version restarts from the clock rather than from 1, so it cannot
+    # bring an old entry back.
+    key = cart_version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def cart_cache_key(user_id, version):
+    return f'cart:{user_id}:{version}'
+
+
+def get_cached_cart(user_id):
+    # {'count': ..., 'subtotal': ...} for the user's open order; pages only
+    # hit the order database again after invalidate_cart() bumps the version
+    key = cart_cache_key(user_id, cart_version(user_id))
+    cached = cache.get(key)
+    if cached is None:
+        # the line count and the stored subtotal come from one query, without
+        # loading the lines or their items
+        Order = apps.get_model('core', 'Order')
+        order = Order.objects.for_user(user_id).filter(user_id=user_id, ordered=False).annotate(
+            lines=Count('items')).values('lines', 'subtotal').first()
+        if order is None:
+            cached = {'count': 0, 'subtotal': ZERO}
+        else:
+            cached = {'count': order['lines'], 'subtotal': order['subtotal']}
+        # add, not set: a reader that loaded the cart before a write can
+        # only fill the key of the version it read
+        cache.add(key, cached, CART_CACHE_TIMEOUT)
+    return cached
+
+
+def invalidate_cart(user_id):
+    # called once the write is committed
+    try:
+        cache.incr(cart_version_key(user_id))
+    except ValueError:
+        cache.add(cart_version_key(user_id), time.time_ns(), None)
+
+
+class SessionCart:
+    # Cart of an anonymous visitor, kept as {item id: quantity} in the
+    # session; it only becomes Order rows when the visitor logs in
+    def __init__(self, session):
+        self.session = session
+
+    @property
+    def lines(self):
+        return self.session.get(CART_SESSION_KEY, {})
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, item_id):
+        return str(item_id) in self.lines
+
+    def add(self, item_id, quantity=1):
+        lines = dict(self.lines)
+        lines[str(item_id)] = lines.get(str(item_id), 0) + quantity
+        self.session[CART_SESSION_KEY] = lines
+
+    def remove(self, item_id, quantity=None):
+        lines = dict(self.lines)
+        left = 0 if quantity is None else lines.get(str(item_id), 0) - quantity
+        if left > 0:
+            lines[str(item_id)] = left
+        else:
+            lines.pop(str(item_id), None)
+        self.session[CART_SESSION_KEY] = lines
+
+    def update(self, item_id, quantity):
+        lines = dict(self.lines)
+        if quantity > 0:
+            lines[str(item_id)] = quantity
+        else:
+            lines.pop(str(item_id), None)
+        self.session[CART_SESSION_KEY] = lines
+
+    def clear(self):
+        self.session.pop(CART_SESSION_KEY, None)
+
+    def summary(self):
+        # unsaved OrderItems so the cart templates render guest carts as is
+        OrderItem = apps.get_model('core', 'OrderItem')
+        items = snapshot.in_bulk([int(item_id) for item_id in self.lines])
+        return CartSummary([
+            OrderItem(item=items[int(item_id)], quantity=quantity)
+            for item_id, quantity in self.lines.items()
+            if int(item_id) in items
+        ])
@@ -0,0 +1,263 @@
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.apps import apps
+from django.conf import settings
+from django.db import DatabaseError, connections, router
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# the Item columns kept in the snapshot, in the model's field order, which
+# Item.from_db() relies on
+FIELDS = ('id', 'title', 'price', 'discount_price', 'category', 'label', 'slug', 'description', 'image')
+
+
+def refresh_seconds():
+    return getattr(settings, 'CATALOGUE_REFRESH_SECONDS', 5)
+
+
+def reload_seconds():
+    return getattr(settings, 'CATALOGUE_RELOAD_SECONDS', 600)
+
+
+def overlap_seconds():
+    return getattr(settings, 'CATALOGUE_CHANGE_OVERLAP_SECONDS', 60)
+
+
+def max_bytes():
+    return getattr(settings, 'CATALOGUE_SNAPSHOT_MAX_BYTES', 16 * 1024 * 1024)
+
+
+class CatalogueEntry:
+    # one Item row, without the model instance and its _state
+    __slots__ = FIELDS
+
+    def __init__(self, values):
+        for name, value in zip(FIELDS, values):
+            setattr(self, name, value)
+
+    def size(self):
+        return sys.getsizeof(self) + sum(sys.getsizeof(getattr(self, name)) for name in FIELDS)
+
+
+class CatalogueSnapshot:
+    """
+    Every Item in this process, by id and by slug. It is loaded on the first
+    request (or by warm_catalogue() when the worker starts) and then, at most
+    every CATALOGUE_REFRESH_SECONDS, only the items in ItemChange rows it has
+    not seen are read again. A change is stamped before its transaction
+    commits, so each refresh rescans the log from CATALOGUE_CHANGE_OVERLAP_SECONDS
+    before the newest change it has seen. A full reload every
+    CATALOGUE_RELOAD_SECONDS picks up bulk updates that bypass the log.
+    A catalogue over CATALOGUE_SNAPSHOT_MAX_BYTES is not kept and reads go
+    to the item database as before.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.stats_lock = threading.Lock()
+        self.reset()
+
+    def count(self, name, number=1):
+        with self.stats_lock:
+            self.stats[name] += number
+
+    def reset(self):
+        self.by_id = {}
+        self.by_slug = {}
+        self.db = None
+        self.bytes = 0
+        # the newest ItemChange timestamp read, and the ids of the rows read
+        # in the overlap window before it
+        self.since = None
+        self.seen = set()
+        self.loaded = self.checked = 0.0
+        self.over_budget = False
+
+    def mark_stale(self):
+        # this process changed an item; the next read catches up
+        self.checked = 0.0
+
+    def refresh(self):
+        now = time.monotonic()
+        if self.over_budget or now - self.checked < refresh_seconds():
+            return
+        with self.lock:
+            if now - self.checked < refresh_seconds():
+                return
+            Item = apps.get_model('core', 'Item')
+            # the log and the rows come from the same alias, so a lagging
+            # replica can only make changes be applied twice
+            db = router.db_for_read(Item)
+            if not self.loaded or now - self.loaded >= reload_seconds():
+                self.load(db)
+            else:
+                self.apply_changes(db)
+            self.checked = now
+
+    def load(self, db):
+        Item = apps.get_model('core', 'Item')
+        # changes read before the items are already in them; ones committed
+        # later are picked up by the next refresh
+        self.since = None
+        changes = self.recent_changes(db)
+        by_id = {}
+        size = 0
+        for values in Item.objects.using(db).order_by('id').values_list(*FIELDS).iterator():
+            entry = CatalogueEntry(values)
+            size += entry.size()
+            if size > max_bytes():
+                return self.drop()
+            by_id[entry.id] = entry
+        by_slug = {}
+        for entry in by_id.values():
+            by_slug.setdefault(entry.slug, entry.id)
+        self.by_id, self.by_slug, self.bytes = by_id, by_slug, size
+        self.db, self.loaded = db, time.monotonic()
+        self.remember_changes(changes)
+        self.count('loads')
+
+    def recent_changes(self, db):
+        # [(id, item_id, changed)] in the log from the overlap window on
+        ItemChange = apps.get_model('core', 'ItemChange')
+        changes = ItemChange.objects.using(db)
+        if self.since is not None:
+            changes = changes.filter(changed__gte=self.since - timedelta(seconds=overlap_seconds()))
+        return list(changes.values_list('id', 'item_id', 'changed'))
+
+    def remember_changes(self, changes):
+        if changes:
+            self.since = max(changed for _, _, changed in changes)
+        self.seen = {change_id for change_id, _, _ in changes}
+
+    def apply_changes(self, db):
+        Item = apps.get_model('core', 'Item')
+        changes = self.recent_changes(db)
+        self.count('refreshes')
+        changed = {item_id for change_id, item_id, _ in changes if change_id not in self.seen}
+        if not changed:
+            self.remember_changes(changes)
+            return
+        fresh = {
+            values[0]: CatalogueEntry(values)
+            for values in Item.objects.using(db).filter(id__in=changed).values_list(*FIELDS)
+        }
+        by_id = dict(self.by_id)
+        size = self.bytes
+        for item_id in changed:
+            old = by_id.pop(item_id, None)
+            if old is not None:
+                size -= old.size()
+            if item_id in fresh:
+                by_id[item_id] = fresh[item_id]
+                size += fresh[item_id].size()
+        if size > max_bytes():
+            return self.drop()
+        by_slug = {}
+        for entry in sorted(by_id.values(), key=lambda entry: entry.id):
+            by_slug.setdefault(entry.slug, entry.id)
+        self.by_id, self.by_slug, self.bytes = by_id, by_slug, size
+        self.db = db
+        self.remember_changes(changes)
+        self.count('changes', len(changed))
+
+    def drop(self):
+        self.reset()
+        self.over_budget = True
+        self.count('over_budget')
+        logger.warning('The catalogue is over CATALOGUE_SNAPSHOT_MAX_BYTES, reading items from the database')
+
+    def as_item(self, entry):
+        Item = apps.get_model('core', 'Item')
+        return Item.from_db(self.db, FIELDS, [getattr(entry, name) for name in FIELDS])
+
+    def in_bulk(self, ids):
+        # {id: Item} like Item.objects.in_bulk(); ids it does not hold yet
+        # (an item added by another process since the last refresh) are
+        # read from the database
+        Item = apps.get_model('core', 'Item')
+        self.refresh()
+        found = {}
+        missing = []
+        for item_id in ids:
+            entry = self.by_id.get(item_id)
+            if entry is None:
+                missing.append(item_id)
+            else:
+                found[item_id] = self.as_item(entry)
+        self.count('hits', len(found))
+        if missing:
+            self.count('misses', len(missing))
+            found.update(Item.objects.in_bulk(missing))
+        return found
+
+    def get(self, item_id):
+        return self.in_bulk([item_id]).get(item_id)
+
+    def slug_ids(self, slugs):
+        # {slug: id} for the slugs that exist
+        Item = apps.get_model('core', 'Item')
+        self.refresh()
+        found = {slug: self.by_slug[slug] for slug in slugs if slug in self.by_slug}
+        self.count('hits', len(found))
+        missing = [slug for slug in slugs if slug not in found]
+        if missing:
+            self.count('misses', len(missing))
+            for slug, item_id in Item.objects.filter(slug__in=missing).order_by('id').values_list('slug', 'id'):
+                found.setdefault(slug, item_id)
+        return found
+
+    def get_by_slug(self, slug):
+        item_id = self.slug_ids([slug]).get(slug)
+        return None if item_id is None else self.get(item_id)
+
+    def metrics(self):
+        # hits, misses, loads, refreshes, changes and over_budget counts for
+        # this process, and the size of the snapshot
+        with self.stats_lock:
+            stats = dict(self.stats)
+        return {
+            **stats,
+            'items': len(self.by_id),
+            'bytes': self.bytes,
+            'since': self.since,
+            'over_budget': self.over_budget,
+        }
+
+
+snapshot = CatalogueSnapshot()
+
+
+def refresh_catalogue(sender, **kwargs):
+    # request_started receiver, so that loading and refreshing happen before
+    # the view runs rather than in the middle of it
+    snapshot.refresh()
+
+
+def warm_catalogue():
+    # called once per worker from the WSGI and ASGI modules, so that the
+    # first request does not pay for the load; the connections are closed
+    # again in case the module was imported before the workers were forked
+    try:
+        snapshot.refresh()
+    except DatabaseError:
+        logger.exception('Could not load the catalogue, it will be loaded on the first request')
+    finally:
+        connections.close_all()
+
+
+def record_item_change(sender, instance, **kwargs):
+    # post_save and post_delete receiver for Item. A snapshot loaded longer
+    # ago than CATALOGUE_RELOAD_SECONDS reloads in full, so older rows are
+    # never read again and are pruned here, where the log grows
+    ItemChange = apps.get_model('core', 'ItemChange')
+    changes = ItemChange.objects.using(router.db_for_write(ItemChange, instance=instance))
+    changes.create(item_id=instance.pk)
+    changes.filter(changed__lt=timezone.now() - timedelta(seconds=reload_seconds() + overlap_seconds())).delete()
+    snapshot.mark_stale()
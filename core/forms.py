@@ -2,6 +2,8 @@ from django import forms
 from django_countries.fields import CountryField
 from django_countries.widgets import CountrySelectWidget
 
+from .models import Address, address_hash
+
 
 PAYMENT_CHOICES = (
     ('S', 'Stripe'),
@@ -66,3 +68,29 @@ class PaymentForm(forms.Form):
     stripeToken = forms.CharField(required=False)
     save = forms.BooleanField(required=False)
     use_default = forms.BooleanField(required=False)
+
+
+class AddressAdminForm(forms.ModelForm):
+    class Meta:
+        model = Address
+        fields = '__all__'
+
+    def clean(self):
+        # content_hash is not a form field, so the unique constraint on it
+        # is not validated by the form and would fail as an IntegrityError
+        cleaned_data = super().clean()
+        content_hash = address_hash(
+            cleaned_data.get('street_address'),
+            cleaned_data.get('apartment_address'),
+            cleaned_data.get('country'),
+            cleaned_data.get('zip'),
+        )
+        duplicates = Address.objects.filter(
+            user=cleaned_data.get('user'),
+            address_type=cleaned_data.get('address_type'),
+            content_hash=content_hash,
+        ).exclude(pk=self.instance.pk)
+        if duplicates.exists():
+            raise forms.ValidationError(
+                'This user already has the same address of this type.')
+        return cleaned_data
@@ -0,0 +1,108 @@
+import re
+
+from django.db import connections
+
+from routers import shards
+
+from .models import Coupon, Order, OrderItem, OrderItems, Payment
+from .services import open_order_lines
+
+# The order tables are not managed by Django, so the indexes declared in
+# their Meta.indexes are only ever created by the advise_indexes command
+INDEXED_MODELS = [Order, OrderItem, OrderItems, Payment, Coupon]
+
+# A plan line that reads a whole table, per backend
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN \w+\s*$|AUTOMATIC', re.MULTILINE),
+    'oracle': re.compile(r'TABLE ACCESS (STORAGE )?FULL'),
+    'postgresql': re.compile(r'Seq Scan on'),
+    'mysql': re.compile(r'\bALL\b'),
+}
+
+
+def models_on(db):
+    # coupons are only kept on the first order shard
+    return [model for model in INDEXED_MODELS if model is not Coupon or db == shards.home_shard()]
+
+
+def hot_queries(db):
+    # (name, queryset) for the lookups the views and services run on the
+    # order tables, with placeholder values
+    queries = [
+        ('open order', Order.objects.using(db).filter(user_id=0, ordered=False)),
+        ('open order lines', open_order_lines(db, 0)),
+        ('order line link', OrderItems.objects.using(db).filter(order_id=0, orderitem_id=0)),
+        ('order by reference', Order.objects.using(db).filter(ref_code='')),
+        ('payment by charge', Payment.objects.using(db).filter(stripe_charge_id='')),
+    ]
+    if Coupon in models_on(db):
+        queries.append(('coupon by code', Coupon.objects.using(db).filter(code='')))
+    return queries
+
+
+def explain(queryset):
+    connection = connections[queryset.db]
+    if connection.vendor != 'oracle':
+        return queryset.explain()
+    # Django has no EXPLAIN for Oracle; the plan goes through PLAN_TABLE
+    sql, params = queryset.query.get_compiler(using=queryset.db).as_sql()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN PLAN FOR ' + sql, params)
+        cursor.execute('SELECT PLAN_TABLE_OUTPUT FROM TABLE(DBMS_XPLAN.DISPLAY())')
+        return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def full_scans(db, plan):
+    pattern = FULL_SCAN_PATTERNS.get(connections[db].vendor)
+    if pattern is None:
+        return []
+    return [line.strip() for line in plan.splitlines() if pattern.search(line)]
+
+
+def existing_indexes(db, model):
+    # the column lists of the table's indexes, lower case
+    connection = connections[db]
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+    return [
+        [column.lower() for column in constraint['columns']]
+        for constraint in constraints.values()
+        if constraint['index'] or constraint['unique'] or constraint['primary_key']
+    ]
+
+
+def missing_indexes(db):
+    # [(model, index)] declared in Meta.indexes with no index on the table
+    # starting with the same columns, whatever its name
+    missing = []
+    for model in models_on(db):
+        existing = existing_indexes(db, model)
+        for index in model._meta.indexes:
+            columns = [model._meta.get_field(name).column.lower() for name in index.fields]
+            if not any(found[:len(columns)] == columns for found in existing):
+                missing.append((model, index))
+    return missing
+
+
+def index_sql(db, model, index):
+    with connections[db].schema_editor(collect_sql=True) as schema_editor:
+        return str(index.create_sql(model, schema_editor))
+
+
+def create_index(db, model, index):
+    with connections[db].schema_editor() as schema_editor:
+        schema_editor.add_index(model, index)
+
+
+def advise(db):
+    """
+    EXPLAIN the hot order queries on ``db`` and list the declared indexes
+    the tables lack: {'plans': [(name, plan, full scan lines)],
+    'missing': [(model, index, DDL)]}.
+    """
+    plans = []
+    for name, queryset in hot_queries(db):
+        plan = explain(queryset)
+        plans.append((name, plan, full_scans(db, plan)))
+    missing = [(model, index, index_sql(db, model, index)) for model, index in missing_indexes(db)]
+    return {'plans': plans, 'missing': missing}
@@ -0,0 +1,118 @@
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import router
+from django.db.models import F, Q
+from django.utils import timezone
+
+from routers import shards
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+JOB_LEASE_SECONDS = getattr(settings, 'JOB_LEASE_SECONDS', 300)
+JOB_RETRY_DELAY = getattr(settings, 'JOB_RETRY_DELAY', 30)
+
+_registry = {}
+
+
+def job(name):
+    # @job('send_order_confirmation') registers a function as a job; it is
+    # called with the payload as keyword arguments and must be safe to run
+    # more than once, since a job whose worker died is run again
+    def decorator(func):
+        _registry[name] = func
+        return func
+    return decorator
+
+
+def enqueue(name, delay=0, max_attempts=5, using=None, **payload):
+    # ``using`` puts the job on the order shard whose transaction is open,
+    # so it is committed or rolled back together with the order
+    if name not in _registry:
+        raise KeyError(f'Unknown job {name!r}')
+    return Job.objects.using(using or router.db_for_write(Job)).create(
+        name=name,
+        payload=payload,
+        max_attempts=max_attempts,
+        run_after=timezone.now() + timedelta(seconds=delay)
+    )
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}'
+
+
+def claimable(now):
+    # queued and due, or running on a worker whose lease has run out
+    return (
+        Q(status='queued', run_after__lte=now)
+        | Q(status='running', locked_until__lt=now)
+    )
+
+
+def claim(worker, limit=10, db=None):
+    """
+    Take up to ``limit`` due jobs for ``worker``. Every job is claimed with a
+    conditional UPDATE, so two workers never take the same job and no row
+    lock (or FOR UPDATE with a LIMIT, which Oracle rejects) is needed.
+    """
+    db = db or router.db_for_write(Job)
+    now = timezone.now()
+    candidates = list(Job.objects.using(db).filter(claimable(now)).order_by(
+        'run_after', 'id').values_list('id', flat=True)[:limit])
+    claimed = []
+    for job_id in candidates:
+        taken = Job.objects.using(db).filter(claimable(now), pk=job_id).update(
+            status='running',
+            locked_by=worker,
+            locked_until=now + timedelta(seconds=JOB_LEASE_SECONDS),
+            attempts=F('attempts') + 1
+        )
+        if taken:
+            claimed.append(job_id)
+    return list(Job.objects.using(db).filter(pk__in=claimed).order_by('run_after', 'id'))
+
+
+def run(job, worker):
+    db = job._state.db
+    mine = Job.objects.using(db).filter(pk=job.pk, locked_by=worker)
+    try:
+        _registry[job.name](**job.payload)
+    except Exception:
+        error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            logger.error(f"Job {job} failed for good: {error}")
+            mine.update(status='failed', last_error=error, locked_until=None)
+        else:
+            # back off 30s, 60s, 120s, ... between attempts
+            delay = JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            logger.warning(f"Job {job} failed, retrying in {delay}s: {error}")
+            mine.update(
+                status='queued',
+                last_error=error,
+                locked_until=None,
+                run_after=timezone.now() + timedelta(seconds=delay)
+            )
+        return False
+    mine.update(status='done', locked_until=None)
+    return True
+
+
+def run_pending(worker=None, limit=10):
+    # Runs one batch of due jobs from every order shard and returns how many
+    # were taken
+    worker = worker or worker_name()
+    taken = 0
+    for db in shards.order_shards():
+        jobs = claim(worker, limit, db)
+        for job in jobs:
+            run(job, worker)
+        taken += len(jobs)
+    return taken
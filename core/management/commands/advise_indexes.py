@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.indexes import advise, create_index
+from routers.shards import order_shards
+
+
+class Command(BaseCommand):
+    help = ('EXPLAINs the hot queries on the unmanaged order tables of every order '
+            'shard, reports full scans and prints the DDL for missing indexes')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append', metavar='ALIAS',
+                            help='Order shard to inspect; every one of ORDER_SHARDS by default')
+        parser.add_argument('--apply', action='store_true',
+                            help='Create the missing indexes')
+
+    def handle(self, *args, **options):
+        aliases = options['database'] or order_shards()
+        unknown = set(aliases) - set(order_shards())
+        if unknown:
+            raise CommandError('Not order shards: %s' % ', '.join(sorted(unknown)))
+
+        for db in aliases:
+            # the report is SQL comments, so the output can be run as a script
+            report = advise(db)
+            self.stdout.write(self.style.MIGRATE_HEADING('-- %s' % db))
+            for name, plan, scans in report['plans']:
+                if scans:
+                    self.stdout.write('--   %s: full scan (%s)' % (name, '; '.join(scans)))
+                else:
+                    self.stdout.write('--   %s: ok' % name)
+                if options['verbosity'] > 1:
+                    for line in plan.splitlines():
+                        self.stdout.write('--     ' + line)
+
+            for model, index, sql in report['missing']:
+                if options['apply']:
+                    create_index(db, model, index)
+                    self.stdout.write(self.style.SUCCESS('--   created %s' % index.name))
+                else:
+                    self.stdout.write('%s;' % sql)
+            if not report['missing']:
+                self.stdout.write('--   no missing indexes')
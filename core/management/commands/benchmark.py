@@ -0,0 +1,91 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import (
+    override_settings, setup_databases, setup_test_environment,
+    teardown_databases, teardown_test_environment
+)
+
+from core import benchmark
+from core.testing import create_unmanaged_tables
+
+
+class Command(BaseCommand):
+    help = ('Seeds throwaway SQLite databases and load-tests the shop flow; '
+            'run with --settings=djecommerce.settings.test')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=200)
+        parser.add_argument('--users', type=int, default=8,
+                            help='Shoppers, each walking through the journey')
+        parser.add_argument('--orders', type=int, default=100,
+                            help='Paid orders seeded as history')
+        parser.add_argument('--iterations', type=int, default=5,
+                            help='Journeys per shopper')
+        parser.add_argument('--concurrency', type=int, default=4)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--save-baseline', metavar='PATH')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='Fail if slower or chattier than this baseline')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed p95 latency increase over the baseline')
+
+    def handle(self, *args, **options):
+        not_sqlite = [
+            alias for alias in settings.DATABASES
+            if connections[alias].vendor != 'sqlite'
+        ]
+        if not_sqlite:
+            raise CommandError(
+                'The benchmark needs SQLite stand-ins, not %s; '
+                'use --settings=djecommerce.settings.test' % ', '.join(not_sqlite))
+
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            create_unmanaged_tables()
+            users = benchmark.seed(options['items'], options['users'], options['orders'])
+            with override_settings(QUERY_STATS_HEADERS=True, QUERY_BUDGET_STRICT=False):
+                results, wall = benchmark.run(
+                    users, options['iterations'], options['concurrency'], options['seed'])
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        report = benchmark.summarise(results, wall)
+        self.write_report(report, wall)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump({'options': self.run_options(options), 'endpoints': report}, f, indent=2)
+            self.stdout.write('Baseline saved to %s' % options['save_baseline'])
+
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+            if baseline['options'] != self.run_options(options):
+                self.stderr.write('Baseline was recorded with different options: %s'
+                                  % baseline['options'])
+            regressions = benchmark.compare(report, baseline['endpoints'], options['tolerance'])
+            if regressions:
+                raise CommandError('Regressions against %s:\n  %s' % (
+                    options['compare'], '\n  '.join(regressions)))
+            self.stdout.write(self.style.SUCCESS('No regressions against %s' % options['compare']))
+
+    def run_options(self, options):
+        keys = ('items', 'users', 'orders', 'iterations', 'concurrency', 'seed')
+        return {key: options[key] for key in keys}
+
+    def write_report(self, report, wall):
+        header = '%-40s %8s %6s %9s %9s %9s %9s %8s' % (
+            'endpoint', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'queries')
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for endpoint, row in report.items():
+            self.stdout.write('%-40s %8d %6d %9.2f %9.2f %9.2f %9.2f %8.2f' % (
+                endpoint, row['requests'], row['errors'], row['p50_ms'], row['p95_ms'],
+                row['p99_ms'], row['throughput'], row['queries']))
+        total = sum(row['requests'] for row in report.values())
+        self.stdout.write('%d requests in %.2fs, %.2f req/s' % (total, wall, total / wall))
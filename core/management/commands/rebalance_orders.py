@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import UserShard
+from core.rebalance import ShardMoveError, move_user, pin_users
+from routers.shards import hashed_shard
+
+
+class Command(BaseCommand):
+    help = ('Moves users\' order data between the ORDER_SHARDS. To add a shard: '
+            'run --pin-all, add the shard to ORDER_SHARDS, then run --all')
+
+    def add_arguments(self, parser):
+        parser.add_argument('users', nargs='*', type=int, metavar='USER_ID')
+        parser.add_argument('--to', metavar='SHARD',
+                            help='Shard to move the users to; by default the one their id hashes to')
+        parser.add_argument('--all', action='store_true',
+                            help='Move every pinned user to the shard their id hashes to')
+        parser.add_argument('--pin-all', action='store_true',
+                            help='Pin every user with orders to the shard they are on now')
+
+    def handle(self, *args, **options):
+        if options['pin_all']:
+            pinned = pin_users()
+            self.stdout.write(self.style.SUCCESS('Pinned %d users' % pinned))
+            return
+
+        user_ids = options['users']
+        if options['all']:
+            user_ids = list(UserShard.objects.values_list('user_id', flat=True))
+        if not user_ids:
+            raise CommandError('Give user ids, --all or --pin-all')
+
+        failed = 0
+        for user_id in user_ids:
+            target = options['to'] or hashed_shard(user_id)
+            try:
+                moved = move_user(user_id, target)
+            except ShardMoveError as e:
+                failed += 1
+                self.stderr.write('User %d: %s' % (user_id, e))
+                continue
+            self.stdout.write('User %d: %d orders now on %s' % (user_id, moved, target))
+        if failed:
+            raise CommandError('%d users were not moved' % failed)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.search import get_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the product search index from the Item table'
+
+    def handle(self, *args, **kwargs):
+        backend = get_backend()
+        if backend.rebuild():
+            self.stdout.write(self.style.SUCCESS(
+                'Search index rebuilt with %s' % type(backend).__name__))
+        else:
+            self.stdout.write('%s has no search index, nothing to rebuild' % backend.alias)
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from core.jobs import run_pending, worker_name
+
+
+class Command(BaseCommand):
+    help = 'Runs queued background jobs (order finalisation, emails, refunds)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit once no job is due instead of polling')
+        parser.add_argument('--batch', type=int, default=10)
+        parser.add_argument('--sleep', type=float, default=2.0,
+                            help='Seconds to wait when no job is due')
+
+    def handle(self, *args, **options):
+        worker = worker_name()
+        self.stdout.write('Worker %s started' % worker)
+        total = 0
+        while True:
+            close_old_connections()
+            ran = run_pending(worker, options['batch'])
+            total += ran
+            if ran:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS('Ran %d jobs' % total))
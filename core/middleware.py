@@ -0,0 +1,217 @@
+import logging
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from routers import replicas, shards
+from routers.context import routing
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+HTTP_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+
+def query_budget(**budgets):
+    # @query_budget(default=2, item_db=1, other_db=3) on a function view;
+    # class-based views set a query_budget attribute instead. Either may be
+    # keyed by method, {'GET': {'default': 2}}, to leave other methods unchecked
+    def decorator(view):
+        view.query_budget = budgets
+        return view
+    return decorator
+
+
+def get_query_budget(view, method):
+    budget = getattr(view, 'query_budget', None)
+    if budget is None:
+        budget = getattr(getattr(view, 'view_class', None), 'query_budget', None)
+    if budget and HTTP_METHODS & set(budget):
+        return budget.get(method)
+    return budget
+
+
+class AliasQueryStats:
+    # connection.execute_wrapper() hook counting one alias' statements
+    def __init__(self, alias):
+        self.alias = alias
+        self.count = 0
+        self.duration = 0.0
+        self.slowest = 0.0
+        self.slowest_sql = ''
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.duration += elapsed
+            if elapsed >= self.slowest:
+                self.slowest = elapsed
+                self.slowest_sql = sql
+
+    def as_dict(self):
+        return {
+            'queries': self.count,
+            'time_ms': round(self.duration * 1000, 2),
+            'slowest_ms': round(self.slowest * 1000, 2),
+            'slowest_sql': self.slowest_sql[:200],
+        }
+
+
+class QueryBudgetMiddleware:
+    # Counts queries, total time and the slowest statement per database alias
+    # for every request, logs them, optionally adds X-DB-* response headers
+    # and checks them against the view's declared query budget
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, wrappers = self.wrap_connections()
+        with wrappers:
+            response = self.get_response(request)
+        return self.process_stats(request, response, stats)
+
+    async def __acall__(self, request):
+        # connections are thread-local, so the wrappers are installed on the
+        # thread that runs the request's sync_to_async database calls
+        stats, wrappers = await sync_to_async(self.wrap_connections)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(wrappers.close)()
+        return self.process_stats(request, response, stats)
+
+    def wrap_connections(self):
+        stats = {alias: AliasQueryStats(alias) for alias in settings.DATABASES}
+        wrappers = ExitStack()
+        for alias, alias_stats in stats.items():
+            wrappers.enter_context(connections[alias].execute_wrapper(alias_stats))
+        return stats, wrappers
+
+    def process_stats(self, request, response, stats):
+        view_name = request.resolver_match.view_name if request.resolver_match else None
+        # the counts are in the message itself, since the configured log
+        # formats only print %(message)s; extra= carries the full stats
+        summary = ', '.join(
+            f'{alias}={alias_stats.count} ({alias_stats.duration * 1000:.2f} ms)'
+            for alias, alias_stats in stats.items()
+            if alias_stats.count
+        ) or 'none'
+        extra = {
+            'view': view_name,
+            'db': {alias: alias_stats.as_dict() for alias, alias_stats in stats.items()},
+        }
+        if getattr(settings, 'QUERY_STATS_HEADERS', False):
+            response['X-DB-Queries'] = ', '.join(
+                f'{alias}={alias_stats.count}' for alias, alias_stats in stats.items())
+            response['X-DB-Time-Ms'] = ', '.join(
+                f'{alias}={alias_stats.duration * 1000:.2f}' for alias, alias_stats in stats.items())
+
+        over = {}
+        budget = get_query_budget(request.resolver_match.func, request.method) if request.resolver_match else None
+        if budget:
+            # replicas and order shards count against the budget of the
+            # store they belong to
+            counts = dict.fromkeys(budget, 0)
+            for alias, alias_stats in stats.items():
+                store = shards.store_of(alias)
+                if store in counts:
+                    counts[store] += alias_stats.count
+            over = {
+                alias: (counts[alias], limit)
+                for alias, limit in budget.items()
+                if counts[alias] > limit
+            }
+        if not over:
+            logger.debug('db queries for %s %s: %s', request.method, request.path, summary, extra=extra)
+            return response
+
+        message = f'{view_name} exceeded its query budget: ' + ', '.join(
+            f'{alias} {count} > {limit}' for alias, (count, limit) in over.items())
+        logger.warning('%s (%s %s: %s)', message, request.method, request.path, summary, extra=extra)
+        if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(message)
+        return response
+
+
+class ReplicaPinMiddleware:
+    # Keeps reads on a primary for REPLICA_STICKY_SECONDS after the request
+    # wrote to it, across the redirect that usually follows, so a visitor
+    # never reads a replica that has not caught up with their own write
+    sync_capable = True
+    async_capable = True
+    cookie_name = 'db_pins'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token, pinned = replicas.start_request(request.COOKIES.get(self.cookie_name))
+        try:
+            response = self.get_response(request)
+        finally:
+            pins = replicas.end_request(token)
+        return self.set_cookie(response, pinned, pins)
+
+    async def __acall__(self, request):
+        token, pinned = replicas.start_request(request.COOKIES.get(self.cookie_name))
+        try:
+            response = await self.get_response(request)
+        finally:
+            pins = replicas.end_request(token)
+        return self.set_cookie(response, pinned, pins)
+
+    def set_cookie(self, response, pinned, pins):
+        pins = {alias: until for alias, until in pins.items() if alias in replicas.replica_sets()}
+        if pins != pinned:
+            response.set_cookie(
+                self.cookie_name,
+                replicas.pins_cookie(pins),
+                max_age=replicas.sticky_seconds(),
+                httponly=True,
+                samesite='Lax'
+            )
+        return response
+
+
+class RoutingMiddleware:
+    # Runs the view in a routing context for the request's user, so order
+    # queries that carry no hint still land on that user's shard
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with routing(user=request.user):
+            return self.get_response(request)
+
+    async def __acall__(self, request):
+        with routing(user=request.user):
+            return await self.get_response(request)
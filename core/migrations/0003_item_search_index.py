@@ -0,0 +1,48 @@
+from django.db import migrations
+
+FTS_TABLE = 'core_item_fts'
+
+
+def create_search_index(apps, schema_editor):
+    Item = apps.get_model('core', 'Item')
+    connection = schema_editor.connection
+    if connection.vendor == 'mysql':
+        schema_editor.execute(
+            'CREATE FULLTEXT INDEX core_item_fulltext ON core_item (title, description)'
+        )
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} '
+            f'USING fts5(title, description, category)'
+        )
+        categories = dict(Item._meta.get_field('category').flatchoices)
+        for item in Item.objects.using(connection.alias).iterator():
+            schema_editor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, description, category) '
+                f'VALUES (%s, %s, %s, %s)',
+                [item.pk, item.title, item.description, categories.get(item.category, '')]
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'mysql':
+        schema_editor.execute('DROP INDEX core_item_fulltext ON core_item')
+    elif connection.vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0002_orderitems_alter_orderitem_options"),
+    ]
+
+    operations = [
+        # hints route this to the database that holds core_item (item_db)
+        migrations.RunPython(
+            create_search_index,
+            drop_search_index,
+            hints={'model_name': 'item'}
+        ),
+    ]
@@ -0,0 +1,149 @@
+from decimal import Decimal
+
+from django.db import migrations, models, router
+
+CENT = Decimal("0.01")
+
+ORDER_COLUMNS = ["subtotal", "discount", "coupon_amount", "total"]
+ORDER_ITEM_COLUMNS = ["unit_price", "list_price"]
+
+
+def money_field(name, **kwargs):
+    return models.DecimalField(
+        max_digits=10, decimal_places=2, db_column=name.upper(), **kwargs
+    )
+
+
+def state_fields():
+    return [
+        ("order", name, money_field(name, default=0)) for name in ORDER_COLUMNS
+    ] + [
+        ("orderitem", name, money_field(name, null=True, blank=True))
+        for name in ORDER_ITEM_COLUMNS
+    ]
+
+
+def existing_columns(connection, table):
+    with connection.cursor() as cursor:
+        return {
+            column.name.lower()
+            for column in connection.introspection.get_table_description(cursor, table)
+        }
+
+
+def add_columns(apps, schema_editor):
+    # CORE_ORDER and CORE_ORDERITEM are not managed by Django, so the columns
+    # are only added where the tables exist, with a bare ALTER TABLE: the
+    # historical models do not describe these tables well enough for
+    # schema_editor.add_field to rebuild them on SQLite
+    connection = schema_editor.connection
+    tables = {name.lower() for name in connection.introspection.table_names()}
+    for model_name, name, field in state_fields():
+        model = apps.get_model("core", model_name)
+        table = model._meta.db_table
+        if table.lower() not in tables:
+            continue
+        if name.lower() in existing_columns(connection, table):
+            continue
+        field.set_attributes_from_name(name)
+        definition, params = schema_editor.column_sql(model, field, include_default=True)
+        schema_editor.execute(
+            "ALTER TABLE %s ADD %s %s"
+            % (schema_editor.quote_name(table), schema_editor.quote_name(field.column), definition),
+            params,
+        )
+
+
+def remove_columns(apps, schema_editor):
+    connection = schema_editor.connection
+    tables = {name.lower() for name in connection.introspection.table_names()}
+    for model_name, name, field in state_fields():
+        model = apps.get_model("core", model_name)
+        table = model._meta.db_table
+        if table.lower() in tables and name.lower() in existing_columns(connection, table):
+            schema_editor.execute(
+                schema_editor.sql_delete_column
+                % {
+                    "table": schema_editor.quote_name(table),
+                    "column": schema_editor.quote_name(name.upper()),
+                }
+            )
+
+
+def backfill_totals(apps, schema_editor):
+    # Snapshot today's item prices onto existing lines, then total every
+    # order. Plain SQL, as the historical state of these unmanaged tables
+    # does not describe their real columns.
+    connection = schema_editor.connection
+    tables = {name.lower() for name in connection.introspection.table_names()}
+    if "core_order" not in tables:
+        return
+    Item = apps.get_model("core", "Item")
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT ID, ITEM_ID FROM CORE_ORDERITEM WHERE UNIT_PRICE IS NULL")
+        lines = cursor.fetchall()
+        items = Item.objects.using(router.db_for_read(Item)).in_bulk(
+            {item_id for line_id, item_id in lines}
+        )
+        prices = []
+        for line_id, item_id in lines:
+            item = items.get(item_id)
+            if item is None:
+                continue
+            list_price = Decimal(str(item.price)).quantize(CENT)
+            unit_price = (
+                Decimal(str(item.discount_price)).quantize(CENT)
+                if item.discount_price
+                else list_price
+            )
+            prices.append([unit_price, list_price, line_id])
+        if prices:
+            cursor.executemany(
+                "UPDATE CORE_ORDERITEM SET UNIT_PRICE = %s, LIST_PRICE = %s WHERE ID = %s",
+                prices,
+            )
+
+        cursor.execute(
+            "SELECT l.ORDER_ID, SUM(i.QUANTITY * i.UNIT_PRICE), "
+            "SUM(i.QUANTITY * (i.LIST_PRICE - i.UNIT_PRICE)) "
+            "FROM CORE_ORDER_ITEMS l JOIN CORE_ORDERITEM i ON i.ID = l.ORDERITEM_ID "
+            "WHERE i.UNIT_PRICE IS NOT NULL GROUP BY l.ORDER_ID"
+        )
+        totals = [
+            [Decimal(str(subtotal)).quantize(CENT), Decimal(str(discount)).quantize(CENT), order_id]
+            for order_id, subtotal, discount in cursor.fetchall()
+        ]
+        if totals:
+            cursor.executemany(
+                "UPDATE CORE_ORDER SET SUBTOTAL = %s, DISCOUNT = %s WHERE ID = %s", totals
+            )
+        cursor.execute(
+            "UPDATE CORE_ORDER SET COUPON_AMOUNT = COALESCE("
+            "(SELECT c.AMOUNT FROM CORE_COUPON c WHERE c.ID = CORE_ORDER.COUPON_ID), 0)"
+        )
+        cursor.execute("UPDATE CORE_ORDER SET TOTAL = SUBTOTAL - COUPON_AMOUNT")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0004_job"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddField(model_name=model_name, name=name, field=field)
+                for model_name, name, field in state_fields()
+            ],
+            database_operations=[
+                migrations.RunPython(
+                    add_columns, remove_columns, hints={"model_name": "order"}
+                ),
+            ],
+        ),
+        migrations.RunPython(
+            backfill_totals, migrations.RunPython.noop, hints={"model_name": "order"}
+        ),
+    ]
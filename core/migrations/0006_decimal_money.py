@@ -0,0 +1,59 @@
+from django.db import migrations, models
+from django.db.models.functions import Round
+
+
+def round_item_prices(apps, schema_editor):
+    # Prices are rounded to the cent while they are still floats, so the
+    # column conversion below never has to guess at 19.989999...
+    Item = apps.get_model("core", "Item")
+    items = Item.objects.using(schema_editor.connection.alias)
+    items.update(price=Round("price", 2))
+    items.exclude(discount_price=None).update(discount_price=Round("discount_price", 2))
+
+
+def round_payment_amounts(apps, schema_editor):
+    # CORE_PAYMENT is not managed by Django; its AMOUNT column keeps its type
+    # and only the stored values are rounded to the cent
+    connection = schema_editor.connection
+    tables = {name.lower() for name in connection.introspection.table_names()}
+    if "core_payment" not in tables:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE CORE_PAYMENT SET AMOUNT = ROUND(AMOUNT, 2)")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0005_order_totals"),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            round_item_prices, migrations.RunPython.noop, hints={"model_name": "item"}
+        ),
+        migrations.AlterField(
+            model_name="item",
+            name="price",
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name="item",
+            name="discount_price",
+            field=models.DecimalField(
+                blank=True, decimal_places=2, max_digits=10, null=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="amount",
+            field=models.DecimalField(
+                db_column="AMOUNT", decimal_places=2, max_digits=10
+            ),
+        ),
+        migrations.RunPython(
+            round_payment_amounts,
+            migrations.RunPython.noop,
+            hints={"model_name": "payment"},
+        ),
+    ]
@@ -0,0 +1,94 @@
+import hashlib
+
+from django.conf import settings
+from django.db import connections, migrations, models
+
+
+def address_hash(street_address, apartment_address, country, zip):
+    # A copy of core.models.address_hash as it was when this migration was
+    # written, so that later changes to it do not change this migration
+    parts = [
+        " ".join(str(value or "").split()).casefold()
+        for value in (street_address, apartment_address, country, zip)
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode()).hexdigest()
+
+
+def order_shards():
+    return list(getattr(settings, "ORDER_SHARDS", ["other_db"]))
+
+
+def repoint_orders(replaced):
+    # CORE_ORDER is not managed by Django and lives on the order shards, so
+    # the orders are moved to the surviving addresses with plain SQL there
+    for alias in order_shards():
+        connection = connections[alias]
+        tables = {name.lower() for name in connection.introspection.table_names()}
+        if "core_order" not in tables:
+            continue
+        with connection.cursor() as cursor:
+            for column in ("SHIPPING_ADDRESS_ID", "BILLING_ADDRESS_ID"):
+                cursor.executemany(
+                    f"UPDATE CORE_ORDER SET {column} = %s WHERE {column} = %s",
+                    [(keep, duplicate) for duplicate, keep in replaced.items()],
+                )
+
+
+def collapse_duplicate_addresses(apps, schema_editor):
+    # One row per (user, type, content); the oldest row survives, and stays
+    # the default if any of its duplicates was
+    Address = apps.get_model("core", "Address")
+    addresses = Address.objects.using(schema_editor.connection.alias)
+    survivors = {}
+    replaced = {}
+    defaults = set()
+    for address in addresses.order_by("id").iterator():
+        address.content_hash = address_hash(
+            address.street_address,
+            address.apartment_address,
+            address.country,
+            address.zip,
+        )
+        key = (address.user_id, address.address_type, address.content_hash)
+        if key in survivors:
+            replaced[address.pk] = survivors[key].pk
+        else:
+            survivors[key] = address
+            addresses.filter(pk=address.pk).update(content_hash=address.content_hash)
+        if address.default:
+            defaults.add(survivors[key].pk)
+    if not replaced:
+        return
+    # orders first, so that no order is left pointing at a deleted row
+    repoint_orders(replaced)
+    addresses.filter(pk__in=defaults).update(default=True)
+    addresses.filter(pk__in=list(replaced)).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0007_usershard"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="address",
+            name="content_hash",
+            field=models.CharField(default="", editable=False, max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(
+            collapse_duplicate_addresses,
+            migrations.RunPython.noop,
+            hints={"model_name": "address"},
+        ),
+        migrations.AddConstraint(
+            model_name="address",
+            constraint=models.UniqueConstraint(
+                fields=("user", "address_type", "content_hash"),
+                name="unique_address_per_user",
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.5 on 2026-10-18 12:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0008_address_content_hash"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ItemChange",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("item_id", models.BigIntegerField()),
+                ("changed", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
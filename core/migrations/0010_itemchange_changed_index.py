@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("core", "0009_itemchange"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="itemchange",
+            name="changed",
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -1,10 +1,20 @@
+import hashlib
+
 from django.db.models.signals import post_save
 from django.conf import settings
-from django.db import models
-from django.db.models import Sum
+from django.db import models, router
+from django.db.models import Case, Count, F, Q, Sum, When
+from django.db.models.functions import Coalesce
+from django.db.models.query import ModelIterable
 from django.shortcuts import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django_countries.fields import CountryField
-from decimal import Decimal
+
+from . import catalogue
+from .cart import CartSummary
+from .money import ZERO, money, price_snapshot
+from .querysets import CrossDatabaseQuerySet, ShardedQuerySet
 
 
 CATEGORY_CHOICES = (
@@ -37,8 +47,8 @@ class UserProfile(models.Model):
 
 class Item(models.Model):
     title = models.CharField(max_length=100)
-    price = models.FloatField()
-    discount_price = models.FloatField(blank=True, null=True)
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    discount_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
     category = models.CharField(choices=CATEGORY_CHOICES, max_length=2)
     label = models.CharField(choices=LABEL_CHOICES, max_length=1)
     slug = models.SlugField()
@@ -68,6 +78,14 @@ class Item(models.Model):
    
         
 
+class ItemChange(models.Model):
+    # One row per saved or deleted Item, written on the item database next
+    # to it; core.catalogue re-reads the items changed since its version
+    item_id = models.BigIntegerField()
+    # refreshes read and item writes prune the log by this column
+    changed = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
 
 # class OrderItem(models.Model):
     # id = models.AutoField(primary_key=True, db_column='ID')
@@ -130,27 +148,50 @@ class OrderItem(models.Model):
         db_column='ITEM_ID'
     )
     quantity = models.IntegerField(default=1, db_column='QUANTITY')
+    # prices when the line was created; unsaved (guest) lines use the item's
+    unit_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, db_column='UNIT_PRICE')
+    list_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True, db_column='LIST_PRICE')
+
+    objects = ShardedQuerySet.as_manager()
 
     class Meta:
         managed = False
         db_table = 'CORE_ORDERITEM'
+        # not created by migrate, see the advise_indexes command
+        indexes = [models.Index(fields=['user', 'ordered'], name='core_oi_user_ordered_idx')]
 
     def __str__(self):
-        return f"{self.quantity} of {self.item.title}"
+        return f"{self.quantity} of {self.get_item().title}"
+
+    def get_item(self):
+        # the line's item, from the catalogue snapshot unless already loaded
+        field = self._meta.get_field('item')
+        if not field.is_cached(self):
+            field.set_cached_value(self, catalogue.snapshot.get(self.item_id))
+        return self.item
 
     def get_total_item_price(self):
-        return Decimal(str(self.quantity)) * Decimal(str(self.item.price))
+        if self.list_price is not None:
+            return self.quantity * self.list_price
+        return self.quantity * money(self.get_item().price)
 
     def get_total_discount_item_price(self):
-        return Decimal(str(self.quantity)) * Decimal(str(self.item.discount_price))
+        if self.unit_price is not None:
+            return self.quantity * self.unit_price
+        return self.quantity * money(self.get_item().discount_price)
 
     def get_amount_saved(self):
         return self.get_total_item_price() - self.get_total_discount_item_price()
 
+    def has_discount(self):
+        if self.unit_price is not None:
+            return self.unit_price < self.list_price
+        return bool(self.get_item().discount_price)
+
     def get_final_price(self):
-        if self.item.discount_price:
-            return float(self.get_total_discount_item_price())
-        return float(self.get_total_item_price())
+        if self.has_discount():
+            return self.get_total_discount_item_price()
+        return self.get_total_item_price()
 
 
 class OrderItems(models.Model):
@@ -168,9 +209,104 @@ class OrderItems(models.Model):
         db_column='ORDERITEM_ID'
     )
 
+    objects = ShardedQuerySet.as_manager()
+
     class Meta:
         managed = False
         db_table = 'CORE_ORDER_ITEMS'
+        indexes = [
+            models.Index(fields=['order', 'orderitem'], name='core_oi_order_line_idx'),
+            models.Index(fields=['orderitem'], name='core_oi_line_idx'),
+        ]
+
+
+def prefetch_addresses(orders):
+    # Order.shipping_address() and billing_address() for many orders, with
+    # one query for the addresses and one for their users (Address.__str__)
+    orders = [order for order in orders if order is not None]
+    ids = {order.shipping_address_id for order in orders} | {order.billing_address_id for order in orders}
+    ids.discard(None)
+    addresses = Address.objects.prefetch_across('user').in_bulk(ids) if ids else {}
+    for order in orders:
+        order._addresses = addresses
+    return orders
+
+
+class OrderQuerySet(ShardedQuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._with_addresses = False
+
+    def with_addresses(self):
+        clone = self._chain()
+        clone._with_addresses = True
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._with_addresses = self._with_addresses
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is not None
+        super()._fetch_all()
+        if self._with_addresses and not fetched and issubclass(self._iterable_class, ModelIterable):
+            prefetch_addresses(self._result_cache)
+
+    def cart_totals(self):
+        """
+        {order id: (subtotal, discount)} for the orders in this queryset,
+        summed by the database instead of over loaded lines. Lines without a
+        price snapshot are priced from their item: inside the same aggregate
+        when Item lives on the order database, otherwise with one batched
+        price lookup on the item database.
+        """
+        amount = models.DecimalField(max_digits=10, decimal_places=2)
+        lines = OrderItems.objects.using(self.db).filter(order__in=self.values('pk'))
+        quantity = F('orderitem__quantity')
+        if router.db_for_read(Item) == self.db:
+            unit = Case(
+                When(orderitem__unit_price__isnull=False, then=F('orderitem__unit_price')),
+                When(orderitem__item__discount_price__gt=0, then=F('orderitem__item__discount_price')),
+                default=F('orderitem__item__price'),
+                output_field=amount
+            )
+            listed = Coalesce('orderitem__list_price', 'orderitem__item__price', output_field=amount)
+            rows = lines.values('order').annotate(
+                subtotal=Sum(quantity * unit, output_field=amount),
+                discount=Sum(quantity * (listed - unit), output_field=amount)
+            )
+            return {row['order']: (money(row['subtotal']), money(row['discount'])) for row in rows}
+
+        priced = Q(orderitem__unit_price__isnull=False)
+        rows = lines.values('order').annotate(
+            subtotal=Sum(quantity * F('orderitem__unit_price'), filter=priced, output_field=amount),
+            discount=Sum(
+                quantity * (F('orderitem__list_price') - F('orderitem__unit_price')),
+                filter=priced,
+                output_field=amount
+            ),
+            unpriced=Count('pk', filter=~priced)
+        )
+        totals = {}
+        unpriced = False
+        for row in rows:
+            totals[row['order']] = (money(row['subtotal'] or ZERO), money(row['discount'] or ZERO))
+            unpriced = unpriced or row['unpriced'] > 0
+        if unpriced:
+            pending = list(lines.exclude(priced).values_list(
+                'order', 'orderitem__item', 'orderitem__quantity'))
+            items = Item.objects.in_bulk({item_id for order_id, item_id, line_quantity in pending})
+            for order_id, item_id, line_quantity in pending:
+                if item_id not in items:
+                    continue
+                unit_price, list_price = price_snapshot(items[item_id])
+                subtotal, discount = totals[order_id]
+                totals[order_id] = (
+                    subtotal + line_quantity * unit_price,
+                    discount + line_quantity * (list_price - unit_price)
+                )
+        return totals
 
 
 class Order(models.Model):
@@ -212,31 +348,70 @@ class Order(models.Model):
     received = models.BooleanField(default=False, db_column='RECEIVED')
     refund_requested = models.BooleanField(default=False, db_column='REFUND_REQUESTED')
     refund_granted = models.BooleanField(default=False, db_column='REFUND_GRANTED')
+    # kept up to date by core.services whenever a line or the coupon changes
+    subtotal = models.DecimalField(max_digits=10, decimal_places=2, default=0, db_column='SUBTOTAL')
+    discount = models.DecimalField(max_digits=10, decimal_places=2, default=0, db_column='DISCOUNT')
+    coupon_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0, db_column='COUPON_AMOUNT')
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0, db_column='TOTAL')
+
+    objects = OrderQuerySet.as_manager()
 
     class Meta:
         managed = False
         db_table = 'CORE_ORDER'
+        indexes = [
+            models.Index(fields=['user', 'ordered'], name='core_order_user_ordered_idx'),
+            models.Index(fields=['ref_code'], name='core_order_ref_code_idx'),
+        ]
 
     def __str__(self):
         return self.user.username
 
+    @cached_property
+    def cart(self):
+        # loaded once per instance so views and templates share the totals
+        return CartSummary.for_order(self)
+
     def get_total(self):
-        total = Decimal('0.0')
-        for order_item in self.items.all():
-            total += Decimal(str(order_item.get_final_price()))
-        if self.coupon:
-            total -= Decimal(str(self.coupon.amount))
-        return float(total)
+        # unsaved orders stand in for guest carts and have no stored totals
+        if self.pk is None:
+            return self.cart.total
+        return self.total
+
+    def get_address(self, address_id):
+        if not address_id:
+            return None
+        # loaded for the whole queryset by OrderQuerySet.with_addresses()
+        addresses = getattr(self, '_addresses', None)
+        if addresses is not None:
+            return addresses.get(address_id)
+        return Address.objects.get(id=address_id)
 
     def shipping_address(self):
-        if self.shipping_address_id:
-            return Address.objects.get(id=self.shipping_address_id)
-        return None
+        return self.get_address(self.shipping_address_id)
 
     def billing_address(self):
-        if self.billing_address_id:
-            return Address.objects.get(id=self.billing_address_id)
-        return None
+        return self.get_address(self.billing_address_id)
+
+
+def address_hash(street_address, apartment_address, country, zip):
+    # Addresses that differ only in case or spacing hash the same, so a
+    # resubmitted checkout form finds the address it saved last time
+    parts = [
+        ' '.join(str(value or '').split()).casefold()
+        for value in (street_address, apartment_address, country, zip)
+    ]
+    return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+
+class AddressQuerySet(CrossDatabaseQuerySet):
+    def defaults(self, user):
+        # {address type: the user's default address of that type}, one query
+        addresses = self.filter(user=user, default=True).order_by('-id')
+        found = {}
+        for address in addresses:
+            found.setdefault(address.address_type, address)
+        return found
 
 
 class Address(models.Model):
@@ -248,14 +423,29 @@ class Address(models.Model):
     zip = models.CharField(max_length=100)
     address_type = models.CharField(max_length=1, choices=ADDRESS_CHOICES)
     default = models.BooleanField(default=False)
+    # address_hash() of the fields above, see services.save_address
+    content_hash = models.CharField(max_length=64, editable=False)
+
+    objects = AddressQuerySet.as_manager()
 
     class Meta:
         verbose_name_plural = 'Addresses'
         managed = True
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'address_type', 'content_hash'],
+                name='unique_address_per_user'
+            )
+        ]
 
     def __str__(self):
         return self.user.username
 
+    def save(self, *args, **kwargs):
+        self.content_hash = address_hash(
+            self.street_address, self.apartment_address, self.country, self.zip)
+        super().save(*args, **kwargs)
+
 
 class Payment(models.Model):
     id = models.AutoField(primary_key=True, db_column='ID')
@@ -268,12 +458,15 @@ class Payment(models.Model):
         db_column='USER_ID',
         db_constraint=False
     )
-    amount = models.FloatField(db_column='AMOUNT')
+    amount = models.DecimalField(max_digits=10, decimal_places=2, db_column='AMOUNT')
     timestamp = models.DateTimeField(auto_now_add=True, db_column='TIMESTAMP')
 
+    objects = ShardedQuerySet.as_manager()
+
     class Meta:
         managed = False
         db_table = 'CORE_PAYMENT'
+        indexes = [models.Index(fields=['stripe_charge_id'], name='core_payment_charge_idx')]
 
     def __str__(self):
         return self.stripe_charge_id
@@ -287,6 +480,7 @@ class Coupon(models.Model):
     class Meta:
         managed = False
         db_table = 'CORE_COUPON'
+        indexes = [models.Index(fields=['code'], name='core_coupon_code_idx')]
 
     def __str__(self):
         return self.code
@@ -298,10 +492,51 @@ class Refund(models.Model):
     accepted = models.BooleanField(default=False)
     email = models.EmailField()
 
+    objects = ShardedQuerySet.as_manager()
+
     def __str__(self):
         return f"{self.pk}"
 
 
+class UserShard(models.Model):
+    # Users whose order data is not on the shard their id hashes to, see
+    # routers.shards; written by the rebalance_orders command
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    shard = models.CharField(max_length=50)
+
+    def __str__(self):
+        return f"{self.user_id} on {self.shard}"
+
+
+JOB_STATUS_CHOICES = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+
+class Job(models.Model):
+    # Background work queued with core.jobs.enqueue(); it lives next to the
+    # orders so a job can be queued in the same transaction as the order
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(choices=JOB_STATUS_CHOICES, max_length=10, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'run_after'])]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk}"
+
+
 def userprofile_receiver(sender, instance, created, *args, **kwargs):
     if created:
         userprofile = UserProfile.objects.create(user=instance)
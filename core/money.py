@@ -0,0 +1,35 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+
+# Every amount in the shop is a Decimal with two places in this currency;
+# Stripe is the only place that sees integer minor units
+CURRENCY = getattr(settings, 'CURRENCY', 'usd')
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+
+
+def money(value):
+    # floats go through str() so 19.99 stays 19.99 rather than 19.989999...
+    if value is None:
+        return None
+    if isinstance(value, float):
+        value = str(value)
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def to_cents(amount):
+    return int(money(amount) * 100)
+
+
+def from_cents(cents):
+    return money(Decimal(cents) / 100)
+
+
+def price_snapshot(item):
+    # (unit price charged, list price) frozen on a line when it is created
+    list_price = money(item.price)
+    if item.discount_price:
+        return money(item.discount_price), list_price
+    return list_price, list_price
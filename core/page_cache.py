@@ -0,0 +1,145 @@
+import hashlib
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .cart import SessionCart
+
+CATALOGUE_CACHE_TIMEOUT = getattr(settings, 'CATALOGUE_CACHE_TIMEOUT', 60 * 10)
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cache_stats():
+    # {'hits': ..., 'misses': ..., 'stores': ..., 'invalidations': ...} for this process
+    with _stats_lock:
+        return dict(_stats)
+
+
+def is_cacheable(request):
+    # The rendered page only varies by user through the navbar, so pages are
+    # shared by anonymous visitors with an empty cart and no pending messages
+    return (
+        request.method == 'GET'
+        and not request.user.is_authenticated
+        and not SessionCart(request.session)
+        and not len(get_messages(request))
+    )
+
+
+def page_key(request):
+    query = '&'.join(f'{k}={v}' for k, v in sorted(request.GET.items()))
+    digest = hashlib.md5(f'{request.path}?{query}'.encode()).hexdigest()
+    return f'catalogue:page:{digest}'
+
+
+def tag_key(tag):
+    return f'catalogue:tag:{tag}'
+
+
+def tag_versions(tags):
+    # {tag: version}; a tag without one starts from the clock, so a version
+    # that was evicted cannot come back and match an old page
+    keys = {tag_key(tag): tag for tag in tags}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, time.time_ns(), None)
+    if len(versions) < len(keys):
+        versions = cache.get_many(keys)
+    return {keys[key]: version for key, version in versions.items()}
+
+
+def get_page(key):
+    # a page is stored with the versions of its tags and only served while
+    # none of them has been bumped since
+    cached = cache.get(key)
+    if cached is not None:
+        content, content_type, versions = cached
+        current = cache.get_many([tag_key(tag) for tag in versions])
+        if all(current.get(tag_key(tag)) == version for tag, version in versions.items()):
+            _count('hits')
+            return HttpResponse(content, content_type=content_type)
+    _count('misses')
+    return None
+
+
+def store_page(key, response, tags, versions):
+    # ``versions`` are the tag versions read before the page was rendered,
+    # so a change made while rendering leaves the stored page already stale
+    versions = {tag: versions[tag] for tag in tags if tag in versions}
+    missing = [tag for tag in tags if tag not in versions]
+    versions.update(tag_versions(missing))
+    cache.set(key, (response.content, response['Content-Type'], versions), CATALOGUE_CACHE_TIMEOUT)
+    _count('stores')
+
+
+def invalidate(*tags):
+    # bumping a tag's version retires every page stored with it, in every
+    # process sharing the cache; a tag without a version has no pages
+    for tag in tags:
+        try:
+            cache.incr(tag_key(tag))
+        except ValueError:
+            pass
+    with _stats_lock:
+        _stats['invalidations'] += len(tags)
+
+
+def item_tag(item_id):
+    return f'item:{item_id}'
+
+
+def listing_tags(category=None, query=None):
+    if query:
+        return ['search']
+    if category:
+        return [f'category:{category}']
+    return ['all']
+
+
+def invalidate_saved_item(sender, instance, created, **kwargs):
+    # pages showing the item, listings of its category and search results;
+    # a new item also shifts the unfiltered listing
+    tags = [item_tag(instance.pk), f'category:{instance.category}', 'search']
+    if created:
+        tags.append('all')
+    invalidate(*tags)
+
+
+def invalidate_deleted_item(sender, instance, **kwargs):
+    invalidate(item_tag(instance.pk), f'category:{instance.category}', 'search', 'all')
+
+
+class CataloguePageCacheMixin:
+    def get_page_cache_known_tags(self):
+        # tags known before the page is rendered; their versions are read
+        # first, the others' only once the page is stored
+        return []
+
+    def get_page_cache_tags(self, response):
+        return []
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_cacheable(request):
+            return super().dispatch(request, *args, **kwargs)
+        key = page_key(request)
+        response = get_page(key)
+        if response is not None:
+            return response
+        versions = tag_versions(self.get_page_cache_known_tags())
+        response = super().dispatch(request, *args, **kwargs)
+        if response.status_code == 200 and hasattr(response, 'render'):
+            response.render()
+            store_page(key, response, self.get_page_cache_tags(response), versions)
+        return response
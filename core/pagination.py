@@ -0,0 +1,151 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+
+def encode_cursor(direction, values):
+    payload = json.dumps([direction, values], cls=DjangoJSONEncoder).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor, fields):
+    # (direction, [value per key field]); anything that was not made by
+    # encode_cursor() for these fields is a 404 rather than a failing query
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        direction, values = json.loads(base64.urlsafe_b64decode(padded))
+    except (ValueError, TypeError, binascii.Error):
+        raise Http404('Invalid cursor')
+    if not isinstance(values, list):
+        # cursors from before keys could be several fields
+        values = [values]
+    if direction not in ('next', 'prev') or len(values) != len(fields):
+        raise Http404('Invalid cursor')
+    decoded = []
+    for field, value in zip(fields, values):
+        if value is None or isinstance(value, (bool, list, dict)):
+            raise Http404('Invalid cursor')
+        try:
+            decoded.append(field.to_python(value))
+        except ValidationError:
+            raise Http404('Invalid cursor')
+    return direction, decoded
+
+
+def approximate_count(queryset):
+    # Table statistics instead of COUNT(*); only meaningful for an
+    # unfiltered queryset and only on backends that keep row estimates
+    if queryset.query.where:
+        return None
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    if connection.vendor == 'mysql':
+        sql = ('SELECT TABLE_ROWS FROM information_schema.TABLES '
+               'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s')
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s'
+    elif connection.vendor == 'oracle':
+        sql = 'SELECT NUM_ROWS FROM USER_TABLES WHERE TABLE_NAME = UPPER(%s)'
+    else:
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+class EstimatedCountPaginator(Paginator):
+    # Paginator for the admin: an unfiltered changelist takes its row count
+    # from the table statistics where the backend keeps them, instead of a
+    # COUNT(*) over the whole table on every page
+    @cached_property
+    def count(self):
+        estimate = approximate_count(self.object_list)
+        if not estimate:
+            return super().count
+        return estimate
+
+
+class CursorPage:
+    cursor_paginated = True
+
+    def __init__(self, object_list, next_cursor=None, previous_cursor=None, approximate_total=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        self.approximate_total = approximate_total
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class KeysetPaginator:
+    # Pages through a queryset by an indexed, unique key (the primary key by
+    # default): every page is WHERE key > last ORDER BY key LIMIT n + 1, so
+    # there is no OFFSET and no COUNT(*) however deep the page is. The key
+    # may be several fields, e.g. ('price', 'id'), the last one unique so
+    # that rows tied on the others keep their order.
+    def __init__(self, queryset, per_page, key='id', with_total=False):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = [key] if isinstance(key, str) else list(key)
+        self.with_total = with_total
+
+    def after(self, values, lookup):
+        # rows past ``values`` in key order: (a > x) or (a = x and b > y) ...
+        query = Q()
+        for position, key in enumerate(self.keys):
+            query |= Q(**dict(zip(self.keys[:position], values)), **{f'{key}__{lookup}': values[position]})
+        return query
+
+    def page(self, cursor=None):
+        fields = [self.queryset.model._meta.get_field(key) for key in self.keys]
+        direction, values = decode_cursor(cursor, fields) if cursor else (None, None)
+        if direction == 'prev':
+            queryset = self.queryset.filter(self.after(values, 'lt')).order_by(
+                *[f'-{key}' for key in self.keys])
+        elif direction == 'next':
+            queryset = self.queryset.filter(self.after(values, 'gt')).order_by(*self.keys)
+        else:
+            queryset = self.queryset.order_by(*self.keys)
+
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if direction == 'prev':
+            rows.reverse()
+
+        # walking backwards, the extra row tells whether an earlier page exists
+        if direction == 'prev':
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, direction == 'next'
+
+        next_cursor = previous_cursor = None
+        if rows and has_next:
+            next_cursor = encode_cursor('next', [getattr(rows[-1], key) for key in self.keys])
+        if rows and has_previous:
+            previous_cursor = encode_cursor('prev', [getattr(rows[0], key) for key in self.keys])
+
+        total = approximate_count(self.queryset) if self.with_total else None
+        return CursorPage(rows, next_cursor, previous_cursor, total)
@@ -0,0 +1,165 @@
+import hashlib
+import logging
+
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Q
+
+from . import jobs
+from .cart import invalidate_cart
+from .models import Order, Payment
+from .money import CURRENCY, from_cents
+from .refcodes import create_ref_code
+
+logger = logging.getLogger(__name__)
+
+stripe.api_key = settings.STRIPE_SECRET_KEY
+stripe.api_base = settings.STRIPE_API_BASE
+
+# stripe_charge_id of a Payment whose charge has not come back yet, or
+# was declined; either is followed by '<idempotency_key>:<attempt number>'
+PENDING_PREFIX = 'pending:'
+DECLINED_PREFIX = 'declined:'
+
+# Stripe errors after which the card was certainly not charged
+DECLINES = (stripe.error.CardError, stripe.error.InvalidRequestError)
+
+
+def idempotency_key(order, amount, source):
+    # The same order, amount and card always give the same key, so a double
+    # submit finds the pending Payment of the first one
+    digest = hashlib.sha256(f'{order.pk}:{amount}:{source}'.encode()).hexdigest()
+    return digest[:32]
+
+
+class PaymentAttempt:
+    def __init__(self, order, payment, profile, email, amount, token, save, use_default):
+        self.order = order
+        self.payment = payment
+        self.profile = profile
+        self.email = email
+        self.amount = amount
+        self.token = token
+        self.save = save
+        self.use_default = use_default
+        self.customer_id = profile.stripe_customer_id or None
+        # Stripe's Idempotency-Key: the order, amount and card, and the
+        # number of declines before this attempt, so a double submit or a
+        # retry after an unknown outcome replays the same charge, while a
+        # retry after a decline is charged afresh
+        self.key = payment.stripe_charge_id[len(PENDING_PREFIX):].replace(':', '-')
+
+
+def start(order, user, profile, amount, token, save=False, use_default=False):
+    """
+    Record a pending Payment for the order before Stripe is called, or
+    return None if the order has been paid meanwhile. Submits of the same
+    order, amount and card share one Payment row: a resubmitted form, or a
+    retry whose charge may have gone through, reuses the pending attempt,
+    and a retry after a decline makes it the next attempt.
+    """
+    source = profile.stripe_customer_id if use_default else token
+    key = idempotency_key(order, amount, source)
+    db = router.db_for_write(Payment, instance=order)
+    with transaction.atomic(using=db):
+        # the order row serialises concurrent submits, so the second one
+        # finds the Payment the first one created
+        if Order.objects.using(db).select_for_update().get(pk=order.pk).ordered:
+            return None
+        payment = Payment.objects.using(db).filter(
+            Q(stripe_charge_id__startswith=f'{PENDING_PREFIX}{key}:')
+            | Q(stripe_charge_id__startswith=f'{DECLINED_PREFIX}{key}:')
+        ).first()
+        if payment is None:
+            payment = Payment.objects.using(db).create(
+                stripe_charge_id=f'{PENDING_PREFIX}{key}:0',
+                user=user,
+                amount=from_cents(amount)
+            )
+        elif payment.stripe_charge_id.startswith(DECLINED_PREFIX):
+            declines = int(payment.stripe_charge_id.rsplit(':', 1)[1]) + 1
+            payment.stripe_charge_id = f'{PENDING_PREFIX}{key}:{declines}'
+            payment.save(using=db, update_fields=['stripe_charge_id'])
+    return PaymentAttempt(order, payment, profile, user.email, amount, token, save, use_default)
+
+
+def create_charge(attempt):
+    # Only talks to Stripe, so it can run outside the request thread
+    if attempt.save:
+        if attempt.customer_id:
+            stripe.Customer.create_source(
+                attempt.customer_id,
+                source=attempt.token,
+                idempotency_key=f'{attempt.key}-source'
+            )
+        else:
+            customer = stripe.Customer.create(
+                email=attempt.email,
+                source=attempt.token,
+                idempotency_key=f'{attempt.key}-customer'
+            )
+            attempt.customer_id = customer.id
+    return stripe.Charge.create(
+        amount=attempt.amount,
+        currency=CURRENCY,
+        customer=attempt.customer_id if attempt.use_default else None,
+        source=attempt.token if not attempt.use_default else None,
+        idempotency_key=attempt.key
+    )
+
+
+async def charge(attempt):
+    # the gateway round trips run on a worker thread of their own, leaving
+    # the event loop and the database thread free while Stripe responds
+    return await sync_to_async(create_charge, thread_sensitive=False)(attempt)
+
+
+def remember_customer(attempt):
+    if attempt.customer_id and attempt.customer_id != attempt.profile.stripe_customer_id:
+        attempt.profile.stripe_customer_id = attempt.customer_id
+        attempt.profile.save(update_fields=['stripe_customer_id'])
+
+
+def finalise(attempt, charge_id):
+    # Mark the order paid with the charge; a concurrent submit of the same
+    # attempt that gets here second finds the order already paid
+    remember_customer(attempt)
+    db = router.db_for_write(Order, instance=attempt.order)
+    with transaction.atomic(using=db):
+        # writing first takes SQLite's write lock before anything is read
+        attempt.payment.stripe_charge_id = charge_id
+        attempt.payment.save(using=db)
+        order = Order.objects.using(db).select_for_update().get(pk=attempt.order.pk)
+        if order.ordered:
+            if order.payment_id != attempt.payment.pk:
+                # paid meanwhile with another card: this charge is real too,
+                # so its Payment is kept for a refund
+                logger.warning('Order %s was charged twice, payments %s and %s',
+                               order.pk, order.payment_id, attempt.payment.pk)
+            return order
+        order.ordered = True
+        order.payment = attempt.payment
+        order.ref_code = create_ref_code(order)
+        order.save(using=db)
+        # queued in the same transaction, so they run if and only if the
+        # order was recorded as paid
+        jobs.enqueue('finalise_order', using=db, order_id=order.pk, user_id=order.user_id)
+        jobs.enqueue('send_order_confirmation', using=db, order_id=order.pk, user_id=order.user_id)
+    invalidate_cart(order.user_id)
+    return order
+
+
+def abandon(attempt, error):
+    # The charge failed and the order stays open. Only after a decline is
+    # the card known not to have been charged; after a network error or a
+    # timeout the attempt stays pending, so a retry reuses its key and
+    # Stripe replays the charge if it went through
+    remember_customer(attempt)
+    if not isinstance(error, DECLINES):
+        return
+    Payment.objects.using(router.db_for_write(Payment, instance=attempt.payment)).filter(
+        pk=attempt.payment.pk,
+        stripe_charge_id=attempt.payment.stripe_charge_id
+    ).update(stripe_charge_id=DECLINED_PREFIX + attempt.payment.stripe_charge_id[len(PENDING_PREFIX):])
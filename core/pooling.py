@@ -0,0 +1,102 @@
+import threading
+from collections import Counter, defaultdict
+
+# Connection pooling for the databases behind ItemRouter. Settings declare
+# one DATABASE_POOLS entry per alias:
+#
+#   'MAX_AGE'        seconds a connection (or pooled session) may live
+#   'HEALTH_CHECKS'  ping a reused connection before the first query
+#   'MIN', 'MAX', 'INCREMENT', 'TIMEOUT'
+#                    session pool sizing and the seconds a request may wait
+#                    for a free session (Oracle and PostgreSQL only)
+#
+# Oracle aliases are switched to core.backends.oracle, which checks sessions
+# out of a SessionPool and returns them at the end of every request.
+# PostgreSQL uses Django's own psycopg pool. MySQL and SQLite have no
+# driver pool, so they keep one persistent connection per worker thread.
+
+POOLED_ORACLE_ENGINE = 'core.backends.oracle'
+
+
+def configure_pools(databases, pools):
+    databases = {alias: dict(settings_dict) for alias, settings_dict in databases.items()}
+    for alias, pool in pools.items():
+        settings_dict = databases[alias]
+        engine = settings_dict['ENGINE']
+        settings_dict['CONN_HEALTH_CHECKS'] = pool.get('HEALTH_CHECKS', True)
+        if 'MAX' in pool and engine in ('django.db.backends.oracle', POOLED_ORACLE_ENGINE):
+            settings_dict['ENGINE'] = POOLED_ORACLE_ENGINE
+            settings_dict['POOL'] = {
+                'min': pool.get('MIN', 1),
+                'max': pool['MAX'],
+                'increment': pool.get('INCREMENT', 1),
+                'wait_timeout': int(pool.get('TIMEOUT', 5) * 1000),
+                'max_lifetime_session': pool.get('MAX_AGE', 0),
+            }
+            # the session goes back to the pool at the end of each request
+            settings_dict['CONN_MAX_AGE'] = 0
+        elif 'MAX' in pool and 'postgresql' in engine:
+            settings_dict['OPTIONS'] = {
+                **settings_dict.get('OPTIONS', {}),
+                'pool': {
+                    'min_size': pool.get('MIN', 1),
+                    'max_size': pool['MAX'],
+                    'timeout': pool.get('TIMEOUT', 5),
+                    'max_lifetime': pool.get('MAX_AGE', 3600),
+                },
+            }
+            settings_dict['CONN_MAX_AGE'] = 0
+        else:
+            settings_dict['CONN_MAX_AGE'] = pool.get('MAX_AGE', 60)
+    return databases
+
+
+class PoolMetrics:
+    # Per-alias counters for this process:
+    #   connects   new connections handed to Django (connection churn)
+    #   checkouts  sessions taken from a pool
+    #   waits      checkouts that found every session busy
+    #   wait_time  seconds spent waiting in checkouts
+    #   releases   sessions given back to a pool
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(Counter)
+
+    def record(self, alias, event, amount=1):
+        with self._lock:
+            self._counters[alias][event] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return {alias: dict(counter) for alias, counter in self._counters.items()}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+pool_metrics = PoolMetrics()
+
+_session_pools = {}
+_session_pools_lock = threading.Lock()
+
+
+def get_session_pool(alias, create):
+    # one driver pool per alias and process, created on first checkout
+    with _session_pools_lock:
+        if alias not in _session_pools:
+            _session_pools[alias] = create()
+        return _session_pools[alias]
+
+
+def record_connection_created(sender, connection, **kwargs):
+    pool_metrics.record(connection.alias, 'connects')
+
+
+def pool_stats():
+    stats = pool_metrics.snapshot()
+    with _session_pools_lock:
+        pools = dict(_session_pools)
+    for alias, pool in pools.items():
+        stats.setdefault(alias, {}).update({'opened': pool.opened, 'busy': pool.busy, 'max': pool.max})
+    return stats
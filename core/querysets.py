@@ -0,0 +1,115 @@
+from collections import defaultdict
+
+from django.db import models, router
+from django.db.models import prefetch_related_objects
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.query import ModelIterable
+
+
+# {model: in_bulk(ids)} for models that a per-process snapshot serves by
+# primary key, registered by core.apps (core.catalogue for Item)
+snapshots = {}
+
+
+def _is_forward(field):
+    return field.concrete and (field.many_to_one or field.one_to_one)
+
+
+def prefetch_across(instances, *lookups):
+    # Like prefetch_related_objects(), but forward foreign keys are resolved
+    # with one IN (...) query per (target model, database) pair picked by the
+    # router, so relations that cross databases (Order -> User,
+    # OrderItem -> Item) are stitched back without a JOIN or an N+1.
+    instances = [instance for instance in instances if instance is not None]
+    if not instances or not lookups:
+        return instances
+
+    tree = {}
+    for lookup in lookups:
+        head, _, rest = lookup.partition(LOOKUP_SEP)
+        tree.setdefault(head, [])
+        if rest:
+            tree[head].append(rest)
+
+    opts = instances[0]._meta
+    fields = [opts.get_field(name) for name in tree]
+
+    batches = defaultdict(list)
+    for field in fields:
+        if not _is_forward(field):
+            # many-to-many and reverse relations live next to their source
+            # rows, so Django's own prefetching already routes them correctly
+            prefetch_related_objects(instances, field.name)
+            continue
+        model = field.related_model
+        db = router.db_for_read(model, instance=instances[0])
+        batches[model, db, field.remote_field.field_name].append(field)
+
+    for (model, db, to_field), batch_fields in batches.items():
+        pending = {
+            field: [obj for obj in instances if not field.is_cached(obj)]
+            for field in batch_fields
+        }
+        values = {
+            getattr(obj, field.attname)
+            for field, objs in pending.items()
+            for obj in objs
+        }
+        values.discard(None)
+        if not values:
+            found = {}
+        elif model in snapshots and to_field == model._meta.pk.attname:
+            found = snapshots[model](values)
+        else:
+            found = model._base_manager.db_manager(db).in_bulk(values, field_name=to_field)
+        for field, objs in pending.items():
+            for obj in objs:
+                field.set_cached_value(obj, found.get(getattr(obj, field.attname)))
+
+    for field in fields:
+        rest = tree[field.name]
+        if not rest:
+            continue
+        if _is_forward(field):
+            related = [getattr(obj, field.name) for obj in instances]
+        else:
+            related = [rel for obj in instances for rel in getattr(obj, field.name).all()]
+        prefetch_across(related, *rest)
+    return instances
+
+
+class CrossDatabaseQuerySet(models.QuerySet):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._prefetch_across_lookups = ()
+        self._prefetch_across_done = False
+
+    def prefetch_across(self, *lookups):
+        clone = self._chain()
+        if lookups == (None,):
+            clone._prefetch_across_lookups = ()
+        else:
+            clone._prefetch_across_lookups = clone._prefetch_across_lookups + lookups
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._prefetch_across_lookups = self._prefetch_across_lookups
+        return clone
+
+    def _fetch_all(self):
+        super()._fetch_all()
+        if (self._prefetch_across_lookups and not self._prefetch_across_done
+                and issubclass(self._iterable_class, ModelIterable)):
+            prefetch_across(self._result_cache, *self._prefetch_across_lookups)
+            self._prefetch_across_done = True
+
+
+class ShardedQuerySet(CrossDatabaseQuerySet):
+    # For the order data spread over ORDER_SHARDS: for_user() gives the
+    # router a user=... hint, so reads and writes find the user's shard (or
+    # one of its replicas) without naming a database
+    def for_user(self, user):
+        clone = self._chain()
+        clone._hints = {**clone._hints, 'user': user}
+        return clone
@@ -0,0 +1,118 @@
+from django.db import transaction
+from django.db.models import Q
+
+from routers import shards
+
+from .cart import invalidate_cart
+from .models import Job, Order, OrderItem, OrderItems, Payment, Refund, UserShard
+from .payments import PENDING_PREFIX
+from .services import user_lock
+
+
+class ShardMoveError(Exception):
+    pass
+
+
+def copy_row(obj, target, **changes):
+    # Inserts ``obj`` on ``target`` under a new primary key and returns it;
+    # auto_now_add fields are restamped on insert, so they are put back after
+    model = type(obj)
+    stamps = {
+        field.attname: getattr(obj, field.attname)
+        for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now_add', False)
+    }
+    obj.pk = None
+    obj._state.adding = True
+    for name, value in changes.items():
+        setattr(obj, name, value)
+    obj.save(using=target, force_insert=True)
+    if stamps:
+        model.objects.using(target).filter(pk=obj.pk).update(**stamps)
+    return obj.pk
+
+
+def move_user(user_id, target):
+    """
+    Move every order, line, payment and refund of a user to the ``target``
+    shard and point the shard map at it. The move holds the user's cart
+    lock (services.user_lock), so cart writes wait until it is done and
+    then go to the new shard. Returns the number of orders moved.
+    """
+    if target not in shards.order_shards():
+        raise ShardMoveError(f'{target} is not one of the ORDER_SHARDS')
+    with user_lock(user_id) as source:
+        if source != target:
+            # jobs and payment attempts in flight refer to rows by their old keys
+            pending = Job.objects.using(source).filter(
+                payload__user_id=user_id, status__in=['queued', 'running'])
+            if pending.exists():
+                raise ShardMoveError(f'User {user_id} still has jobs queued on {source}')
+            paying = Payment.objects.using(source).filter(
+                user_id=user_id, stripe_charge_id__startswith=PENDING_PREFIX)
+            if paying.exists():
+                raise ShardMoveError(f'User {user_id} has a payment in progress')
+            orders = copy_orders(user_id, source, target)
+        else:
+            orders = []
+
+        # written under the lock, so it is committed before any waiting
+        # write reads it
+        if target == shards.hashed_shard(user_id):
+            UserShard.objects.filter(user_id=user_id).delete()
+        else:
+            UserShard.objects.update_or_create(user_id=user_id, defaults={'shard': target})
+    shards.forget_shard(user_id)
+    invalidate_cart(user_id)
+    return len(orders)
+
+
+def copy_orders(user_id, source, target):
+    # returns the orders moved from ``source`` to ``target``
+    with transaction.atomic(using=source), transaction.atomic(using=target):
+        orders = list(Order.objects.using(source).select_for_update().filter(
+            user_id=user_id).order_by('pk'))
+        order_ids = [order.pk for order in orders]
+        lines = list(OrderItem.objects.using(source).filter(user_id=user_id))
+        links = list(OrderItems.objects.using(source).filter(order_id__in=order_ids))
+        payments = list(Payment.objects.using(source).filter(
+            Q(user_id=user_id) | Q(pk__in=[order.payment_id for order in orders if order.payment_id])))
+        payment_ids = [payment.pk for payment in payments]
+        refunds = list(Refund.objects.using(source).filter(order_id__in=order_ids))
+
+        # keys are reassigned on the target, so references are remapped
+        new_payment = {payment.pk: copy_row(payment, target) for payment in payments}
+        new_order = {
+            order.pk: copy_row(order, target, payment_id=new_payment.get(order.payment_id))
+            for order in orders
+        }
+        new_line = {line.pk: copy_row(line, target) for line in lines}
+        OrderItems.objects.using(target).bulk_create([
+            OrderItems(order_id=new_order[link.order_id], orderitem_id=new_line[link.orderitem_id])
+            for link in links
+            if link.orderitem_id in new_line
+        ])
+        for refund in refunds:
+            copy_row(refund, target, order_id=new_order[refund.order_id])
+
+        Refund.objects.using(source).filter(order_id__in=order_ids).delete()
+        OrderItems.objects.using(source).filter(order_id__in=order_ids).delete()
+        OrderItem.objects.using(source).filter(pk__in=[line.pk for line in lines]).delete()
+        Order.objects.using(source).filter(pk__in=order_ids).delete()
+        Payment.objects.using(source).filter(pk__in=payment_ids).delete()
+    return orders
+
+
+def pin_users():
+    """
+    Record where every user with orders is now, so that changing
+    ORDER_SHARDS leaves them in place until they are moved one by one.
+    Returns the number of users pinned.
+    """
+    pinned = 0
+    for db in shards.order_shards():
+        user_ids = set(Order.objects.using(db).values_list('user_id', flat=True).distinct())
+        for user_id in user_ids:
+            UserShard.objects.update_or_create(user_id=user_id, defaults={'shard': db})
+        pinned += len(user_ids)
+    return pinned
@@ -0,0 +1,34 @@
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.http import base36_to_int, int_to_base36
+
+from routers import replicas, shards
+
+# An order reference is the base 36 index of the order's shard in
+# ORDER_SHARDS, the base 36 order id and a keyed checksum, e.g. 1ft3k8d2qs9x:
+# unique without a lookup, and decoded back to the row without a scan.
+# ORDER_SHARDS may only be appended to once codes have been handed out, and
+# holds at most 36 shards.
+CHECK_LENGTH = 8
+
+
+def checksum(body):
+    digest = int(salted_hmac('core.refcodes', body).hexdigest(), 16)
+    return int_to_base36(digest)[-CHECK_LENGTH:].rjust(CHECK_LENGTH, '0')
+
+
+def create_ref_code(order):
+    shard = shards.order_shards().index(replicas.primary_of(order._state.db))
+    body = int_to_base36(shard) + int_to_base36(order.pk)
+    return body + checksum(body)
+
+
+def decode_ref_code(code):
+    # (shard, order id), or None for a code that was not made here
+    code = (code or '').strip().lower()
+    body, check = code[:-CHECK_LENGTH], code[-CHECK_LENGTH:]
+    if len(body) < 2 or not constant_time_compare(check, checksum(body)):
+        return None
+    try:
+        return shards.order_shards()[base36_to_int(body[0])], base36_to_int(body[1:])
+    except (ValueError, IndexError):
+        return None
@@ -0,0 +1,157 @@
+import re
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import Case, IntegerField, Q, When
+
+from .models import CATEGORY_CHOICES, Item
+
+FTS_TABLE = 'core_item_fts'
+SEARCH_MAX_RESULTS = getattr(settings, 'SEARCH_MAX_RESULTS', 200)
+
+TERM_RE = re.compile(r'\w+')
+
+
+def search_terms(query):
+    return TERM_RE.findall(query.lower())
+
+
+def matching_categories(terms):
+    # category is stored as a code, so its display name is matched here
+    return [
+        code for code, name in CATEGORY_CHOICES
+        if any(word.startswith(term) for term in terms for word in name.lower().split())
+    ]
+
+
+class SearchBackend:
+    # Indexes title, description and category name of every Item and returns
+    # ranked ids; index() and remove() are called from the Item signals.
+    # Databases without a full-text index keep the old LIKE scan.
+    def __init__(self, alias):
+        self.alias = alias
+
+    def index(self, item):
+        pass
+
+    def remove(self, item_id):
+        pass
+
+    def rebuild(self):
+        # True when there was an index to rebuild
+        return False
+
+    def search(self, terms):
+        query = Q()
+        for term in terms:
+            query |= Q(title__icontains=term) | Q(description__icontains=term)
+        query |= Q(category__in=matching_categories(terms))
+        return list(Item.objects.using(self.alias).filter(query).values_list(
+            'id', flat=True)[:SEARCH_MAX_RESULTS])
+
+
+class MySQLFullTextBackend(SearchBackend):
+    # InnoDB keeps the FULLTEXT index from migration 0003 in sync by itself;
+    # every term is matched as a prefix and categories add to the score
+    def rebuild(self):
+        # rebuilds the table and with it the FULLTEXT index, dropping the
+        # entries of deleted rows that InnoDB keeps until then
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute('OPTIMIZE TABLE core_item')
+            cursor.fetchall()
+        return True
+
+    def search(self, terms):
+        against = ' '.join(f'{term}*' for term in terms)
+        categories = matching_categories(terms)
+        if categories:
+            category_sql = f"category IN ({', '.join(['%s'] * len(categories))})"
+        else:
+            category_sql = 'FALSE'
+        sql = f"""
+            SELECT id,
+                   MATCH(title, description) AGAINST (%s IN BOOLEAN MODE)
+                   + ({category_sql}) AS score
+            FROM core_item
+            WHERE MATCH(title, description) AGAINST (%s IN BOOLEAN MODE)
+               OR {category_sql}
+            ORDER BY score DESC, id
+            LIMIT %s
+        """
+        params = [against, *categories, against, *categories, SEARCH_MAX_RESULTS]
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+
+class SQLiteFTSBackend(SearchBackend):
+    # FTS5 table next to core_item, keyed by rowid = item id and ranked by
+    # bm25; all terms must match, each as a prefix
+    def index(self, item):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [item.pk])
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, title, description, category) '
+                f'VALUES (%s, %s, %s, %s)',
+                [item.pk, item.title, item.description, item.get_category_display()]
+            )
+
+    def remove(self, item_id):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [item_id])
+
+    def rebuild(self):
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+        for item in Item.objects.using(self.alias).iterator():
+            self.index(item)
+        return True
+
+    def search(self, terms):
+        match = ' '.join(f'"{term}"*' for term in terms)
+        with connections[self.alias].cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s '
+                f'ORDER BY bm25({FTS_TABLE}) LIMIT %s',
+                [match, SEARCH_MAX_RESULTS]
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+_backends = {}
+
+
+def get_backend():
+    alias = router.db_for_write(Item)
+    if alias not in _backends:
+        connection = connections[alias]
+        if connection.vendor == 'mysql':
+            _backends[alias] = MySQLFullTextBackend(alias)
+        elif connection.vendor == 'sqlite' and FTS_TABLE in connection.introspection.table_names():
+            _backends[alias] = SQLiteFTSBackend(alias)
+        else:
+            _backends[alias] = SearchBackend(alias)
+    return _backends[alias]
+
+
+def search_items(query):
+    # Items matching ``query``, best match first
+    terms = search_terms(query)
+    if not terms:
+        return Item.objects.none()
+    ids = get_backend().search(terms)
+    if not ids:
+        return Item.objects.none()
+    ranking = Case(
+        *[When(pk=pk, then=position) for position, pk in enumerate(ids)],
+        output_field=IntegerField()
+    )
+    return Item.objects.filter(pk__in=ids).order_by(ranking)
+
+
+def index_item(sender, instance, **kwargs):
+    get_backend().index(instance)
+
+
+def remove_item(sender, instance, **kwargs):
+    get_backend().remove(instance.pk)
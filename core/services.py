@@ -0,0 +1,336 @@
+from contextlib import contextmanager
+
+from django.db import connections, router, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from routers import replicas, shards
+
+from .cart import SessionCart, invalidate_cart
+from .catalogue import snapshot
+from .models import Address, Order, OrderItem, OrderItems, UserProfile, address_hash
+from .money import ZERO, money, price_snapshot
+
+
+def open_order_lines(db, user_id):
+    # scoped through CORE_ORDER_ITEMS so lines left on a paid order are never
+    # picked up by the cart again
+    return OrderItem.objects.using(db).filter(
+        user_id=user_id,
+        ordered=False,
+        order__ordered=False
+    )
+
+
+@contextmanager
+def user_lock(user_id):
+    """
+    Run the block holding a FOR UPDATE lock on the user's UserProfile row
+    and return the user's shard as the database has it under that lock.
+    Cart writes take it before they touch the order database (add_item()
+    only when the user has no open order to lock): the row exists before
+    the user's first order does, so two first adds cannot both find no
+    open order and both create one, and a write that waited for
+    rebalance_orders to move the user goes to the new shard, whatever the
+    cached shard map says.
+    """
+    db = router.db_for_write(UserProfile)
+    profiles = UserProfile.objects.using(db).select_for_update().filter(user_id=user_id)
+    with transaction.atomic(using=db):
+        if not list(profiles.values_list('pk', flat=True)):
+            # a user created without the post_save receiver, e.g. in bulk
+            UserProfile.objects.using(db).get_or_create(user_id=user_id)
+            list(profiles.values_list('pk', flat=True))
+        shard = shards.stored_shard(user_id)
+        shards.remember_shard(user_id, shard)
+        yield shard
+
+
+def locked_open_orders(db, user_id):
+    # FOR UPDATE on the open order serialises concurrent changes to the same
+    # cart; no LIMIT because Oracle rejects FETCH FIRST with FOR UPDATE
+    return list(Order.objects.using(db).select_for_update().filter(
+        user_id=user_id,
+        ordered=False
+    ))
+
+
+def lock_open_order(db, user_id):
+    # callers hold user_lock(), so no one else creates the order meanwhile
+    orders = locked_open_orders(db, user_id)
+    if orders:
+        return orders[0]
+    return Order.objects.using(db).create(
+        user_id=user_id,
+        ordered_date=timezone.now()
+    )
+
+
+def change_totals(db, order_id, changes):
+    """
+    Add (quantity change, unit price, list price) line changes to the stored
+    totals of an order with a single UPDATE.
+    """
+    subtotal = sum((quantity * unit for quantity, unit, listed in changes), ZERO)
+    discount = sum((quantity * (listed - unit) for quantity, unit, listed in changes), ZERO)
+    if subtotal or discount:
+        Order.objects.using(db).filter(pk=order_id).update(
+            subtotal=F('subtotal') + subtotal,
+            discount=F('discount') + discount,
+            total=F('total') + subtotal
+        )
+
+
+def add_to_open_order(db, user_id, item, quantity):
+    """
+    Add ``quantity`` of an item to the user's open order on ``db``: two
+    UPDATEs when the item already has a line there, and a lookup of the
+    order and two INSERTs more when it does not. Returns True if a line was
+    created, False if one was incremented, and None, having written
+    nothing, when the user has no open order on ``db``.
+    """
+    amount = DecimalField(max_digits=10, decimal_places=2)
+    unit_price, list_price = price_snapshot(item)
+    lines = open_order_lines(db, user_id).filter(item_id=item.id)
+    # the prices frozen on the line, else those a new line gets; a line
+    # from before prices were frozen is charged the current ones
+    unit = Coalesce(Subquery(lines.values('unit_price')[:1]), Value(unit_price), output_field=amount)
+    listed = Coalesce(Subquery(lines.values('list_price')[:1]), Value(list_price), output_field=amount)
+    added = ExpressionWrapper(Value(quantity) * unit, output_field=amount)
+    # the totals first: the UPDATE locks the open order row, which
+    # serialises this with the other writes to the cart and with a move
+    # of the user (rebalance.copy_orders locks the same row)
+    orders = Order.objects.using(db).filter(user_id=user_id, ordered=False)
+    if not orders.update(
+        subtotal=F('subtotal') + added,
+        discount=F('discount') + ExpressionWrapper(Value(quantity) * (listed - unit), output_field=amount),
+        total=F('total') + added
+    ):
+        return None
+    if lines.update(quantity=F('quantity') + quantity):
+        return False
+    order_item = OrderItem.objects.using(db).create(
+        user_id=user_id,
+        item_id=item.id,
+        quantity=quantity,
+        unit_price=unit_price,
+        list_price=list_price
+    )
+    OrderItems.objects.using(db).create(order_id=orders.values_list('pk', flat=True)[0], orderitem=order_item)
+    return True
+
+
+def add_item(user_id, item, quantity=1):
+    """
+    Add ``quantity`` of an item to the user's open order and return True if
+    a new line was created, False if an existing line was incremented.
+    """
+    # the common case, an open order on the cached shard, takes no user lock
+    db = shards.order_db(user_id, write=True)
+    with transaction.atomic(using=db):
+        created = add_to_open_order(db, user_id, item, quantity)
+    if created is None:
+        # there is no order row to lock yet; the user lock keeps a second
+        # first add from creating another open order, and finds the user's
+        # shard if they were moved meanwhile
+        with user_lock(user_id) as db, transaction.atomic(using=db):
+            created = add_to_open_order(db, user_id, item, quantity)
+            if created is None:
+                unit_price, list_price = price_snapshot(item)
+                order = Order.objects.using(db).create(
+                    user_id=user_id,
+                    ordered_date=timezone.now(),
+                    subtotal=quantity * unit_price,
+                    discount=quantity * (list_price - unit_price),
+                    total=quantity * unit_price
+                )
+                order_item = OrderItem.objects.using(db).create(
+                    user_id=user_id,
+                    item_id=item.id,
+                    quantity=quantity,
+                    unit_price=unit_price,
+                    list_price=list_price
+                )
+                OrderItems.objects.using(db).create(order=order, orderitem=order_item)
+                created = True
+    invalidate_cart(user_id)
+    return created
+
+
+def remove_item(user_id, item, quantity=None):
+    """
+    Take ``quantity`` of an item (the whole line when None) out of the
+    user's open order. Returns the quantity left on the line, or None when
+    the item is not in the cart; raises Order.DoesNotExist without an open
+    order.
+    """
+    with user_lock(user_id) as db, transaction.atomic(using=db):
+        orders = locked_open_orders(db, user_id)
+        if not orders:
+            raise Order.DoesNotExist
+        line = open_order_lines(db, user_id).filter(item_id=item.id).first()
+        if line is None:
+            return None
+        removed = line.quantity if quantity is None else min(quantity, line.quantity)
+        if removed < line.quantity:
+            OrderItem.objects.using(db).filter(pk=line.pk).update(
+                quantity=F('quantity') - removed)
+        else:
+            OrderItems.objects.using(db).filter(orderitem=line).delete()
+            OrderItem.objects.using(db).filter(pk=line.pk).delete()
+        unit_price, list_price = line.unit_price, line.list_price
+        if unit_price is None:
+            unit_price, list_price = price_snapshot(item)
+        change_totals(db, orders[0].pk, [(-removed, unit_price, list_price)])
+    invalidate_cart(user_id)
+    return line.quantity - removed
+
+
+def apply_coupon(order, coupon):
+    # the grand total is the subtotal less the coupon, worked out in the UPDATE
+    db = router.db_for_write(Order, instance=order)
+    amount = money(coupon.amount)
+    Order.objects.using(db).filter(pk=order.pk).update(
+        coupon=coupon,
+        coupon_amount=amount,
+        total=F('subtotal') - amount
+    )
+    invalidate_cart(order.user_id)
+
+
+def recompute_totals(orders):
+    """
+    Rewrite the stored totals of ``orders`` from their lines with
+    Order.objects.cart_totals(), e.g. after prices were corrected by hand.
+    Returns how many orders had drifted.
+    """
+    # the primary of whichever shard the queryset reads
+    db = replicas.primary_of(orders.db)
+    orders = orders.using(db)
+    drifted = []
+    with transaction.atomic(using=db):
+        stored = list(orders.select_for_update().values_list(
+            'pk', 'user_id', 'subtotal', 'discount'))
+        totals = orders.cart_totals()
+        for order_id, user_id, subtotal, discount in stored:
+            fresh = totals.get(order_id, (ZERO, ZERO))
+            if fresh == (subtotal, discount):
+                continue
+            Order.objects.using(db).filter(pk=order_id).update(
+                subtotal=fresh[0],
+                discount=fresh[1],
+                total=fresh[0] - F('coupon_amount')
+            )
+            drifted.append(user_id)
+    for user_id in drifted:
+        invalidate_cart(user_id)
+    return len(drifted)
+
+
+def set_quantities(user_id, quantities):
+    """
+    Apply {item id: quantity} to the user's open order in one transaction;
+    a quantity of 0 removes the line. Returns the open order, or None when
+    there is nothing to update.
+    """
+    with user_lock(user_id) as db, transaction.atomic(using=db):
+        if not any(quantities.values()) and not open_order_lines(db, user_id).exists():
+            return None
+        order = lock_open_order(db, user_id)
+        lines = {
+            line.item_id: line
+            for line in open_order_lines(db, user_id).filter(item_id__in=quantities)
+        }
+
+        # from the catalogue snapshot: the items of new lines, and of lines
+        # from before prices were frozen on them
+        wanted = [
+            item_id for item_id, quantity in quantities.items()
+            if (item_id not in lines and quantity > 0)
+            or (item_id in lines and lines[item_id].unit_price is None)
+        ]
+        items = snapshot.in_bulk(wanted) if wanted else {}
+
+        changed, removed, added, totals = [], [], [], []
+        for item_id, quantity in quantities.items():
+            line = lines.get(item_id)
+            if line is None:
+                if quantity > 0 and item_id in items:
+                    unit_price, list_price = price_snapshot(items[item_id])
+                    added.append(OrderItem(
+                        user_id=user_id,
+                        item_id=item_id,
+                        quantity=quantity,
+                        unit_price=unit_price,
+                        list_price=list_price
+                    ))
+                    totals.append((quantity, unit_price, list_price))
+                continue
+            unit_price, list_price = line.unit_price, line.list_price
+            if unit_price is None:
+                unit_price, list_price = price_snapshot(items[item_id])
+            if quantity <= 0:
+                removed.append(line.id)
+                totals.append((-line.quantity, unit_price, list_price))
+            elif quantity != line.quantity:
+                totals.append((quantity - line.quantity, unit_price, list_price))
+                line.quantity = quantity
+                changed.append(line)
+
+        if changed:
+            OrderItem.objects.using(db).bulk_update(changed, ['quantity'])
+        if removed:
+            OrderItems.objects.using(db).filter(order=order, orderitem_id__in=removed).delete()
+            OrderItem.objects.using(db).filter(id__in=removed).delete()
+        if added:
+            if connections[db].features.can_return_rows_from_bulk_insert:
+                added = OrderItem.objects.using(db).bulk_create(added)
+            else:
+                for order_item in added:
+                    order_item.save(using=db)
+            OrderItems.objects.using(db).bulk_create([
+                OrderItems(order=order, orderitem=order_item) for order_item in added
+            ])
+        change_totals(db, order.pk, totals)
+    invalidate_cart(user_id)
+    return order
+
+
+def save_address(user, address_type, street_address, apartment_address, country, zip, default=False):
+    """
+    Return the user's address of this type with the same content, creating
+    it if there is none, and make it the default of its type if asked to.
+    """
+    content_hash = address_hash(street_address, apartment_address, country, zip)
+    with transaction.atomic(using=router.db_for_write(Address)):
+        address, created = Address.objects.get_or_create(
+            user=user,
+            address_type=address_type,
+            content_hash=content_hash,
+            defaults={
+                'street_address': street_address,
+                'apartment_address': apartment_address,
+                'country': country,
+                'zip': zip,
+                'default': default
+            }
+        )
+        if default:
+            Address.objects.filter(user=user, address_type=address_type, default=True).exclude(
+                pk=address.pk).update(default=False)
+            if not address.default:
+                address.default = True
+                address.save(update_fields=['default'])
+    return address
+
+
+def merge_session_cart(sender, request, user, **kwargs):
+    # user_logged_in receiver: a guest cart is added on top of whatever open
+    # order the user already has
+    session_cart = SessionCart(request.session)
+    items = snapshot.in_bulk([int(item_id) for item_id in session_cart.lines])
+    for item_id, quantity in session_cart.lines.items():
+        if int(item_id) in items:
+            add_item(user.id, items[int(item_id)], quantity)
+    session_cart.clear()
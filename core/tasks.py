@@ -0,0 +1,42 @@
+from django.core.mail import send_mail
+from django.db import router, transaction
+
+from .jobs import job
+from .models import Order, Refund
+
+
+@job('finalise_order')
+def finalise_order(order_id, user_id=None):
+    # The payment request has already marked the order paid; its lines are
+    # no longer part of any cart, so flagging them can wait for the worker
+    order = Order.objects.using(router.db_for_write(Order, user=user_id)).get(pk=order_id)
+    order.items.filter(ordered=False).update(ordered=True)
+
+
+@job('send_order_confirmation')
+def send_order_confirmation(order_id, user_id=None):
+    # at-least-once: a worker dying after send_mail sends a second copy
+    order = Order.objects.using(router.db_for_read(Order, user=user_id)).prefetch_across(
+        'user', 'items__item').get(pk=order_id)
+    if not order.user or not order.user.email:
+        return
+    lines = '\n'.join(
+        f'{order_item.quantity} x {order_item.item.title}: ${order_item.get_final_price():.2f}'
+        for order_item in order.cart.items
+    )
+    send_mail(
+        f'Your order {order.ref_code}',
+        f'Thank you for your order.\n\n{lines}\n\n'
+        f'Total: ${order.get_total():.2f}\n'
+        f'Reference code: {order.ref_code}\n',
+        None,
+        [order.user.email]
+    )
+
+
+@job('record_refund_request')
+def record_refund_request(order_id, reason, email, user_id=None):
+    db = router.db_for_write(Refund, user=user_id)
+    with transaction.atomic(using=db):
+        Order.objects.using(db).filter(pk=order_id).update(refund_requested=True)
+        Refund.objects.using(db).get_or_create(order_id=order_id, reason=reason, email=email)
@@ -1,25 +1,10 @@
-# from django import template
-# from core.models import Order
-
-# register = template.Library()
-
-
-# @register.filter
-# def cart_item_count(user):
-#     if user.is_authenticated:
-#         qs = Order.objects.filter(user=user, ordered=False)
-#         if qs.exists():
-#             return qs[0].items.count()
-#     return 0
 from django import template
-from core.models import Order
+from core.cart import SessionCart, get_cached_cart
 
 register = template.Library()
 
 @register.filter
-def cart_item_count(user):
-    if user.is_authenticated:
-        qs = Order.objects.using('other_db').filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-    return 0
\ No newline at end of file
+def cart_item_count(request):
+    if request.user.is_authenticated:
+        return get_cached_cart(request.user.id)['count']
+    return len(SessionCart(request.session))
\ No newline at end of file
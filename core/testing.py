@@ -0,0 +1,105 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import stripe
+from django.db import connections
+
+from routers import shards
+
+from .models import Coupon, Order, OrderItem, OrderItems, Payment
+
+# Tables that live in the Oracle schema and are not created by migrate.
+UNMANAGED_ORDER_MODELS = [Order, OrderItem, OrderItems, Payment, Coupon]
+
+
+def create_unmanaged_tables(using=None):
+    # migrate never creates managed = False tables, and 0001 left an early
+    # CORE_ORDERITEM with a foreign key to core_item, which does not exist
+    # on this alias, so the tables are rebuilt from the current models on
+    # every order shard
+    for alias in [using] if using else shards.order_shards():
+        connection = connections[alias]
+        existing = {name.lower() for name in connection.introspection.table_names()}
+        with connection.schema_editor() as schema_editor:
+            for model in UNMANAGED_ORDER_MODELS:
+                if model._meta.db_table.lower() in existing:
+                    schema_editor.delete_model(model)
+                schema_editor.create_model(model)
+
+
+class FakeStripe:
+    """
+    A local stand-in for the Stripe API, for tests and the benchmark.
+    Answers customers, sources and charges, replays responses for a
+    repeated Idempotency-Key like Stripe does and declines the
+    tok_chargeDeclined test token.
+    """
+    def __init__(self):
+        self.requests = []
+        self.responses = {}
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                params = dict(parse_qsl(self.rfile.read(length).decode()))
+                status, body = fake.respond(self.path, params, self.headers.get('Idempotency-Key'))
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def respond(self, path, params, key):
+        with self.lock:
+            if key and key in self.responses:
+                return self.responses[key]
+            self.requests.append((path, params, key))
+            number = len(self.requests)
+            if path == '/v1/customers':
+                response = 200, {'id': f'cus_{number}', 'object': 'customer'}
+            elif path.startswith('/v1/customers/') and path.endswith('/sources'):
+                response = 200, {'id': f'card_{number}', 'object': 'card'}
+            elif path == '/v1/charges' and params.get('source') == 'tok_chargeDeclined':
+                response = 402, {'error': {
+                    'type': 'card_error',
+                    'code': 'card_declined',
+                    'message': 'Your card was declined.',
+                }}
+            elif path == '/v1/charges':
+                response = 200, {
+                    'id': f'ch_{number}',
+                    'object': 'charge',
+                    'amount': int(params.get('amount', 0)),
+                    'paid': True,
+                    'status': 'succeeded',
+                }
+            else:
+                response = 404, {'error': {'type': 'invalid_request_error', 'message': path}}
+            if key:
+                self.responses[key] = response
+            return response
+
+    def charges(self):
+        return [request for request in self.requests if request[0] == '/v1/charges']
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.api_base = stripe.api_base
+        stripe.api_base = self.url
+        return self
+
+    def __exit__(self, *exc_info):
+        stripe.api_base = self.api_base
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,3 +1,1071 @@
-from django.test import TestCase
+import json
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import stripe
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connections, router, transaction
+from django.db.models.signals import post_delete
+from django.utils import timezone
+from django.http import Http404, HttpResponse
+from django.shortcuts import resolve_url
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.urls import path
+from django.utils.http import int_to_base36
+
+from routers import replicas, shards
+from routers.context import routing
+from routers.shards import hashed_shard, home_shard, order_db, order_shards
+
+from . import jobs, page_cache, payments, querysets, search, services
+from .cart import cart_cache_key, cart_version, cart_version_key, get_cached_cart
+from .catalogue import snapshot, warm_catalogue
+from .indexes import INDEXED_MODELS, advise
+from .middleware import QueryBudgetExceeded, query_budget
+from .models import Address, Coupon, Item, ItemChange, Job, Order, OrderItem, OrderItems, Payment, UserProfile, UserShard
+from .pagination import KeysetPaginator, encode_cursor
+from .pooling import configure_pools, pool_metrics, pool_stats
+from .rebalance import move_user
+from .refcodes import CHECK_LENGTH, decode_ref_code
+from .testing import FakeStripe, create_unmanaged_tables
+from .views import find_order
+
+
+@contextmanager
+def recorded_queries():
+    # {alias: [sql, ...]} for the statements run on every database in the block
+    queries = defaultdict(list)
+
+    def recorder(alias):
+        def record(execute, sql, params, many, context):
+            queries[alias].append(sql)
+            return execute(sql, params, many, context)
+        return record
+
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(recorder(alias)))
+        yield queries
+
+
+class OrderDatabaseTestCase(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        create_unmanaged_tables()
+        # the flush between tests bypasses the ItemChange log and the
+        # UserShard signals
+        snapshot.reset()
+        cache.clear()
+        self.user = User.objects.create_user('shopper', 'shopper@example.com', 'password')
+        self.db = order_db(self.user, write=True)
+        self.item = Item.objects.create(
+            title='Shirt',
+            price=20.0,
+            discount_price=15.0,
+            category='S',
+            label='P',
+            slug='shirt',
+            description='A shirt',
+            image='shirt.jpg'
+        )
+
+
+class AddItemTests(OrderDatabaseTestCase):
+    def test_add_item_increments_existing_line(self):
+        self.assertTrue(services.add_item(self.user.id, self.item))
+        self.assertFalse(services.add_item(self.user.id, self.item))
+        line = OrderItem.objects.using(self.db).get(user=self.user, item_id=self.item.id)
+        self.assertEqual(line.quantity, 2)
+
+    def test_concurrent_adds_to_the_same_cart(self):
+        workers, adds = 8, 10
+
+        def add(_):
+            try:
+                for _ in range(adds):
+                    services.add_item(self.user.id, self.item)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(add, range(workers)))
+
+        line = OrderItem.objects.using(self.db).get(user=self.user, item_id=self.item.id)
+        self.assertEqual(line.quantity, workers * adds)
+        self.assertEqual(OrderItems.objects.using(self.db).count(), 1)
+        self.assertEqual(Order.objects.using(self.db).get().total, 15 * workers * adds)
+
+
+    def test_cart_writes_wait_for_the_user_lock(self):
+        # the first add for a user has no order row to lock; the user lock
+        # keeps a second first add from creating another open order
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with services.user_lock(self.user.id):
+                adding = executor.submit(services.add_item, self.user.id, self.item)
+                time.sleep(0.2)
+                self.assertFalse(adding.done())
+                services.lock_open_order(self.db, self.user.id)
+            adding.result()
+        self.assertEqual(Order.objects.using(self.db).filter(ordered=False).count(), 1)
+
+
+class OrderTotalsTests(OrderDatabaseTestCase):
+    def assertTotalsMatchLines(self, order):
+        order = Order.objects.using(self.db).prefetch_across('items__item').get(pk=order.pk)
+        self.assertEqual(order.subtotal, order.cart.subtotal)
+        self.assertEqual(order.discount, order.cart.savings)
+        self.assertEqual(order.total, order.cart.total)
+        return order
+
+    def test_totals_follow_cart_changes(self):
+        hat = Item.objects.create(
+            title='Hat', price=10.0, category='SW', label='S',
+            slug='hat', description='A hat', image='hat.jpg'
+        )
+        services.add_item(self.user.id, self.item, 2)
+        services.add_item(self.user.id, hat)
+        order = self.assertTotalsMatchLines(Order.objects.using(self.db).get())
+        self.assertEqual((order.subtotal, order.discount, order.total), (40, 10, 40))
+
+        # prices are frozen on the lines once they are in the cart
+        Item.objects.filter(pk=self.item.pk).update(discount_price=5.0)
+        services.add_item(self.user.id, Item.objects.get(pk=self.item.pk))
+        self.assertEqual(self.assertTotalsMatchLines(order).total, 55)
+
+        self.assertEqual(services.remove_item(self.user.id, self.item, 1), 2)
+        services.set_quantities(self.user.id, {hat.id: 3})
+        self.assertEqual(self.assertTotalsMatchLines(order).total, 60)
+
+        coupon = Coupon.objects.create(code='SAVE5', amount=5.0)
+        services.apply_coupon(order, coupon)
+        order = self.assertTotalsMatchLines(order)
+        self.assertEqual((order.coupon_amount, order.total), (5, 55))
+
+        self.assertEqual(services.remove_item(self.user.id, hat), 0)
+        self.assertEqual(self.assertTotalsMatchLines(order).total, 25)
+
+    def test_prices_add_up_to_the_cent(self):
+        pen = Item.objects.create(
+            title='Pen', price='0.10', category='OW', label='D',
+            slug='pen', description='A pen', image='pen.jpg'
+        )
+        services.add_item(self.user.id, pen, 3)
+        order = self.assertTotalsMatchLines(Order.objects.using(self.db).get())
+        self.assertEqual(str(order.total), '0.30')
+        self.assertEqual(order.cart.as_dict()['items'][0]['price'], Decimal('0.30'))
+
+    def test_recompute_totals_from_the_lines(self):
+        hat = Item.objects.create(
+            title='Hat', price=10.0, category='SW', label='S',
+            slug='hat', description='A hat', image='hat.jpg'
+        )
+        services.add_item(self.user.id, self.item, 2)
+        services.add_item(self.user.id, hat)
+        # a line without a snapshot is priced from the item database
+        OrderItem.objects.using(self.db).filter(item_id=hat.id).update(unit_price=None, list_price=None)
+        Order.objects.using(self.db).update(subtotal=0, discount=0, total=0)
+
+        orders = Order.objects.using(self.db)
+        self.assertEqual(orders.cart_totals(), {orders.get().pk: (40, 10)})
+        self.assertEqual(services.recompute_totals(orders), 1)
+        self.assertEqual(services.recompute_totals(orders), 0)
+        self.assertTotalsMatchLines(orders.get())
+
+
+class PrefetchAcrossTests(OrderDatabaseTestCase):
+    def test_one_query_per_target_database(self):
+        hat = Item.objects.create(title='Hat', price=10.0, category='SW', label='S', slug='hat',
+                                  description='A hat', image='hat.jpg')
+        other = User.objects.create_user('other')
+        UserShard.objects.create(user=other, shard=self.db)
+        for user in (self.user, other):
+            services.add_item(user.id, self.item)
+            services.add_item(user.id, hat)
+        coupon = Coupon.objects.using(home_shard()).create(code='SAVE5', amount=5.0)
+        Order.objects.using(self.db).filter(user=self.user).update(coupon=coupon)
+
+        # the items from their database rather than the catalogue snapshot
+        with mock.patch.dict(querysets.snapshots, clear=True), recorded_queries() as queries:
+            orders = list(Order.objects.using(self.db).order_by('user_id').prefetch_across(
+                'user', 'coupon', 'items__item'))
+            self.assertEqual([order.user for order in orders], [self.user, other])
+            self.assertEqual([order.coupon for order in orders], [coupon, None])
+            self.assertEqual(
+                [sorted(line.item.slug for line in order.items.all()) for order in orders],
+                [['hat', 'shirt'], ['hat', 'shirt']])
+        counts = Counter({alias: len(statements) for alias, statements in queries.items() if statements})
+        # the orders and their lines, the users, the coupons and the items
+        self.assertEqual(counts, Counter({self.db: 2, 'default': 1}) + Counter([
+            router.db_for_read(Coupon), router.db_for_read(Item)]))
+
+    def test_null_and_missing_relations_are_cached_as_none(self):
+        services.add_item(self.user.id, self.item)
+        # a line whose item has since been deleted from the catalogue
+        OrderItem.objects.using(self.db).update(item_id=self.item.pk + 100)
+        order = Order.objects.using(self.db).prefetch_across('coupon', 'items__item').get()
+        with recorded_queries() as queries:
+            self.assertIsNone(order.coupon)
+            [line] = order.items.all()
+            self.assertIsNone(OrderItem.item.field.get_cached_value(line))
+            self.assertEqual(order.cart.items, [])
+        self.assertFalse(any(queries.values()))
+
+
+class UpdateCartTests(OrderDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.hat, self.cap = [
+            Item.objects.create(title=slug.title(), price=price, category='SW', label='S',
+                                slug=slug, description=f'A {slug}', image=f'{slug}.jpg')
+            for slug, price in (('hat', 10.0), ('cap', 8.0))
+        ]
+
+    def update(self, *changes, body=None):
+        if body is None:
+            body = json.dumps({'changes': [{'slug': slug, 'quantity': quantity} for slug, quantity in changes]})
+        return self.client.post('/update-cart/', body, content_type='application/json')
+
+    def lines(self):
+        # {slug: quantity}; the items are on another database
+        slugs = dict(Item.objects.values_list('id', 'slug'))
+        return {
+            slugs[item_id]: quantity
+            for item_id, quantity in OrderItem.objects.using(self.db).values_list('item_id', 'quantity')
+        }
+
+    def test_changes_are_applied_together(self):
+        services.add_item(self.user.id, self.item, 2)
+        services.add_item(self.user.id, self.hat)
+        self.client.force_login(self.user)
+        response = self.update(('shirt', 3), ('hat', 0), ('cap', 2))
+
+        self.assertEqual(response.status_code, 200)
+        cart = response.json()
+        self.assertEqual(sorted((line['slug'], line['quantity']) for line in cart['items']),
+                         [('cap', 2), ('shirt', 3)])
+        self.assertEqual((cart['subtotal'], cart['savings'], cart['total']), ('61.00', '15.00', '61.00'))
+        self.assertEqual(self.lines(), {'shirt': 3, 'cap': 2})
+        order = Order.objects.using(self.db).get()
+        self.assertEqual((order.subtotal, order.discount), (61, 15))
+        self.assertEqual(OrderItems.objects.using(self.db).filter(order=order).count(), 2)
+
+    def test_new_lines_are_inserted_in_bulk(self):
+        self.client.force_login(self.user)
+        with recorded_queries() as queries:
+            self.assertEqual(self.update(('hat', 1), ('cap', 1)).status_code, 200)
+        inserts = [sql for sql in queries[self.db] if sql.startswith('INSERT INTO "CORE_ORDERITEM"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(self.lines(), {'hat': 1, 'cap': 1})
+
+    def test_quantity_zero_does_not_add_a_line(self):
+        self.client.force_login(self.user)
+        response = self.update(('hat', 0))
+        self.assertEqual(response.json()['items'], [])
+        self.assertFalse(Order.objects.using(self.db).exists())
+
+    def test_invalid_updates_are_rejected(self):
+        services.add_item(self.user.id, self.item)
+        self.client.force_login(self.user)
+        for response in (
+            self.update(('shirt', 2), ('scarf', 1)),
+            self.update(('shirt', -1)),
+            self.update(body='{"changes": [{"slug": "shirt"'),
+            self.update(body='{"changes": [{"slug": "shirt", "quantity": "two"}]}'),
+            self.update(body='[]'),
+        ):
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.update(('scarf', 1)).json()['slugs'], ['scarf'])
+        self.assertEqual(self.lines(), {'shirt': 1})
+
+    def test_guest_updates_the_session(self):
+        self.client.get('/add-to-cart/shirt/')
+        with recorded_queries() as queries:
+            response = self.update(('shirt', 4), ('hat', 1))
+        self.assertEqual(response.json()['quantity'], 5)
+        self.assertEqual(self.client.session['cart'], {str(self.item.pk): 4, str(self.hat.pk): 1})
+        self.assertEqual(self.update(('shirt', 0)).json()['count'], 1)
+        self.assertEqual(queries[self.db] + queries['other_db'], [])
+
+
+class GuestCartTests(OrderDatabaseTestCase):
+    def test_guest_adds_touch_no_order_database(self):
+        with recorded_queries() as queries:
+            self.client.get('/add-to-cart/shirt/')
+            self.client.get('/add-to-cart/shirt/')
+            response = self.client.get('/order-summary/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.session['cart'], {str(self.item.pk): 2})
+        self.assertFalse(set(queries) & {*order_shards(), 'other_db_replica'})
+
+    def test_login_merges_into_the_open_order(self):
+        hat = Item.objects.create(title='Hat', price=10.0, category='SW', label='S', slug='hat',
+                                  description='A hat', image='hat.jpg')
+        services.add_item(self.user.id, self.item)
+        self.client.get('/add-to-cart/shirt/')
+        self.client.get('/add-to-cart/hat/')
+        self.assertTrue(self.client.login(username='shopper', password='password'))
+
+        self.assertNotIn('cart', self.client.session)
+        order = Order.objects.using(self.db).get()
+        lines = dict(OrderItem.objects.using(self.db).values_list('item_id', 'quantity'))
+        self.assertEqual(lines, {self.item.pk: 2, hat.pk: 1})
+        self.assertEqual(OrderItems.objects.using(self.db).filter(order=order).count(), 2)
+        self.assertEqual(order.total, 40)
+
+    def test_checkout_needs_a_login(self):
+        self.client.get('/add-to-cart/shirt/')
+        response = self.client.get('/checkout/')
+        self.assertRedirects(response, f'{resolve_url(settings.LOGIN_URL)}?next=/checkout/',
+                             fetch_redirect_response=False)
+
+
+class CartCacheTests(OrderDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def test_summary_is_cached_until_the_cart_changes(self):
+        self.assertEqual(get_cached_cart(self.user.id)['count'], 0)
+        services.add_item(self.user.id, self.item, 2)
+        with recorded_queries() as queries:
+            self.assertEqual(get_cached_cart(self.user.id), {'count': 1, 'subtotal': 30})
+            self.assertEqual(get_cached_cart(self.user.id)['count'], 1)
+        self.assertEqual(sum(map(len, queries.values())), 1)
+        services.remove_item(self.user.id, self.item)
+        self.assertEqual(get_cached_cart(self.user.id)['count'], 0)
+
+    def test_stale_fill_does_not_outlive_a_write(self):
+        version = cart_version(self.user.id)
+        services.add_item(self.user.id, self.item)
+        # a reader that loaded the empty cart before the write stores it late
+        cache.add(cart_cache_key(self.user.id, version), {'count': 0, 'subtotal': 0})
+        self.assertEqual(get_cached_cart(self.user.id)['count'], 1)
+
+    def test_lost_version_does_not_bring_back_an_old_summary(self):
+        get_cached_cart(self.user.id)
+        cache.delete(cart_version_key(self.user.id))
+        services.add_item(self.user.id, self.item)
+        self.assertEqual(get_cached_cart(self.user.id)['count'], 1)
+
+
+class SearchTests(OrderDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        search._backends.clear()
+        self.addCleanup(search._backends.clear)
+        self.hat = Item.objects.create(
+            title='Hat', price=10.0, category='SW', label='S',
+            slug='hat', description='A woollen hat', image='hat.jpg'
+        )
+
+    def found(self, query):
+        return [item.slug for item in search.search_items(query)]
+
+    def test_backend_follows_the_database(self):
+        backend = search.get_backend()
+        self.assertIsInstance(backend, search.SQLiteFTSBackend)
+        search._backends.clear()
+        connection = connections[backend.alias]
+        with mock.patch.object(connection.introspection, 'table_names', return_value=[]):
+            self.assertIs(type(search.get_backend()), search.SearchBackend)
+
+    def test_scan_search_without_an_index(self):
+        backend = search.SearchBackend('item_db')
+        self.assertEqual(backend.search(['wool']), [self.hat.pk])
+        # categories match by their display name
+        self.assertEqual(backend.search(['sport']), [self.hat.pk])
+        self.assertFalse(backend.rebuild())
+
+    def test_index_follows_item_signals(self):
+        self.assertEqual(self.found('wool'), ['hat'])
+        self.hat.title = 'Beanie'
+        self.hat.description = 'A knitted beanie'
+        self.hat.save()
+        self.assertEqual(self.found('wool'), [])
+        self.assertEqual(self.found('knit bean'), ['hat'])
+        # Item.delete() would also collect order lines, which live elsewhere
+        post_delete.send(sender=Item, instance=self.hat)
+        self.assertEqual(self.found('beanie'), [])
+
+    def test_rebuild_command(self):
+        out = StringIO()
+        call_command('rebuild_search_index', stdout=out)
+        self.assertIn('SQLiteFTSBackend', out.getvalue())
+        self.assertEqual(self.found('shirt'), ['shirt'])
+
+
+class KeysetPaginatorTests(OrderDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for n, price in enumerate([10, 5, 10, 10, 5, 30, 10]):
+            Item.objects.create(
+                title=f'Hat {n}', price=price, category='SW', label='S',
+                slug=f'hat-{n}', description='A hat', image='hat.jpg'
+            )
+
+    def walk(self, paginator):
+        # every page forwards, then back again from the last one
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor))
+        back = [pages[-1]]
+        while back[-1].has_previous():
+            back.append(paginator.page(back[-1].previous_cursor))
+        return [[item.pk for item in page] for page in pages], [[item.pk for item in page] for page in back]
+
+    def test_pages_forwards_and_back(self):
+        forwards, back = self.walk(KeysetPaginator(Item.objects.all(), 3))
+        ids = list(Item.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(forwards, [ids[:3], ids[3:6], ids[6:]])
+        self.assertEqual(back, forwards[::-1])
+
+    def test_ties_keep_their_order(self):
+        forwards, back = self.walk(KeysetPaginator(Item.objects.all(), 2, key=('price', 'id')))
+        ids = list(Item.objects.order_by('price', 'id').values_list('id', flat=True))
+        self.assertEqual(sum(forwards, []), ids)
+        self.assertEqual(back, forwards[::-1])
+
+    def test_tampered_cursors_are_not_found(self):
+        paginator = KeysetPaginator(Item.objects.all(), 3)
+        for cursor in ['garbage', encode_cursor('next', ['abc']), encode_cursor('next', [[1]]),
+                       encode_cursor('next', [1, 2]), encode_cursor('sideways', [1]),
+                       encode_cursor('next', [None]), encode_cursor('next', [True])]:
+            with self.subTest(cursor=cursor), self.assertRaises(Http404):
+                paginator.page(cursor)
+        self.assertEqual(self.client.get('/', {'cursor': encode_cursor('next', ['abc'])}).status_code, 404)
+
+
+class PageCacheTests(OrderDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def assertServedFromCache(self, path):
+        hits = page_cache.cache_stats().get('hits', 0)
+        response = self.client.get(path)
+        self.assertEqual(page_cache.cache_stats().get('hits', 0), hits + 1)
+        return response
+
+    def test_item_save_invalidates_product_and_listing_pages(self):
+        self.client.get('/product/shirt/')
+        self.client.get('/')
+        self.assertContains(self.assertServedFromCache('/product/shirt/'), '$15')
+        self.assertContains(self.assertServedFromCache('/'), 'Shirt')
+
+        self.item.title = 'Tee'
+        self.item.discount_price = 12
+        self.item.save()
+        self.assertContains(self.client.get('/product/shirt/'), '$12')
+        self.assertContains(self.client.get('/'), 'Tee')
+        self.assertServedFromCache('/')
+
+    def test_page_rendered_across_a_change_is_not_served(self):
+        # the tag versions are read before rendering; a save in between
+        # leaves the stored page stale from the start
+        versions = page_cache.tag_versions(['all'])
+        page_cache.invalidate('all')
+        page_cache.store_page('page', HttpResponse('old'), ['all'], versions)
+        self.assertIsNone(page_cache.get_page('page'))
+
+
+class ConfigurePoolsTests(SimpleTestCase):
+    settings_databases = {
+        'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite3'},
+        'item_db': {'ENGINE': 'django.db.backends.mysql', 'NAME': 'item_django'},
+        'other_db': {'ENGINE': 'django.db.backends.oracle', 'NAME': 'localhost:1521/oracle'},
+    }
+
+    def test_oracle_alias_uses_session_pool(self):
+        databases = configure_pools(self.settings_databases, {
+            'other_db': {'MIN': 2, 'MAX': 10, 'TIMEOUT': 3, 'MAX_AGE': 600},
+        })
+        other_db = databases['other_db']
+        self.assertEqual(other_db['ENGINE'], 'core.backends.oracle')
+        self.assertEqual(other_db['CONN_MAX_AGE'], 0)
+        self.assertEqual(other_db['POOL'], {
+            'min': 2, 'max': 10, 'increment': 1,
+            'wait_timeout': 3000, 'max_lifetime_session': 600,
+        })
+        self.assertEqual(self.settings_databases['other_db']['ENGINE'], 'django.db.backends.oracle')
+
+    def test_other_aliases_keep_persistent_connections(self):
+        databases = configure_pools(self.settings_databases, {
+            'default': {'MAX_AGE': 60},
+            'item_db': {'MAX_AGE': 300, 'HEALTH_CHECKS': True},
+        })
+        self.assertEqual(databases['default']['CONN_MAX_AGE'], 60)
+        self.assertEqual(databases['item_db']['CONN_MAX_AGE'], 300)
+        self.assertTrue(databases['item_db']['CONN_HEALTH_CHECKS'])
+        self.assertNotIn('CONN_MAX_AGE', databases['other_db'])
+
+
+class PoolMetricsTests(TransactionTestCase):
+    databases = {'item_db'}
+
+    def test_new_connections_are_counted_per_alias(self):
+        connection = connections['item_db']
+        connection.close()
+        pool_metrics.reset()
+        connection.ensure_connection()
+        connection.ensure_connection()
+        connection.close()
+        connection.ensure_connection()
+        self.assertEqual(pool_stats()['item_db']['connects'], 2)
+
+
+class QueryBudgetTests(OrderDatabaseTestCase):
+    # Runs with QUERY_BUDGET_STRICT, so a view going over the budget declared
+    # on it raises QueryBudgetExceeded and fails the request
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        for n in range(5):
+            Item.objects.create(
+                title=f'Hat {n}',
+                price=10.0,
+                category='SW',
+                label='S',
+                slug=f'hat-{n}',
+                description='A hat',
+                image='hat.jpg'
+            )
+
+    def queries(self, response):
+        return dict(
+            pair.split('=') for pair in response['X-DB-Queries'].split(', ')
+        )
+
+    def fill_cart(self):
+        self.client.force_login(self.user)
+        for item in Item.objects.all():
+            self.client.get(f'/add-to-cart/{item.slug}/')
+
+    def test_home(self):
+        response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+        # the catalogue is read from the replica
+        self.assertEqual(self.queries(response)['item_db_replica'], '1')
+        self.assertEqual(self.client.get('/?q=hat').status_code, 200)
+        self.fill_cart()
+        self.assertEqual(self.client.get('/').status_code, 200)
+
+    def test_order_summary(self):
+        self.fill_cart()
+        response = self.client.get('/order-summary/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context['object'].cart.items), 6)
+
+    def test_checkout(self):
+        self.fill_cart()
+        self.assertEqual(self.client.get('/checkout/').status_code, 200)
+
+    def test_add_to_cart(self):
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/add-to-cart/shirt/').status_code, 302)
+        again = self.client.get('/add-to-cart/shirt/')
+        self.assertEqual(again.status_code, 302)
+        # to an open cart: the session's user, and the BEGIN and two UPDATEs
+        # on the shard
+        self.assertEqual(self.queries(again)['default'], '1')
+        self.assertEqual(self.queries(again)[self.db], '3')
+        self.assertEqual(self.client.get('/add-to-cart/hat-0/').status_code, 302)
+        order = Order.objects.using(self.db).get()
+        self.assertEqual((order.subtotal, order.discount, order.total), (40, 10, 40))
+
+    def test_guest_add_to_cart(self):
+        # the first add creates the session row, later ones update it
+        first = self.client.get('/add-to-cart/shirt/')
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(self.queries(first)['default'], '3')
+        self.assertEqual(self.client.get('/add-to-cart/hat-0/').status_code, 302)
+
+    def test_query_counts_are_logged(self):
+        with self.assertLogs('core.middleware', 'DEBUG') as logs:
+            self.client.get('/')
+        self.assertRegex(logs.output[0], r'^DEBUG:.*GET /: .*item_db_replica=1 \(')
+
+    @override_settings(ROOT_URLCONF='core.tests')
+    def test_exceeding_the_budget_raises(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/over-budget/')
+
+
+
+@override_settings(CATALOGUE_REFRESH_SECONDS=60)
+class CatalogueSnapshotTests(OrderDatabaseTestCase):
+    def test_cart_flow_reads_no_items_from_the_database(self):
+        Item.objects.create(title='Hat', price=10.0, category='SW', label='S', slug='hat',
+                            description='A hat', image='hat.jpg')
+        self.client.force_login(self.user)
+        self.client.get('/add-to-cart/shirt/')
+        with recorded_queries() as queries:
+            self.assertEqual(self.client.get('/add-to-cart/shirt/').status_code, 302)
+            response = self.client.get('/order-summary/')
+            self.assertEqual(response.context['object'].cart.items[0].quantity, 2)
+            self.client.post('/update-cart/', {'changes': [
+                {'slug': 'shirt', 'quantity': 1}, {'slug': 'hat', 'quantity': 2}]},
+                content_type='application/json')
+            self.client.get('/remove-from-cart/shirt/')
+        self.assertEqual(queries['item_db'] + queries['item_db_replica'], [])
+        self.assertEqual(OrderItem.objects.using(self.db).get().quantity, 2)
+
+    def test_login_merge_reads_no_items_from_the_database(self):
+        self.client.get('/add-to-cart/shirt/')
+        with recorded_queries() as queries:
+            self.assertTrue(self.client.login(username='shopper', password='password'))
+        self.assertEqual(queries['item_db'] + queries['item_db_replica'], [])
+        self.assertEqual(OrderItem.objects.using(self.db).get().quantity, 1)
+
+    def test_item_changes_reach_the_snapshot(self):
+        snapshot.refresh()
+        self.item.price = 25.0
+        self.item.save()
+        hat = Item.objects.create(title='Hat', price=10.0, category='SW', label='S', slug='hat',
+                                  description='A hat', image='hat.jpg')
+        self.assertEqual(snapshot.get(self.item.id).price, 25.0)
+        self.assertEqual(snapshot.get_by_slug('hat').pk, hat.pk)
+        self.assertEqual(snapshot.metrics()['items'], 2)
+
+    def test_changes_committed_late_are_not_skipped(self):
+        snapshot.refresh()
+        ItemChange.objects.create(id=100, item_id=0)
+        snapshot.mark_stale()
+        snapshot.refresh()
+        # a change stamped and numbered before the last one read, whose
+        # transaction only commits now
+        Item.objects.filter(pk=self.item.pk).update(price=30.0)
+        change = ItemChange.objects.create(id=50, item_id=self.item.pk)
+        ItemChange.objects.filter(pk=change.pk).update(changed=change.changed - timedelta(seconds=5))
+        snapshot.mark_stale()
+        self.assertEqual(snapshot.get(self.item.id).price, 30.0)
+
+    @override_settings(CATALOGUE_RELOAD_SECONDS=60, CATALOGUE_CHANGE_OVERLAP_SECONDS=60)
+    def test_item_changes_prune_the_change_log(self):
+        old = ItemChange.objects.get()
+        ItemChange.objects.filter(pk=old.pk).update(changed=timezone.now() - timedelta(minutes=3))
+        self.item.save()
+        self.assertEqual(ItemChange.objects.exclude(pk=old.pk).count(), 1)
+        self.assertFalse(ItemChange.objects.filter(pk=old.pk).exists())
+
+    def test_catalogue_is_warmed_before_the_first_request(self):
+        warm_catalogue()
+        self.assertEqual(snapshot.metrics()['items'], 1)
+        with recorded_queries() as queries:
+            self.client.get('/product/shirt/')
+        self.assertEqual(queries['item_db'] + queries['item_db_replica'], [])
+
+    @override_settings(CATALOGUE_SNAPSHOT_MAX_BYTES=1)
+    def test_catalogue_over_budget_is_read_from_the_database(self):
+        self.assertEqual(snapshot.get(self.item.id).title, 'Shirt')
+        metrics = snapshot.metrics()
+        self.assertTrue(metrics['over_budget'])
+        self.assertEqual(metrics['items'], 0)
+
+
+class ReplicaRoutingTests(OrderDatabaseTestCase):
+    def test_weighted_round_robin(self):
+        replica_set = replicas.ReplicaSet('item_db', {'a': 2, 'b': 1})
+        self.assertEqual([replica_set.pick() for _ in range(6)], ['a', 'b', 'a', 'a', 'b', 'a'])
+
+    def test_reads_stay_on_the_primary_after_a_write(self):
+        # on the shard that has a replica, whatever the user id hashes to
+        UserShard.objects.create(user=self.user, shard='other_db')
+        self.client.force_login(self.user)
+        response = self.client.get('/add-to-cart/shirt/')
+        self.assertIn('other_db', response.cookies['db_pins'].value)
+        # the redirect target reads the order it just changed from the primary
+        response = self.client.get('/order-summary/')
+        self.assertEqual(response['X-DB-Queries'].count('other_db_replica=0'), 1)
+        self.assertEqual(len(response.context['object'].cart.items), 1)
+
+    def test_only_writes_pin_the_primary(self):
+        self.assertNotIn('db_pins', self.client.get('/', {'q': 'shirt'}).cookies)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.assertNotIn('db_pins', self.client.get(f'/admin/core/item/{self.item.pk}/change/').cookies)
+
+        token, pinned = replicas.start_request(None)
+        try:
+            self.assertEqual(router.db_for_write(Item), 'item_db')
+            self.assertFalse(replicas.is_pinned('item_db'))
+            Item.objects.filter(pk=self.item.pk).update(title='Tee')
+            self.assertTrue(replicas.is_pinned('item_db'))
+        finally:
+            replicas.end_request(token)
+
+    @override_settings(REPLICA_RETRY_SECONDS=60)
+    def test_replica_that_is_down_is_skipped(self):
+        token, pinned = replicas.start_request(None)
+        try:
+            replica = connections['item_db_replica']
+            with mock.patch.object(replica, 'ensure_connection', side_effect=OperationalError) as connect:
+                self.assertEqual(router.db_for_read(Item), 'item_db')
+                self.assertEqual(router.db_for_read(Item), 'item_db')
+            self.assertEqual(connect.call_count, 1)
+        finally:
+            replicas.end_request(token)
+
+
+class ShardingTests(OrderDatabaseTestCase):
+    def other_shard(self, shard):
+        return next(alias for alias in order_shards() if alias != shard)
+
+    def test_orders_are_placed_by_user(self):
+        users = [self.user]
+        while hashed_shard(users[-1].pk) == self.db:
+            users.append(User.objects.create_user(f'shopper{len(users)}'))
+        other = users[-1]
+        services.add_item(self.user.id, self.item)
+        services.add_item(other.id, self.item)
+        self.assertEqual(order_db(other, write=True), self.other_shard(self.db))
+        self.assertEqual(Order.objects.using(self.db).get().user_id, self.user.id)
+        self.assertEqual(Order.objects.using(order_db(other, write=True)).get().user_id, other.id)
+
+    def test_rebalance_moves_a_users_orders(self):
+        services.add_item(self.user.id, self.item, 2)
+        target = self.other_shard(self.db)
+        call_command('rebalance_orders', self.user.id, to=target, stdout=StringIO())
+
+        self.assertFalse(Order.objects.using(self.db).exists())
+        self.assertFalse(OrderItem.objects.using(self.db).exists())
+        self.assertEqual(order_db(self.user, write=True), target)
+        self.client.force_login(self.user)
+        response = self.client.get('/order-summary/')
+        self.assertEqual(response.context['object'].cart.quantity, 2)
+        self.assertEqual(response.context['object'].total, 30)
+
+        # back to the shard the user id hashes to, which drops the pin
+        call_command('rebalance_orders', all=True, stdout=StringIO())
+        self.assertEqual(order_db(self.user, write=True), self.db)
+        self.assertFalse(UserShard.objects.exists())
+        self.assertEqual(OrderItem.objects.using(self.db).get().quantity, 2)
+
+    def test_writes_follow_a_move_despite_a_stale_shard_map(self):
+        services.add_item(self.user.id, self.item)
+        target = self.other_shard(self.db)
+        move_user(self.user.id, target)
+        # a worker that cached the shard before the move
+        shards.remember_shard(self.user.id, self.db)
+        services.add_item(self.user.id, self.item)
+        self.assertFalse(Order.objects.using(self.db).exists())
+        self.assertEqual(OrderItem.objects.using(target).get().quantity, 2)
+        self.assertEqual(order_db(self.user, write=True), target)
+
+    def test_cart_flow_queries_land_on_the_users_stores(self):
+        self.client.force_login(self.user)
+        with recorded_queries() as queries:
+            self.client.get('/add-to-cart/shirt/')
+            self.client.get('/order-summary/')
+            self.client.post('/update-cart/', {'changes': [{'slug': 'shirt', 'quantity': 3}]},
+                             content_type='application/json')
+            self.client.get('/checkout/')
+            self.client.get('/remove-item-from-cart/shirt/')
+
+        shard_replicas = set(replicas.replica_sets().get(self.db, replicas.ReplicaSet(self.db, {})).weights)
+        expected = {'default', 'item_db', 'item_db_replica', self.db} | shard_replicas
+        self.assertLessEqual(set(queries), expected)
+        self.assertIn(self.db, queries)
+        writes = {
+            alias for alias, statements in queries.items()
+            if any(sql.lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE')) for sql in statements)
+        }
+        self.assertLessEqual(writes, {'default', self.db})
+        self.assertEqual(OrderItem.objects.for_user(self.user).get().quantity, 2)
+
+    def test_unhinted_queries_follow_the_routing_context(self):
+        other = User.objects.create_user('other')
+        UserShard.objects.create(user=other, shard=self.other_shard(self.db))
+        with routing(user=other, primary=True):
+            self.assertEqual(Order.objects.all().db, self.other_shard(self.db))
+            # an explicit hint wins over the context
+            self.assertEqual(Order.objects.for_user(self.user).db, self.db)
+
+
+class CheckoutAddressTests(OrderDatabaseTestCase):
+    def checkout(self, street):
+        return self.client.post('/checkout/', {
+            'shipping_address': street,
+            'shipping_country': 'US',
+            'shipping_zip': '10001',
+            'same_billing_address': 'on',
+            'set_default_shipping': 'on',
+            'payment_option': 'S',
+        })
+
+    def test_resubmitted_address_is_reused(self):
+        services.add_item(self.user.id, self.item)
+        self.client.force_login(self.user)
+        self.assertRedirects(self.checkout('1 Bench Street'), '/payment/stripe/', fetch_redirect_response=False)
+        self.assertRedirects(self.checkout('1  bench STREET'), '/payment/stripe/', fetch_redirect_response=False)
+
+        # one shipping and one billing row, both used by the order
+        self.assertEqual(Address.objects.count(), 2)
+        order = Order.objects.for_user(self.user).with_addresses().get()
+        self.assertEqual(order.shipping_address().street_address, '1 Bench Street')
+        self.assertEqual(order.billing_address().address_type, 'B')
+        self.assertEqual(list(Address.objects.defaults(self.user)), ['S'])
+
+    def test_admin_edit_onto_an_existing_address_is_rejected(self):
+        fields = {'user': self.user, 'country': 'US', 'zip': '10001', 'address_type': 'S'}
+        Address.objects.create(street_address='1 Bench Street', **fields)
+        other = Address.objects.create(street_address='2 Bench Street', **fields)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.post(f'/admin/core/address/{other.pk}/change/', {
+            'user': self.user.pk,
+            'street_address': '1 bench street',
+            'apartment_address': '',
+            'country': 'US',
+            'zip': '10001',
+            'address_type': 'S',
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'already has the same address')
+        other.refresh_from_db()
+        self.assertEqual(other.street_address, '2 Bench Street')
+
+
+class OrderAdminTests(OrderDatabaseTestCase):
+    def add_orders(self, count):
+        for _ in range(count):
+            street = f'{Address.objects.count()} Main St'
+            shipping, billing = [
+                Address.objects.create(
+                    user=self.user, street_address=street, country='US', zip='12345', address_type=kind)
+                for kind in 'SB'
+            ]
+            Order.objects.using(home_shard()).create(
+                user=self.user,
+                ordered_date=timezone.now(),
+                shipping_address_id=shipping.id,
+                billing_address_id=billing.id
+            )
+
+    def changelist_queries(self):
+        with recorded_queries() as queries:
+            response = self.client.get('/admin/core/order/')
+        self.assertEqual(response.status_code, 200)
+        return {alias: len(statements) for alias, statements in queries.items()}
+
+    def test_changelist_queries_do_not_grow_with_the_page(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        self.add_orders(2)
+        snapshot.refresh()
+        few = self.changelist_queries()
+        self.add_orders(6)
+        self.assertEqual(self.changelist_queries(), few)
+
+    def test_orders_on_every_shard_can_be_edited(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        shard = order_shards()[1]
+        address = Address.objects.create(user=self.user, street_address='1 Main St', country='US', zip='1')
+        order = Order.objects.using(shard).create(user=self.user, ordered_date=timezone.now(), ordered=True)
+        home = Order.objects.using(home_shard()).create(user=self.user, ordered_date=timezone.now())
+        self.assertEqual(order.pk, home.pk)
+
+        response = self.client.get('/admin/core/order/', {'shard': shard})
+        self.assertEqual([row.pk for row in response.context['cl'].result_list], [order.pk])
+        self.assertEqual(response.context['cl'].result_list[0]._state.db, shard)
+
+        url = f'/admin/core/order/{order.pk}/change/?_changelist_filters=shard%3D{shard}'
+        self.assertTrue(self.client.get(url).context['original'].ordered)
+        response = self.client.post(url, {
+            'user': self.user.pk,
+            'ordered_date_0': '2026-01-01',
+            'ordered_date_1': '10:00:00',
+            'ordered': 'on',
+            'being_delivered': 'on',
+            'subtotal': '0',
+            'discount': '0',
+            'coupon_amount': '0',
+            'total': '0',
+            'shipping_address_id': address.pk,
+            'billing_address_id': address.pk,
+        })
+        self.assertEqual(response.status_code, 302, getattr(response, 'context', None) and
+                         response.context['adminform'].form.errors)
+        self.assertTrue(Order.objects.using(shard).get(pk=order.pk).being_delivered)
+        self.assertFalse(Order.objects.using(home_shard()).get(pk=home.pk).being_delivered)
+
+
+class IndexAdvisorTests(OrderDatabaseTestCase):
+    def test_advised_indexes_are_used_by_the_plans(self):
+        db = home_shard()
+        report = advise(db)
+        self.assertIn('SCAN CORE_ORDER', dict((name, plan) for name, plan, scans in report['plans'])['open order'])
+        self.assertEqual(
+            {index.name for model, index, sql in report['missing']},
+            {index.name for model in INDEXED_MODELS for index in model._meta.indexes}
+        )
+
+        call_command('advise_indexes', database=[db], apply=True, stdout=StringIO())
+        report = advise(db)
+        self.assertEqual(report['missing'], [])
+        plans = {name: plan for name, plan, scans in report['plans'] if not scans}
+        self.assertEqual(len(plans), len(report['plans']))
+        self.assertIn('core_order_user_ordered_idx', plans['open order'])
+        self.assertIn('core_oi_user_ordered_idx', plans['open order lines'])
+        self.assertIn('core_order_ref_code_idx', plans['order by reference'])
+        self.assertIn('core_coupon_code_idx', plans['coupon by code'])
+
+
+class PaymentTests(OrderDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.user)
+        services.add_item(self.user.id, self.item)
+
+    def test_payment_charges_and_finalises_the_order(self):
+        with FakeStripe() as fake:
+            response = self.client.post('/payment/stripe/', {'stripeToken': 'tok_visa'})
+        self.assertRedirects(response, '/', fetch_redirect_response=False)
+        order = Order.objects.using(self.db).get(user=self.user)
+        self.assertTrue(order.ordered)
+        self.assertEqual(order.payment.stripe_charge_id, 'ch_1')
+        self.assertFalse(OrderItem.objects.using(self.db).get(user=self.user).ordered)
+        self.assertEqual(jobs.run_pending(), 2)
+        self.assertTrue(OrderItem.objects.using(self.db).get(user=self.user).ordered)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertIn(order.ref_code, mail.outbox[0].subject)
+        [(path, params, key)] = fake.charges()
+        self.assertEqual(params['amount'], '1500')
+        self.assertTrue(key)
+
+    def test_refund_request_decodes_the_reference(self):
+        with FakeStripe():
+            self.client.post('/payment/stripe/', {'stripeToken': 'tok_visa'})
+        order = Order.objects.using(self.db).get(user=self.user)
+        self.assertEqual(decode_ref_code(order.ref_code), (self.db, order.pk))
+        forged = order.ref_code[0] + int_to_base36(order.pk + 1) + order.ref_code[-CHECK_LENGTH:]
+        self.assertIsNone(decode_ref_code(forged))
+
+        # straight to the row on its shard, however the code was typed
+        with recorded_queries() as queries:
+            self.assertEqual(find_order(f' {order.ref_code.upper()} ').pk, order.pk)
+        self.assertEqual({alias: len(statements) for alias, statements in queries.items()}, {self.db: 1})
+
+        response = self.client.post('/request-refund/', {
+            'ref_code': order.ref_code,
+            'message': 'Wrong size',
+            'email': 'shopper@example.com',
+        })
+        self.assertRedirects(response, '/request-refund/', fetch_redirect_response=False)
+        jobs.run_pending()
+        self.assertTrue(Order.objects.using(self.db).get(pk=order.pk).refund_requested)
+
+    def test_double_submit_is_charged_once(self):
+        order = Order.objects.using(self.db).get(user=self.user)
+        profile = UserProfile.objects.get(user=self.user)
+        with FakeStripe() as fake:
+            first = payments.start(order, self.user, profile, 1500, 'tok_visa')
+            second = payments.start(order, self.user, profile, 1500, 'tok_visa')
+            self.assertEqual(first.key, second.key)
+            for attempt in (first, second):
+                charge = payments.create_charge(attempt)
+                payments.finalise(attempt, charge.id)
+        self.assertEqual(len(fake.charges()), 1)
+        self.assertEqual(Payment.objects.using(self.db).get().stripe_charge_id, charge.id)
+
+    def test_concurrent_submits_share_the_pending_payment(self):
+        order = Order.objects.using(self.db).get(user=self.user)
+        profile = UserProfile.objects.get(user=self.user)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with transaction.atomic(using=self.db):
+                first = payments.start(order, self.user, profile, 1500, 'tok_visa')
+                second = executor.submit(payments.start, order, self.user, profile, 1500, 'tok_visa')
+                time.sleep(0.2)
+                self.assertFalse(second.done())
+            second = second.result()
+        self.assertEqual((second.payment.pk, second.key), (first.payment.pk, first.key))
+        self.assertEqual(Payment.objects.using(self.db).count(), 1)
+
+    def test_unknown_outcome_keeps_the_key(self):
+        order = Order.objects.using(self.db).get(user=self.user)
+        profile = UserProfile.objects.get(user=self.user)
+        first = payments.start(order, self.user, profile, 1500, 'tok_visa')
+        payments.abandon(first, stripe.error.APIConnectionError('Connection reset'))
+        retry = payments.start(order, self.user, profile, 1500, 'tok_visa')
+        self.assertEqual((retry.payment.pk, retry.key), (first.payment.pk, first.key))
+        self.assertTrue(retry.payment.stripe_charge_id.startswith(payments.PENDING_PREFIX))
+
+    def test_declined_card_leaves_the_order_open(self):
+        with FakeStripe():
+            self.client.post('/payment/stripe/', {'stripeToken': 'tok_chargeDeclined'})
+        self.assertFalse(Order.objects.using(self.db).get(user=self.user).ordered)
+        payment = Payment.objects.using(self.db).get()
+        self.assertTrue(payment.stripe_charge_id.startswith(payments.DECLINED_PREFIX))
+
+    def test_retry_after_a_decline_is_a_new_charge(self):
+        order = Order.objects.using(self.db).get(user=self.user)
+        profile = UserProfile.objects.get(user=self.user)
+        with FakeStripe() as fake:
+            declined = payments.start(order, self.user, profile, 1500, 'tok_chargeDeclined')
+            with self.assertRaises(stripe.error.CardError) as declined_error:
+                payments.create_charge(declined)
+            payments.abandon(declined, declined_error.exception)
+            # same order, amount and card, e.g. once the card was topped up
+            retry = payments.start(order, self.user, profile, 1500, 'tok_chargeDeclined')
+            self.assertNotEqual(retry.key, declined.key)
+            with self.assertRaises(stripe.error.CardError):
+                payments.create_charge(retry)
+        # both reached the gateway; a replayed response is not recorded
+        self.assertEqual(len(fake.charges()), 2)
+
+
+
+calls = []
+
+
+@jobs.job('test_flaky')
+def flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise RuntimeError('flaky')
+
+
+class JobTests(TransactionTestCase):
+    databases = {'default', 'other_db', 'other_db_2'}
+
+    def setUp(self):
+        calls.clear()
+
+    def test_failed_job_is_retried_later(self):
+        job = jobs.enqueue('test_flaky', max_attempts=2, fail_times=1)
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertIn('flaky', job.last_error)
+        self.assertEqual(jobs.run_pending(), 0)
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+
+    def test_job_of_a_dead_worker_is_reclaimed(self):
+        job = jobs.enqueue('test_flaky', fail_times=0)
+        self.assertEqual(len(jobs.claim('dead-worker')), 1)
+        self.assertEqual(jobs.claim('other-worker'), [])
+
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now())
+        self.assertEqual(jobs.run_pending('other-worker'), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.locked_by), ('done', 'other-worker'))
+
+
+@query_budget(item_db=0)
+def over_budget(request):
+    return HttpResponse(Item.objects.count())
+
+
+urlpatterns = [path('over-budget/', over_budget)]
@@ -7,6 +7,7 @@ from .views import (
     add_to_cart,
     remove_from_cart,
     remove_single_item_from_cart,
+    update_cart,
     PaymentView,
     AddCouponView,
     RequestRefundView
@@ -26,6 +27,7 @@ urlpatterns = [
     path('remove-from-cart/<str:slug>/', remove_from_cart, name='remove-from-cart'),
     path('remove-item-from-cart/<slug>/', remove_single_item_from_cart,
         name='remove-single-item-from-cart'),
+    path('update-cart/', update_cart, name='update-cart'),
     path('payment/<payment_option>/', PaymentView.as_view(), name='payment'),
     path('request-refund/', RequestRefundView.as_view(), name='request-refund')
 ]
@@ -1,29 +1,35 @@
-import random
-import string
+import json
 import logging
 import traceback
 
 import stripe
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib import messages
-from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, JsonResponse
 from django.shortcuts import redirect
-from django.shortcuts import render, get_object_or_404
-from django.utils import timezone
+from django.shortcuts import render
+from django.views.decorators.http import require_POST
 from django.views.generic import ListView, DetailView, View
 from django.shortcuts import render
-from django.db.models import Q
 from django.db import connections
 from django.db import transaction
-import cx_Oracle
-from django.contrib.auth.models import User
 
-from .forms import CheckoutForm, CouponForm, RefundForm, PaymentForm
-from .models import Item, OrderItem, Order, Address, Payment, Coupon, Refund, UserProfile, OrderItems
+from routers.context import routing
+from routers.shards import order_db, order_shards
 
-stripe.api_key = settings.STRIPE_SECRET_KEY
+from . import catalogue, jobs, payments, services
+from .cart import CartSummary, SessionCart
+from .forms import CheckoutForm, CouponForm, RefundForm, PaymentForm
+from .models import Item, Order, Address, Coupon, UserProfile
+from .middleware import query_budget
+from .money import to_cents
+from .page_cache import CataloguePageCacheMixin, item_tag, listing_tags
+from .pagination import KeysetPaginator
+from .refcodes import decode_ref_code
+from .search import search_items
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -34,10 +40,6 @@ logging.basicConfig(
 )
 
 
-def create_ref_code():
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=20))
-
-
 def products(request):
     context = {
         'items': Item.objects.all()
@@ -53,10 +55,14 @@ def is_valid_form(values):
     return valid
 
 
-class CheckoutView(View):
+class CheckoutView(LoginRequiredMixin, View):
+    # the order with its lines and items, and the navbar badge after a change
+    query_budget = {'GET': {'default': 3, 'item_db': 2, 'other_db': 4}}
+
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.for_user(self.request.user).prefetch_across(
+                'items__item').get(user=self.request.user, ordered=False)
             form = CheckoutForm()
             context = {
                 'form': form,
@@ -65,23 +71,14 @@ class CheckoutView(View):
                 'DISPLAY_COUPON_FORM': True
             }
 
-            shipping_address_qs = Address.objects.filter(
-                user=self.request.user,
-                address_type='S',
-                default=True
-            )
-            if shipping_address_qs.exists():
+            # both default addresses with one query
+            defaults = Address.objects.defaults(self.request.user)
+            if 'S' in defaults:
                 context.update(
-                    {'default_shipping_address': shipping_address_qs[0]})
-
-            billing_address_qs = Address.objects.filter(
-                user=self.request.user,
-                address_type='B',
-                default=True
-            )
-            if billing_address_qs.exists():
+                    {'default_shipping_address': defaults['S']})
+            if 'B' in defaults:
                 context.update(
-                    {'default_billing_address': billing_address_qs[0]})
+                    {'default_billing_address': defaults['B']})
             return render(self.request, "checkout.html", context)
         except ObjectDoesNotExist:
             messages.info(self.request, "You do not have an active order")
@@ -106,7 +103,7 @@ class CheckoutView(View):
             # Log cleaned data
             logger.debug(f"Form cleaned data: {form.cleaned_data}")
             
-            order = Order.objects.using('other_db').get(
+            order = Order.objects.for_user(request.user).get(
                 user=request.user, 
                 ordered=False
             )
@@ -126,40 +123,39 @@ class CheckoutView(View):
                 messages.error(request, f"Please fill in all required shipping fields: {', '.join(missing)}")
                 return redirect("core:checkout")
 
+            # an address the user already has is reused, see services.save_address
             try:
-                shipping_address_obj = Address.objects.create(
-                    user=request.user,
-                    street_address=shipping_data['address'],
-                    apartment_address=form.cleaned_data.get('shipping_address2', ''),
-                    country=shipping_data['country'],
-                    zip=shipping_data['zip'],
-                    address_type='S'
+                shipping_address_obj = services.save_address(
+                    request.user,
+                    'S',
+                    shipping_data['address'],
+                    form.cleaned_data.get('shipping_address2', ''),
+                    shipping_data['country'],
+                    shipping_data['zip'],
+                    default=bool(form.cleaned_data.get('set_default_shipping'))
                 )
-                logger.debug(f"Created shipping address: {shipping_address_obj.id}")
+                logger.debug(f"Saved shipping address: {shipping_address_obj.id}")
             except Exception as e:
                 logger.error(f"Error creating shipping address: {str(e)}")
                 messages.error(request, f"Error creating shipping address: {str(e)}")
                 return redirect("core:checkout")
 
-            if form.cleaned_data.get('set_default_shipping'):
-                shipping_address_obj.default = True
-                shipping_address_obj.save()
-
             # Handle billing address
             same_billing_address = form.cleaned_data.get('same_billing_address')
             logger.debug(f"Same billing address: {same_billing_address}")
 
             if same_billing_address:
                 try:
-                    billing_address_obj = Address.objects.create(
-                        user=request.user,
-                        street_address=shipping_address_obj.street_address,
-                        apartment_address=shipping_address_obj.apartment_address,
-                        country=shipping_address_obj.country,
-                        zip=shipping_address_obj.zip,
-                        address_type='B'
+                    billing_address_obj = services.save_address(
+                        request.user,
+                        'B',
+                        shipping_address_obj.street_address,
+                        shipping_address_obj.apartment_address,
+                        shipping_address_obj.country,
+                        shipping_address_obj.zip,
+                        default=bool(form.cleaned_data.get('set_default_billing'))
                     )
-                    logger.debug(f"Created billing address (same as shipping): {billing_address_obj.id}")
+                    logger.debug(f"Saved billing address (same as shipping): {billing_address_obj.id}")
                 except Exception as e:
                     logger.error(f"Error creating billing address: {str(e)}")
                     messages.error(request, f"Error creating billing address: {str(e)}")
@@ -179,28 +175,25 @@ class CheckoutView(View):
                     return redirect("core:checkout")
 
                 try:
-                    billing_address_obj = Address.objects.create(
-                        user=request.user,
-                        street_address=billing_data['address'],
-                        apartment_address=form.cleaned_data.get('billing_address2', ''),
-                        country=billing_data['country'],
-                        zip=billing_data['zip'],
-                        address_type='B'
+                    billing_address_obj = services.save_address(
+                        request.user,
+                        'B',
+                        billing_data['address'],
+                        form.cleaned_data.get('billing_address2', ''),
+                        billing_data['country'],
+                        billing_data['zip'],
+                        default=bool(form.cleaned_data.get('set_default_billing'))
                     )
-                    logger.debug(f"Created billing address: {billing_address_obj.id}")
+                    logger.debug(f"Saved billing address: {billing_address_obj.id}")
                 except Exception as e:
                     logger.error(f"Error creating billing address: {str(e)}")
                     messages.error(request, f"Error creating billing address: {str(e)}")
                     return redirect("core:checkout")
 
-            if form.cleaned_data.get('set_default_billing'):
-                billing_address_obj.default = True
-                billing_address_obj.save()
-
             # Update order
             try:
                 with transaction.atomic():
-                    with connections['other_db'].cursor() as cursor:
+                    with connections[order_db(request.user, write=True)].cursor() as cursor:
                         # Convert IDs to integers and use a simpler SQL query
                         shipping_id = int(shipping_address_obj.id)
                         billing_id = int(billing_address_obj.id)
@@ -247,8 +240,14 @@ class CheckoutView(View):
 
 
 class PaymentView(View):
-    def get(self, *args, **kwargs):
-        order = Order.objects.using('other_db').get(user=self.request.user, ordered=False)
+    # Async so that a worker is not held for the Stripe round trips; the
+    # database work still runs synchronously through sync_to_async
+    async def get(self, *args, **kwargs):
+        return await sync_to_async(self.show_payment)()
+
+    def show_payment(self):
+        order = Order.objects.for_user(self.request.user).prefetch_across(
+            'items__item').get(user=self.request.user, ordered=False)
         if order.billing_address_id:
             context = {
                 'order': order,
@@ -260,86 +259,66 @@ class PaymentView(View):
             messages.warning(self.request, "You have not added a billing address")
             return redirect("core:checkout")
 
-    def post(self, *args, **kwargs):
+    async def post(self, *args, **kwargs):
+        attempt = await sync_to_async(self.start_payment)()
+        if attempt is None:
+            return redirect("/")
         try:
-            order = Order.objects.using('other_db').get(user=self.request.user, ordered=False)
-            form = PaymentForm(self.request.POST)
-            userprofile = UserProfile.objects.using('default').get(user=self.request.user)
-
-            if form.is_valid():
-                token = form.cleaned_data.get('stripeToken')
-                save = form.cleaned_data.get('save')
-                use_default = form.cleaned_data.get('use_default')
-
-                if save:
-                    if userprofile.stripe_customer_id != '' and userprofile.stripe_customer_id is not None:
-                        customer = stripe.Customer.retrieve(userprofile.stripe_customer_id)
-                        customer.sources.create(source=token)
-                    else:
-                        customer = stripe.Customer.create(
-                            email=self.request.user.email,
-                            source=token
-                        )
-                        userprofile.stripe_customer_id = customer.id
-                        userprofile.save(using='default')
-
-                amount = int(order.get_total() * 100)  # cents
-
-                try:
-                    charge = stripe.Charge.create(
-                        amount=amount,
-                        currency="usd",
-                        customer=userprofile.stripe_customer_id if use_default else None,
-                        source=token if not use_default else None
-                    )
-
-                    # Create the payment
-                    payment = Payment.objects.using('other_db').create(
-                        stripe_charge_id=charge.id,
-                        user=self.request.user,
-                        amount=order.get_total()
-                    )
-
-                    # Update the order
-                    order_items = order.items.all()
-                    order_items.update(ordered=True)
-                    for item in order_items:
-                        item.save(using='other_db')
-
-                    order.ordered = True
-                    order.payment = payment
-                    order.ref_code = create_ref_code()
-                    order.save(using='other_db')
-
-                    messages.success(self.request, "Your order was successful!")
-                    return redirect("/")
-
-                except stripe.error.CardError as e:
-                    messages.warning(self.request, f"{e.error.message}")
-                    return redirect("/")
-                except stripe.error.RateLimitError as e:
-                    messages.warning(self.request, "Rate limit error")
-                    return redirect("/")
-                except stripe.error.InvalidRequestError as e:
-                    messages.warning(self.request, "Invalid parameters")
-                    return redirect("/")
-                except stripe.error.AuthenticationError as e:
-                    messages.warning(self.request, "Not authenticated")
-                    return redirect("/")
-                except stripe.error.APIConnectionError as e:
-                    messages.warning(self.request, "Network error")
-                    return redirect("/")
-                except stripe.error.StripeError as e:
-                    messages.warning(self.request, "Something went wrong. You were not charged. Please try again.")
-                    return redirect("/")
-                except Exception as e:
-                    messages.warning(self.request, "A serious error occurred. We have been notified.")
-                    logger.error(f"Payment error: {str(e)}")
-                    return redirect("/")
+            charge = await payments.charge(attempt)
+        except Exception as e:
+            await sync_to_async(self.payment_failed)(attempt, e)
+            return redirect("/")
+        await sync_to_async(self.payment_succeeded)(attempt, charge)
+        return redirect("/")
 
+    def start_payment(self):
+        try:
+            # from the primary, so the amount charged is never a replica's
+            with routing(primary=True):
+                order = Order.objects.for_user(self.request.user).get(
+                    user=self.request.user, ordered=False)
         except ObjectDoesNotExist:
             messages.warning(self.request, "You do not have an active order")
-            return redirect("/")
+            return None
+        form = PaymentForm(self.request.POST)
+        if not form.is_valid():
+            messages.warning(self.request, "Invalid payment details")
+            return None
+        userprofile = UserProfile.objects.get(user=self.request.user)
+        attempt = payments.start(
+            order,
+            self.request.user,
+            userprofile,
+            to_cents(order.get_total()),
+            form.cleaned_data.get('stripeToken'),
+            save=form.cleaned_data.get('save'),
+            use_default=form.cleaned_data.get('use_default')
+        )
+        if attempt is None:
+            messages.info(self.request, "Your order has already been paid")
+        return attempt
+
+    def payment_succeeded(self, attempt, charge):
+        payments.finalise(attempt, charge.id)
+        messages.success(self.request, "Your order was successful!")
+
+    def payment_failed(self, attempt, e):
+        payments.abandon(attempt, e)
+        if isinstance(e, stripe.error.CardError):
+            messages.warning(self.request, f"{e.error.message}")
+        elif isinstance(e, stripe.error.RateLimitError):
+            messages.warning(self.request, "Rate limit error")
+        elif isinstance(e, stripe.error.InvalidRequestError):
+            messages.warning(self.request, "Invalid parameters")
+        elif isinstance(e, stripe.error.AuthenticationError):
+            messages.warning(self.request, "Not authenticated")
+        elif isinstance(e, stripe.error.APIConnectionError):
+            messages.warning(self.request, "Network error")
+        elif isinstance(e, stripe.error.StripeError):
+            messages.warning(self.request, "Something went wrong. You were not charged. Please try again.")
+        else:
+            messages.warning(self.request, "A serious error occurred. We have been notified.")
+            logger.error(f"Payment error: {str(e)}")
 
 
 # class HomeView(ListView):
@@ -347,33 +326,67 @@ class PaymentView(View):
 #     paginate_by = 10
 #     template_name = "home.html"
 
-class HomeView(ListView):
+class HomeView(CataloguePageCacheMixin, ListView):
     model = Item
     template_name = 'home.html'
     context_object_name = 'object_list'
     paginate_by = 10
+    # a search is the ranked id lookup, the page count and the page itself;
+    # the navbar badge is rebuilt from the open order after a cart change
+    query_budget = {'default': 1, 'item_db': 3, 'other_db': 2}
 
     def get_queryset(self):
         query = self.request.GET.get('q')
         category = self.kwargs.get('category')
         if query:
-            return Item.objects.filter(
-                Q(title__icontains=query) | Q(category__icontains=query)
-            ).distinct()
+            return search_items(query)
         if category:
             return Item.objects.filter(category=category).distinct()
         return Item.objects.all()
 
+    def paginate_queryset(self, queryset, page_size):
+        # Search results are ranked, so only the plain catalogue and category
+        # listings can page by primary key
+        if settings.CATALOGUE_PAGINATION != 'cursor' or self.request.GET.get('q'):
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(
+            queryset,
+            page_size,
+            with_total=settings.CATALOGUE_APPROXIMATE_TOTAL
+        )
+        page = paginator.page(self.request.GET.get('cursor'))
+        return (paginator, page, page.object_list, page.has_other_pages())
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['category'] = self.kwargs.get('category')
         return context
 
+    def get_page_cache_known_tags(self):
+        return listing_tags(self.kwargs.get('category'), self.request.GET.get('q'))
+
+    def get_page_cache_tags(self, response):
+        tags = self.get_page_cache_known_tags()
+        return tags + [item_tag(item.pk) for item in response.context_data['object_list']]
+
+
+class OrderSummaryView(View):
+    # the order with its lines and items, and the navbar badge after a change
+    query_budget = {'default': 1, 'item_db': 2, 'other_db': 4}
 
-class OrderSummaryView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
+        if not self.request.user.is_authenticated:
+            session_cart = SessionCart(self.request.session)
+            if not session_cart:
+                messages.warning(self.request, "You do not have an active order")
+                return redirect("/")
+            # an unsaved order so the template renders guest carts unchanged
+            order = Order()
+            order.cart = session_cart.summary()
+            return render(self.request, 'order_summary.html', {'object': order})
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.for_user(self.request.user).prefetch_across(
+                'items__item').get(user=self.request.user, ordered=False)
             context = {
                 'object': order
             }
@@ -383,72 +396,57 @@ class OrderSummaryView(LoginRequiredMixin, View):
             return redirect("/")
 
 
-class ItemDetailView(DetailView):
+def item_or_404(slug):
+    # the cart views read items from the process's catalogue snapshot
+    item = catalogue.snapshot.get_by_slug(slug)
+    if item is None:
+        raise Http404("No item found matching the query")
+    return item
+
+
+class ItemDetailView(CataloguePageCacheMixin, DetailView):
     model = Item
     template_name = "product.html"
 
+    def get_object(self, queryset=None):
+        return item_or_404(self.kwargs['slug'])
+
+    def get_page_cache_tags(self, response):
+        return [item_tag(self.object.pk)]
 
-@login_required
+
+# The usual add, to a cart that is already open, is the session's user and
+# two UPDATEs on the user's shard (and a BEGIN on SQLite), see
+# services.add_item. The budget is set by the first add of a cart, which
+# finds no order to lock and creates it under the user lock: the shard
+# when it is not cached, the lock (and its BEGIN) and the stored shard on
+# default, and the failed UPDATE, its retry under the lock and three
+# INSERTs on the shard. A guest's first add instead looks up and inserts
+# the session row (and BEGINs on SQLite)
+@query_budget(default=5, item_db=0, other_db=7)
 def add_to_cart(request, slug):
     try:
-        # Get item from MySQL database
-        item = get_object_or_404(Item.objects.using('item_db'), slug=slug)
+        item = item_or_404(slug)
         logger.debug(f"Found item: {item}")
-        
-        # Get user from default database (SQLite)
-        user = get_object_or_404(User.objects.using('default'), id=request.user.id)
-        logger.debug(f"Found user: {user}")
-        
-        # Get or create order item in Oracle database
-        order_item, created = OrderItem.objects.using('other_db').get_or_create(
-            item_id=item.id,  # Use item_id instead of item
-            user_id=user.id,  # Use user_id instead of user
-            ordered=False,
-            defaults={'quantity': 1}
-        )
-        logger.debug(f"OrderItem created: {created}")
-        
-        # Get order queryset from Oracle database
-        order_qs = Order.objects.using('other_db').filter(
-            user_id=user.id,  # Use user_id instead of user
-            ordered=False
-        )
-        logger.debug(f"Found order: {order_qs.exists()}")
-        
-        if order_qs.exists():
-            order = order_qs[0]
-            # Check if the order item is in the order using the through model
-            if OrderItems.objects.using('other_db').filter(
-                order=order,
-                orderitem__item_id=item.id
-            ).exists():
-                order_item.quantity += 1
-                order_item.save(using='other_db')
+
+        # Guests only touch the session until they log in
+        if not request.user.is_authenticated:
+            session_cart = SessionCart(request.session)
+            if item.id in session_cart:
                 messages.info(request, "This item quantity was updated.")
             else:
-                OrderItems.objects.using('other_db').create(
-                    order=order,
-                    orderitem=order_item
-                )
                 messages.info(request, "This item was added to your cart.")
-        else:
-            ordered_date = timezone.now()
-            order = Order.objects.using('other_db').create(
-                user_id=user.id,  # Use user_id instead of user
-                ordered_date=ordered_date
-            )
-            OrderItems.objects.using('other_db').create(
-                order=order,
-                orderitem=order_item
-            )
+            session_cart.add(item.id)
+            return redirect("core:order-summary")
+
+        # One transaction on the order database, see services.add_item
+        if services.add_item(request.user.id, item):
             messages.info(request, "This item was added to your cart.")
-        
+        else:
+            messages.info(request, "This item quantity was updated.")
         return redirect("core:order-summary")
     except Exception as e:
         logger.error(f"Error in add_to_cart: {str(e)}")
-        # Print the SQL query that caused the error
-        from django.db import connection
-        logger.error(f"Last query: {connection.queries[-1] if connection.queries else 'No queries'}")
         raise
 
 
@@ -498,119 +496,93 @@ def add_to_cart(request, slug):
 #         messages.info(request, "You do not have an active order")
 #         return redirect("core:product", slug=slug)
 
-@login_required
 def remove_from_cart(request, slug):
     try:
-        # Get item from MySQL database using slug instead of category
-        item = get_object_or_404(Item.objects.using('item_db'), slug=slug)
-        
-        # Get Order from Oracle database
-        order_qs = Order.objects.using('other_db').filter(
-            user=request.user,
-            ordered=False
-        )
+        item = item_or_404(slug)
+
+        if not request.user.is_authenticated:
+            session_cart = SessionCart(request.session)
+            if item.id not in session_cart:
+                messages.warning(request, "This item was not in your cart")
+                return redirect("core:home")
+            session_cart.remove(item.id)
+            messages.info(request, "Item removed from your cart.")
+            return redirect("core:order-summary")
         
-        if order_qs.exists():
-            order = order_qs[0]
-            
-            # Check if the order item exists using raw SQL
-            with connections['other_db'].cursor() as cursor:
-                cursor.execute("""
-                    SELECT oi.ID 
-                    FROM CORE_ORDERITEM oi
-                    INNER JOIN CORE_ORDER_ITEMS coi ON oi.ID = coi.ORDERITEM_ID
-                    WHERE coi.ORDER_ID = %s 
-                    AND oi.ITEM_ID = %s
-                    AND oi.ORDERED = 0
-                """, [order.id, item.id])
-                
-                order_item = cursor.fetchone()
-                
-                if order_item:
-                    order_item_id = order_item[0]
-                    
-                    # First remove from CORE_ORDER_ITEMS
-                    cursor.execute("""
-                        DELETE FROM CORE_ORDER_ITEMS 
-                        WHERE ORDER_ID = %s AND ORDERITEM_ID = %s
-                    """, [order.id, order_item_id])
-                    
-                    # Then delete the OrderItem
-                    cursor.execute("""
-                        DELETE FROM CORE_ORDERITEM 
-                        WHERE ID = %s
-                    """, [order_item_id])
-                    
-                    messages.info(request, "Item removed from your cart.")
-                    return redirect("core:order-summary")
-                else:
-                    messages.warning(request, "This item was not in your cart")
-                    return redirect("core:home")
-        else:
+        try:
+            removed = services.remove_item(request.user.id, item) is not None
+        except Order.DoesNotExist:
             messages.warning(request, "You do not have an active order")
             return redirect("core:home")
-            
+        if removed:
+            messages.info(request, "Item removed from your cart.")
+            return redirect("core:order-summary")
+        messages.warning(request, "This item was not in your cart")
+        return redirect("core:home")
+
     except Exception as e:
         messages.error(request, f"Error removing item: {str(e)}")
         return redirect("core:home")
 
 
-@login_required
 def remove_single_item_from_cart(request, slug):
-    # Get item from MySQL database
-    item = get_object_or_404(Item.objects.using('item_db'), slug=slug)
-    
-    # Get Order from Oracle database
-    order_qs = Order.objects.using('other_db').filter(
-        user=request.user, 
-        ordered=False
-    )
-    
-    if order_qs.exists():
-        order = order_qs[0]
-        
-        # Use raw SQL to check if item exists in order
-        with connections['other_db'].cursor() as cursor:
-            cursor.execute("""
-                SELECT oitem.ID, oitem.QUANTITY 
-                FROM CORE_ORDER_ITEMS oi
-                JOIN CORE_ORDERITEM oitem ON oi.ORDERITEM_ID = oitem.ID
-                WHERE oi.ORDER_ID = %s 
-                AND oitem.ITEM_ID = %s
-                AND oitem.ORDERED = 0
-                """, [order.id, item.id])
-            result = cursor.fetchone()
-            
-        if result:
-            order_item_id, quantity = result
-            if quantity > 1:
-                # Update quantity
-                with connections['other_db'].cursor() as cursor:
-                    cursor.execute("""
-                        UPDATE CORE_ORDERITEM 
-                        SET QUANTITY = QUANTITY - 1 
-                        WHERE ID = %s
-                        """, [order_item_id])
-                messages.info(request, "This item quantity was updated.")
-            else:
-                # Remove the order-item relationship and the order item
-                with connections['other_db'].cursor() as cursor:
-                    cursor.execute("""
-                        DELETE FROM CORE_ORDER_ITEMS 
-                        WHERE ORDER_ID = %s AND ORDERITEM_ID = %s
-                        """, [order.id, order_item_id])
-                    cursor.execute("""
-                        DELETE FROM CORE_ORDERITEM 
-                        WHERE ID = %s
-                        """, [order_item_id])
-                messages.info(request, "This item was removed from your cart.")
-            return redirect("core:order-summary")
-        else:
+    item = item_or_404(slug)
+
+    if not request.user.is_authenticated:
+        session_cart = SessionCart(request.session)
+        if item.id not in session_cart:
             messages.info(request, "This item was not in your cart.")
             return redirect("core:product", slug=slug)
-    else:
+        session_cart.remove(item.id, 1)
+        messages.info(request, "This item quantity was updated.")
+        return redirect("core:order-summary")
+    
+    try:
+        left = services.remove_item(request.user.id, item, 1)
+    except Order.DoesNotExist:
         messages.info(request, "You do not have an active order.")
         return redirect("core:product", slug=slug)
+    if left is None:
+        messages.info(request, "This item was not in your cart.")
+        return redirect("core:product", slug=slug)
+    if left:
+        messages.info(request, "This item quantity was updated.")
+    else:
+        messages.info(request, "This item was removed from your cart.")
+    return redirect("core:order-summary")
+
+
+@require_POST
+def update_cart(request):
+    # Body: {"changes": [{"slug": "...", "quantity": 2}, ...]} with absolute
+    # quantities, 0 removing the line; answers with the recomputed totals
+    try:
+        changes = json.loads(request.body)['changes']
+        quantities = {change['slug']: int(change['quantity']) for change in changes}
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'error': 'Invalid cart update'}, status=400)
+    if any(quantity < 0 for quantity in quantities.values()):
+        return JsonResponse({'error': 'Invalid cart update'}, status=400)
+
+    # Resolve every slug from the catalogue snapshot
+    item_ids = catalogue.snapshot.slug_ids(list(quantities))
+    unknown = sorted(set(quantities) - set(item_ids))
+    if unknown:
+        return JsonResponse({'error': 'Unknown items', 'slugs': unknown}, status=400)
+    changes = {item_ids[slug]: quantity for slug, quantity in quantities.items()}
+
+    if not request.user.is_authenticated:
+        session_cart = SessionCart(request.session)
+        for item_id, quantity in changes.items():
+            session_cart.update(item_id, quantity)
+        return JsonResponse(session_cart.summary().as_dict())
+
+    order = services.set_quantities(request.user.id, changes)
+    if order is None:
+        return JsonResponse(CartSummary([]).as_dict())
+    order = Order.objects.for_user(request.user).prefetch_across(
+        'items__item').get(pk=order.pk)
+    return JsonResponse(order.cart.as_dict())
 
 
 def get_coupon(request, code):
@@ -628,14 +600,14 @@ class AddCouponView(View):
         if form.is_valid():
             try:
                 code = form.cleaned_data.get('code')
-                order = Order.objects.using('other_db').get(
+                order = Order.objects.for_user(self.request.user).get(
                     user=self.request.user, 
                     ordered=False
                 )
                 try:
-                    coupon = Coupon.objects.using('other_db').get(code=code)
-                    order.coupon = coupon
-                    order.save(using='other_db')
+                    # coupons are shared, on the first order shard
+                    coupon = Coupon.objects.get(code=code)
+                    services.apply_coupon(order, coupon)
                     messages.success(self.request, "Successfully added coupon")
                     return redirect("core:checkout")
                 except Coupon.DoesNotExist:
@@ -649,6 +621,24 @@ class AddCouponView(View):
         return redirect("core:checkout")
 
 
+def find_order(ref_code):
+    # the code names the shard and primary key of its order; orders moved by
+    # rebalance_orders since, and codes from before the scheme, are looked up
+    # by the indexed REF_CODE column on every shard
+    ref_code = ref_code.strip().lower()
+    decoded = decode_ref_code(ref_code)
+    if decoded is not None:
+        db, order_id = decoded
+        order = Order.objects.using(db).filter(pk=order_id, ref_code=ref_code).first()
+        if order is not None:
+            return order
+    for db in order_shards():
+        order = Order.objects.using(db).filter(ref_code=ref_code).first()
+        if order is not None:
+            return order
+    raise Order.DoesNotExist
+
+
 class RequestRefundView(View):
     def get(self, *args, **kwargs):
         form = RefundForm()
@@ -665,16 +655,16 @@ class RequestRefundView(View):
             email = form.cleaned_data.get('email')
             # edit the order
             try:
-                order = Order.objects.get(ref_code=ref_code)
-                order.refund_requested = True
-                order.save()
-
-                # store the refund
-                refund = Refund()
-                refund.order = order
-                refund.reason = message
-                refund.email = email
-                refund.save()
+                order = find_order(ref_code)
+                # the order and the refund are updated by the job worker
+                jobs.enqueue(
+                    'record_refund_request',
+                    using=order._state.db,
+                    order_id=order.pk,
+                    user_id=order.user_id,
+                    reason=message,
+                    email=email
+                )
 
                 messages.info(self.request, "Your request was received.")
                 return redirect("core:request-refund")
@@ -0,0 +1,11 @@
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djecommerce.settings')
+
+application = get_asgi_application()
+
+from core.catalogue import warm_catalogue  # noqa: E402
+
+warm_catalogue()
@@ -28,11 +28,14 @@ INSTALLED_APPS = [
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 MIDDLEWARE = [
+    'core.middleware.QueryBudgetMiddleware',
+    'core.middleware.ReplicaPinMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.RoutingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "allauth.account.middleware.AccountMiddleware",
@@ -57,6 +60,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'djecommerce.wsgi.application'
+ASGI_APPLICATION = 'djecommerce.asgi.application'
 
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
@@ -64,6 +68,50 @@ USE_I18N = True
 USE_L10N = True
 USE_TZ = True
 
+# Cache; LocMemCache is per process, so anything running more than one
+# worker needs a shared backend (see production.py)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+CART_CACHE_TIMEOUT = 60 * 15
+CATALOGUE_CACHE_TIMEOUT = 60 * 10
+
+# Guest carts live in the session, so keep session reads off the database
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Catalogue listing: 'cursor' pages by primary key, 'offset' uses ?page=
+
+CATALOGUE_PAGINATION = 'cursor'
+CATALOGUE_APPROXIMATE_TOTAL = True
+
+# Query budgets: X-DB-Queries / X-DB-Time-Ms headers on every response, and
+# whether a view going over its declared budget raises instead of logging
+
+QUERY_STATS_HEADERS = False
+QUERY_BUDGET_STRICT = False
+
+# Read replicas per primary alias, e.g. {'item_db': {'item_db_replica': 2,
+# 'item_db_replica2': 1}} with round-robin weights. Reads stay on the
+# primary for REPLICA_STICKY_SECONDS after a write, and a replica that cannot
+# be reached is skipped for REPLICA_RETRY_SECONDS
+
+DATABASE_REPLICAS = {}
+REPLICA_STICKY_SECONDS = 5
+REPLICA_RETRY_SECONDS = 30
+
+# Order databases; each user's orders live on one of them, picked by a hash
+# of the user id unless the rebalance_orders command moved the user
+
+ORDER_SHARDS = ['other_db']
+SHARD_MAP_CACHE_TIMEOUT = 60
+
+# Stripe; point STRIPE_API_BASE at a local fake or stripe-mock to test payments
+
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='https://api.stripe.com')
+
 # Static files (CSS, JavaScript, Images)
 
 STATIC_URL = '/static/'
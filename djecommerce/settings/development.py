@@ -1,8 +1,13 @@
 from .base import *
 
+from core.pooling import configure_pools
+
 DEBUG = True
+QUERY_STATS_HEADERS = True
 ALLOWED_HOSTS = ['127.0.0.1','localhost']
 
+EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
+
 INSTALLED_APPS += [
     'debug_toolbar'
 ]
@@ -58,6 +63,21 @@ DATABASES = {
     },
 }
 
+# Connection pooling per alias, see core.pooling
+DATABASE_POOLS = {
+    'default': {'MAX_AGE': 60},
+    'item_db': {'MAX_AGE': 300, 'HEALTH_CHECKS': True},
+    'other_db': {'MIN': 2, 'MAX': 10, 'INCREMENT': 1, 'TIMEOUT': 5, 'MAX_AGE': 600},
+}
+DATABASES = configure_pools(DATABASES, DATABASE_POOLS)
+
+# SQLite has no row locks, so its write lock is taken when a transaction
+# starts; otherwise the select_for_update() in services.user_lock would not
+# serialise anything
+for settings_dict in DATABASES.values():
+    if settings_dict['ENGINE'] == 'django.db.backends.sqlite3':
+        settings_dict['OPTIONS'] = {'transaction_mode': 'IMMEDIATE', **settings_dict.get('OPTIONS', {})}
+
 STRIPE_PUBLIC_KEY = config('STRIPE_TEST_PUBLIC_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_TEST_SECRET_KEY')
 
@@ -23,5 +23,13 @@ DATABASES = {
     
 }
 
+# Cart counts, cached pages and the shard map are shared by every worker
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('CACHE_URL', default='redis://127.0.0.1:6379/0'),
+    }
+}
+
 STRIPE_PUBLIC_KEY = config('STRIPE_LIVE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = config('STRIPE_LIVE_SECRET_KEY')
\ No newline at end of file
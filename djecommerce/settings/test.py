@@ -0,0 +1,53 @@
+import os
+
+os.environ.setdefault('SECRET_KEY', 'test-secret-key')
+os.environ.setdefault('STRIPE_TEST_PUBLIC_KEY', 'pk_test')
+os.environ.setdefault('STRIPE_TEST_SECRET_KEY', 'sk_test')
+
+from .base import *
+
+# SQLite stand-ins for the databases behind ItemRouter, with two order shards.
+# Test databases are files rather than in-memory so that several threads
+# can share them.
+
+DEBUG = False
+ALLOWED_HOSTS = ['testserver', '127.0.0.1', 'localhost']
+
+DATABASES = {
+    alias: {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, f'{alias}.sqlite3'),
+        # take the write lock when a transaction starts, as the row locks
+        # taken on Oracle would, instead of failing on lock upgrade
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, f'test_{alias}.sqlite3'),
+        },
+    }
+    for alias in ('default', 'item_db', 'other_db', 'other_db_2')
+}
+
+ORDER_SHARDS = ['other_db', 'other_db_2']
+
+# Each store gets a replica; under test it mirrors its primary's database
+DATABASE_REPLICAS = {
+    'item_db': {'item_db_replica': 1},
+    'other_db': {'other_db_replica': 1},
+}
+for primary, weights in DATABASE_REPLICAS.items():
+    for replica in weights:
+        DATABASES[replica] = dict(
+            DATABASES[primary],
+            NAME=os.path.join(BASE_DIR, f'{replica}.sqlite3'),
+            TEST={'MIRROR': primary}
+        )
+
+DATABASE_ROUTERS = ["routers.db_routers.ItemRouter"]
+
+QUERY_STATS_HEADERS = True
+QUERY_BUDGET_STRICT = True
+
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+STRIPE_PUBLIC_KEY = config('STRIPE_TEST_PUBLIC_KEY')
+STRIPE_SECRET_KEY = config('STRIPE_TEST_SECRET_KEY')
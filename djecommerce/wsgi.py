@@ -5,3 +5,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djecommerce.settings')
 
 application = get_wsgi_application()
+
+from core.catalogue import warm_catalogue  # noqa: E402
+
+warm_catalogue()
@@ -0,0 +1,35 @@
+import contextvars
+from contextlib import contextmanager
+
+# {'user': ..., 'shard': alias, 'primary': bool} for the block being run, see routing()
+_context = contextvars.ContextVar('routing_context', default=None)
+
+
+@contextmanager
+def routing(**options):
+    """
+    Route the queries run inside the block: user=... places order data that
+    came without a hint on that user's shard, shard=... on that shard
+    whoever the user is, and primary=True sends every read to the
+    primaries. Blocks nest, inner ones keep what they do not set.
+    """
+    token = _context.set({**(_context.get() or {}), **options})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def get(option, default=None):
+    return (_context.get() or {}).get(option, default)
+
+
+def user():
+    # the request user is lazy, so the session is only read when an order
+    # query needs it
+    user = get('user')
+    return getattr(user, 'pk', user)
+
+
+def primary_only():
+    return bool(get('primary'))
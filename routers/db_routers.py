@@ -1,3 +1,6 @@
+from . import replicas, shards
+
+
 # class ItemRouter:
 #     route_app_labels = {'core'}  # Add this attribute
 
@@ -64,17 +67,31 @@ class ItemRouter:
     
     # Apps that should use different databases
     core_app = 'core'
-    item_models = {'item'}
+    item_models = {'item', 'itemchange'}
     order_models = {
         'order', 
         'orderitem', 
         'payment',
         'coupon',
         'refund',
-        'orderitems'  # Changed from order_items to match model name
+        'orderitems',  # Changed from order_items to match model name
+        'job'
     }
+    # spread over the ORDER_SHARDS by user, from a user=... or instance hint
+    # (see routers.shards); the other order models stay on the first shard
+    sharded_models = {'order', 'orderitem', 'orderitems', 'payment', 'refund'}
 
     def db_for_read(self, model, **hints):
+        primary = self.primary_for(model, **hints)
+        if primary is None:
+            return None
+        return replicas.read_alias(primary)
+
+    def db_for_write(self, model, **hints):
+        # the primary is pinned once a write runs on it, see replicas.pin_writes
+        return self.primary_for(model, **hints)
+
+    def primary_for(self, model, **hints):
         app_label = model._meta.app_label
         model_name = model._meta.model_name
 
@@ -90,20 +107,23 @@ class ItemRouter:
         if app_label == self.core_app:
             if model_name in self.item_models:
                 return 'item_db'
+            if model_name in self.sharded_models:
+                return shards.shard_for_hints(hints)
             if model_name in self.order_models:
-                return 'other_db'
+                return shards.home_shard()
             return 'default'  
             
         return None
 
-    def db_for_write(self, model, **hints):
-        return self.db_for_read(model, **hints)
-
     def allow_relation(self, obj1, obj2, **hints):
         # Allow relations between objects in any database
         return True
 
     def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get their schema from their primary
+        if replicas.is_replica(db):
+            return False
+
         if model_name == 'user' or app_label == 'auth':
             return db == 'default'
             
@@ -114,7 +134,7 @@ class ItemRouter:
             if model_name in self.item_models:
                 return db == 'item_db'
             if model_name in self.order_models:
-                return db == 'other_db'
+                return db in shards.order_shards()
             return db == 'default'
             
         return None
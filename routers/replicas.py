@@ -0,0 +1,177 @@
+import contextvars
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DatabaseError, connections
+from django.dispatch import receiver
+
+from . import context
+
+logger = logging.getLogger(__name__)
+
+# {primary alias: time.time() until which reads stay on the primary}; set
+# per request by core.middleware.ReplicaPinMiddleware
+_pins = contextvars.ContextVar('replica_pins', default=None)
+_replica_sets = None
+
+
+def retry_seconds():
+    return getattr(settings, 'REPLICA_RETRY_SECONDS', 30)
+
+
+def sticky_seconds():
+    return getattr(settings, 'REPLICA_STICKY_SECONDS', 5)
+
+
+class ReplicaSet:
+    """
+    The read replicas of one primary alias, picked by smooth weighted round
+    robin: weights {'a': 2, 'b': 1} give a, b, a, a, b, a, ... A replica
+    that cannot be connected to is skipped for REPLICA_RETRY_SECONDS, and
+    reads fall back to the primary when no replica is up.
+    """
+
+    def __init__(self, primary, weights):
+        self.primary = primary
+        self.weights = dict(weights)
+        self.scores = dict.fromkeys(self.weights, 0)
+        self.down_until = {}
+        self.lock = threading.Lock()
+
+    def pick(self):
+        now = time.monotonic()
+        with self.lock:
+            up = [alias for alias in self.weights if self.down_until.get(alias, 0) <= now]
+            if not up:
+                return None
+            for alias in up:
+                self.scores[alias] += self.weights[alias]
+            alias = max(up, key=self.scores.__getitem__)
+            self.scores[alias] -= sum(self.weights[alias] for alias in up)
+            return alias
+
+    def mark_down(self, alias):
+        with self.lock:
+            self.down_until[alias] = time.monotonic() + retry_seconds()
+        logger.warning(f"Replica {alias} of {self.primary} is down, reading from the primary")
+
+    def choose(self):
+        for _ in range(len(self.weights)):
+            alias = self.pick()
+            if alias is None:
+                break
+            if is_up(alias):
+                return alias
+            self.mark_down(alias)
+        return self.primary
+
+
+def is_up(alias):
+    # opens the thread's connection if it has none; an open connection is
+    # left to CONN_HEALTH_CHECKS rather than pinged on every read
+    try:
+        connections[alias].ensure_connection()
+    except DatabaseError:
+        return False
+    return True
+
+
+def replica_sets():
+    # DATABASE_REPLICAS = {'item_db': {'item_db_replica': 1}, ...}
+    global _replica_sets
+    if _replica_sets is None:
+        _replica_sets = {
+            primary: ReplicaSet(primary, weights)
+            for primary, weights in getattr(settings, 'DATABASE_REPLICAS', {}).items()
+            if weights
+        }
+    return _replica_sets
+
+
+@receiver(setting_changed)
+def reset_replica_sets(setting, **kwargs):
+    global _replica_sets
+    if setting in ('DATABASE_REPLICAS', 'REPLICA_RETRY_SECONDS'):
+        _replica_sets = None
+
+
+def primary_of(alias):
+    for primary, replicas in replica_sets().items():
+        if alias in replicas.weights:
+            return primary
+    return alias
+
+
+def is_replica(alias):
+    return primary_of(alias) != alias
+
+
+def pin(primary):
+    # read-your-writes: reads of this primary skip the replicas for a while
+    pins = _pins.get()
+    if pins is None:
+        pins = {}
+        _pins.set(pins)
+    pins[primary] = time.time() + sticky_seconds()
+
+
+WRITE_RE = re.compile(r'\s*(INSERT|UPDATE|DELETE|MERGE|REPLACE)\b', re.IGNORECASE)
+
+
+def pin_writes(execute, sql, params, many, context):
+    # execute wrapper on the primaries: only a statement that writes pins,
+    # not asking the router where a write would go
+    result = execute(sql, params, many, context)
+    if WRITE_RE.match(sql):
+        pin(context['connection'].alias)
+    return result
+
+
+def watch_writes(sender, connection, **kwargs):
+    # connection_created receiver, connected in core.apps
+    if connection.alias in replica_sets() and pin_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, pin_writes)
+
+
+def is_pinned(primary):
+    pins = _pins.get()
+    return bool(pins) and pins.get(primary, 0) > time.time()
+
+
+def read_alias(primary):
+    replicas = replica_sets().get(primary)
+    if replicas is None or is_pinned(primary) or context.primary_only():
+        return primary
+    if connections[primary].in_atomic_block:
+        # reads inside a transaction must see its own writes
+        return primary
+    return replicas.choose()
+
+
+def start_request(cookie):
+    # pins carried over from earlier requests in a 'alias:until,...' cookie
+    pins = {}
+    now = time.time()
+    for part in (cookie or '').split(','):
+        alias, _, until = part.partition(':')
+        try:
+            until = float(until)
+        except ValueError:
+            continue
+        if alias in replica_sets() and until > now:
+            pins[alias] = until
+    return _pins.set(pins), dict(pins)
+
+
+def end_request(token):
+    pins = _pins.get() or {}
+    _pins.reset(token)
+    return pins
+
+
+def pins_cookie(pins):
+    return ','.join(f'{alias}:{until:.3f}' for alias, until in sorted(pins.items()))
@@ -0,0 +1,111 @@
+import zlib
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router, transaction
+
+from . import context, replicas
+
+
+def order_shards():
+    # ORDER_SHARDS = ['other_db', 'other_db_2', ...]; the first one also
+    # holds the tables that are not per user, such as CORE_COUPON
+    return list(getattr(settings, 'ORDER_SHARDS', ['other_db']))
+
+
+def home_shard():
+    return order_shards()[0]
+
+
+def hashed_shard(user_id):
+    shards = order_shards()
+    return shards[zlib.crc32(str(user_id).encode()) % len(shards)]
+
+
+def shard_cache_key(user_id):
+    return f'order-shard:{user_id}'
+
+
+def stored_shard(user_id):
+    # the user's shard as the database has it: the UserShard row that the
+    # rebalance_orders command wrote, else the hashed shard
+    UserShard = apps.get_model('core', 'UserShard')
+    shard = UserShard.objects.filter(user_id=user_id).values_list('shard', flat=True).first()
+    return shard or hashed_shard(user_id)
+
+
+def shard_for(user_id):
+    # cached per user, so pinning every user (rebalance_orders --pin-all)
+    # costs a cache entry per active user rather than the whole table
+    if user_id is None:
+        return home_shard()
+    shard = cache.get(shard_cache_key(user_id))
+    if shard is None:
+        shard = stored_shard(user_id)
+        remember_shard(user_id, shard)
+    return shard
+
+
+def remember_shard(user_id, shard):
+    cache.set(shard_cache_key(user_id), shard, getattr(settings, 'SHARD_MAP_CACHE_TIMEOUT', 60))
+
+
+def forget_shard(user_id):
+    cache.delete(shard_cache_key(user_id))
+
+
+def forget_moved_user(sender, instance, **kwargs):
+    # post_save and post_delete receiver for UserShard, connected in
+    # core.apps; once committed, so no reader caches the old shard again
+    db = router.db_for_write(sender, instance=instance)
+    transaction.on_commit(lambda: forget_shard(instance.user_id), using=db)
+
+
+def order_db(user, write=False):
+    """
+    The alias to use for the order data of ``user`` (a user or a user id):
+    its shard for writes, and for reads the shard or one of its replicas.
+    Same as asking the router with a user=... hint.
+    """
+    Order = apps.get_model('core', 'Order')
+    if write:
+        return router.db_for_write(Order, user=user)
+    return router.db_for_read(Order, user=user)
+
+
+def shard_for_hints(hints):
+    # an explicit hint wins over the user of the routing context
+    if 'user' in hints:
+        user = hints['user']
+        return shard_for(getattr(user, 'pk', user))
+    if 'instance' in hints:
+        return shard_of_instance(hints['instance'])
+    return context.get('shard') or shard_for(context.user())
+
+
+def shard_of_instance(instance):
+    # rows loaded from a shard stay on it; new rows follow a related row
+    # that is already on one (a Refund its Order), else their user
+    db = instance._state.db and replicas.primary_of(instance._state.db)
+    if db in order_shards():
+        return db
+    if instance._meta.label == settings.AUTH_USER_MODEL:
+        return shard_for(instance.pk)
+    for field in instance._meta.concrete_fields:
+        if field.is_relation and field.is_cached(instance):
+            related = field.get_cached_value(instance)
+            db = related is not None and related._state.db and replicas.primary_of(related._state.db)
+            if db in order_shards():
+                return db
+    return shard_for(getattr(instance, 'user_id', None))
+
+
+def store_of(alias):
+    # the logical store an alias belongs to, named after its home alias, so
+    # query budgets written for 'other_db' cover every order shard
+    primary = replicas.primary_of(alias)
+    if primary in order_shards():
+        return home_shard()
+    return primary
+